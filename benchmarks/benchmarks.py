@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Benchmarks of generating the commands and scheduler files of large experiments.
+
+These are run using airspeed velocity (asv), which records the results of each commit
+so the changes in performance can be followed over time. Each benchmark is run for a
+number of synthetic experiments, with between 10^3 and 10^7 combinations of the
+variables, created using each of the ways of combining variables.
+
+"""
+
+from collections import deque
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict
+
+from experi.commands import CommandStore, CommandTemplate, Job
+from experi.pbs import write_scheduler_file
+from experi.run import WRITE_BUFFER_SIZE, LazyMatrix, process_command, variable_matrix
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+
+def product_shape(size: int) -> Dict[str, Any]:
+    return {"a": {"arange": 10}, "b": {"arange": 10}, "c": {"arange": size // 100}}
+
+
+def zip_shape(size: int) -> Dict[str, Any]:
+    return {"zip": {"a": {"arange": size}, "b": {"arange": size}}, "c": "zip"}
+
+
+def chain_shape(size: int) -> Dict[str, Any]:
+    return {
+        "chain": [
+            {"a": "first", "b": {"arange": size // 2}},
+            {"a": "second", "b": {"arange": size // 2}},
+        ],
+        "c": "chain",
+    }
+
+
+def cycle_shape(size: int) -> Dict[str, Any]:
+    return {
+        "zip": {
+            "a": {"arange": size},
+            "cycle": {"times": 10, "b": {"arange": size // 10}},
+        },
+        "c": "cycle",
+    }
+
+
+def nested_shape(size: int) -> Dict[str, Any]:
+    return {
+        "product": {
+            "zip": {"a": {"arange": 10}, "b": {"arange": 10}},
+            "c": {"arange": size // 10},
+        }
+    }
+
+
+# Each shape has a unique command for every combination, with the variables a, b and c
+SHAPES = {
+    "product": product_shape,
+    "zip": zip_shape,
+    "chain": chain_shape,
+    "cycle": cycle_shape,
+    "nested": nested_shape,
+}
+
+COMMAND = {
+    "cmd": "echo {a} {b} {c} > {creates}",
+    "creates": "output/{a}_{b}_{c}.txt",
+}
+
+
+def create_job(shape: str, size: int) -> Job:
+    variables = LazyMatrix(variable_matrix, SHAPES[shape](size))
+    return Job(process_command(COMMAND, variables))
+
+
+class Expansion:
+    """Generating the combinations of the variables and the commands from them."""
+
+    params = (list(SHAPES), SIZES)
+    param_names = ["shape", "size"]
+    # The largest experiments take minutes, so each is only timed a few times
+    number = 1
+    repeat = (1, 5, 30.0)
+    warmup_time = 0
+    timeout = 1800
+
+    def setup(self, shape, size):
+        self.variables = SHAPES[shape](size)
+
+    def time_variable_matrix(self, shape, size):
+        deque(variable_matrix(self.variables), maxlen=0)
+
+    def time_process_command(self, shape, size):
+        process_command(COMMAND, LazyMatrix(variable_matrix, self.variables))
+
+
+class Deduplication:
+    """Creating the unique commands from the variables, half of which are repeated.
+
+    The variable b isn't used by the template, so each command is created from two
+    combinations of the variables.
+
+    """
+
+    params = SIZES
+    param_names = ["size"]
+    number = 1
+    repeat = (1, 5, 30.0)
+    warmup_time = 0
+    timeout = 1800
+
+    def setup(self, size):
+        self.template = CommandTemplate("echo {a}")
+        self.variables = {"a": {"arange": size // 2}, "b": {"arange": 2}}
+
+    def time_from_matrix(self, size):
+        CommandStore.from_matrix(self.template, variable_matrix(self.variables))
+
+
+class Scripts:
+    """Writing the scheduler file of a job to disk, with and without a manifest.
+
+    The commands are stored in the same way whichever shape created them, so these are
+    only run for the product of the variables.
+
+    """
+
+    params = SIZES
+    param_names = ["size"]
+    number = 1
+    repeat = (1, 5, 30.0)
+    warmup_time = 0
+    timeout = 1800
+
+    def setup(self, size):
+        self.job = create_job("product", size)
+        self.directory = TemporaryDirectory()
+        self.fname = Path(self.directory.name) / "experi_00.pbs"
+
+    def write(self):
+        manifest = self.fname.with_suffix(".commands")
+        with self.fname.open("w", buffering=WRITE_BUFFER_SIZE) as dst:
+            write_scheduler_file("pbs", self.job, dst, manifest)
+
+    def time_write_scheduler_file(self, size):
+        self.write()
+
+    def time_write_scheduler_file_manifest(self, size):
+        self.job.scheduler_options = {"manifest": True}
+        self.write()
+
+    def teardown(self, size):
+        self.job.scheduler_options = None
+        self.directory.cleanup()
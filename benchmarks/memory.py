@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Benchmarks of the memory used expanding and writing large experiments.
+
+The peakmem benchmarks are the peak resident memory of the process, while the track
+benchmarks are the peak memory allocated by python for each combination of the
+variables, measured using tracemalloc.
+
+"""
+
+import logging
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from experi.pbs import write_scheduler_file
+from experi.run import process_structure
+
+from .benchmarks import COMMAND, SHAPES, SIZES
+
+# Tracing the memory is much slower, so the largest experiments are skipped
+TRACED_SIZES = [size for size in SIZES if size <= 10 ** 6]
+
+
+def create_structure(shape, size):
+    return {"jobs": [{"command": COMMAND}], "variables": SHAPES[shape](size)}
+
+
+def expand_and_write(structure, directory):
+    for index, job in enumerate(process_structure(structure, "pbs")):
+        with (Path(directory) / f"experi_{index:02d}.pbs").open("w") as dst:
+            write_scheduler_file("pbs", job, dst)
+
+
+class PeakMemory:
+    """The resident memory expanding the variables and writing the scheduler file."""
+
+    params = (list(SHAPES), SIZES)
+    param_names = ["shape", "size"]
+    timeout = 1800
+
+    def setup(self, shape, size):
+        self.structure = create_structure(shape, size)
+        self.directory = TemporaryDirectory()
+
+    def teardown(self, shape, size):
+        self.directory.cleanup()
+
+    def peakmem_process_structure(self, shape, size):
+        for _ in process_structure(self.structure, "pbs"):
+            pass
+
+    def peakmem_write_scheduler_file(self, shape, size):
+        expand_and_write(self.structure, self.directory.name)
+
+
+class HeapPerCombination:
+    """The peak memory allocated by python for each combination of the variables."""
+
+    params = (list(SHAPES), TRACED_SIZES)
+    param_names = ["shape", "size"]
+    unit = "bytes"
+    timeout = 1800
+
+    def setup(self, shape, size):
+        self.structure = create_structure(shape, size)
+        self.directory = TemporaryDirectory()
+        # The log records would otherwise be counted
+        logging.disable(logging.DEBUG)
+
+    def teardown(self, shape, size):
+        logging.disable(logging.NOTSET)
+        self.directory.cleanup()
+
+    def track_process_structure(self, shape, size):
+        tracemalloc.start()
+        try:
+            for _ in process_structure(self.structure, "pbs"):
+                pass
+            return tracemalloc.get_traced_memory()[1] / size
+        finally:
+            tracemalloc.stop()
+
+    def track_write_scheduler_file(self, shape, size):
+        tracemalloc.start()
+        try:
+            expand_and_write(self.structure, self.directory.name)
+            return tracemalloc.get_traced_memory()[1] / size
+        finally:
+            tracemalloc.stop()
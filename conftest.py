@@ -0,0 +1,14 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Configuration of pytest for the whole repository.
+
+Having this file in the root of the repository adds it to the path when running the
+tests, so the tests are able to import the experiments defined in the benchmarks.
+
+"""
@@ -28,6 +28,7 @@ dev_require = [
     "coverage",
     "pytest-cov",
     "hypothesis",
+    "asv",
 ]
 docs_require = ["sphinx", "sphinx-autobuild", "sphinx-rtd-theme", "sphinx-click"]
 
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""A cache of the commands generated from an input file.
+
+Generating the commands of an experiment expands every combination of the variables,
+which for large experiments is most of the time taken to run experi. The cache stores
+the unique commands of each job, keyed by the contents of the input file and the
+version of experi, so running an unchanged experiment again, like to resubmit it or
+check which commands have completed, loads the commands rather than generating them.
+
+The entries of the cache are pickle files in ``.experi/cache`` within the experiment
+directory, with the least recently used entries removed once there are too many.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, TypeVar, Union
+
+from .journal import STATE_DIRECTORY
+from .version import __version__
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+T = TypeVar("T")
+
+# The location of the cache relative to the experiment directory
+CACHE_DIRECTORY = Path(STATE_DIRECTORY) / "cache"
+
+# The most entries kept in the cache, along with their total size in bytes
+MAX_ENTRIES = 8
+MAX_BYTES = 2 ** 28
+
+
+def structure_key(structure: Dict[str, Any]) -> Optional[str]:
+    """A digest of the input file and the version of experi.
+
+    The structure is serialised with the keys of every mapping sorted, so the key
+    only depends on the values in the input file, not the layout of the file.
+
+    Returns: The key, or None when the structure can't be serialised.
+
+    """
+    try:
+        normalised = json.dumps(
+            [__version__, structure], sort_keys=True, separators=(",", ":")
+        )
+    except (TypeError, ValueError):
+        logger.debug("Unable to create a key for the structure")
+        return None
+    return hashlib.blake2b(normalised.encode(), digest_size=16).hexdigest()
+
+
+class ExpansionCache:
+    """The commands generated from the input files of an experiment.
+
+    Args:
+        directory: The experiment directory, with the cache stored in
+            ``.experi/cache`` within it.
+        max_entries: The most entries to keep.
+        max_bytes: The largest total size of the entries, although the most recently
+            used entry is always kept.
+
+    """
+
+    def __init__(
+        self,
+        directory: PathLike,
+        max_entries: int = MAX_ENTRIES,
+        max_bytes: int = MAX_BYTES,
+    ) -> None:
+        self.path = Path(directory) / CACHE_DIRECTORY
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def entry(self, key: str) -> Path:
+        return self.path / f"{key}.pickle"
+
+    def load(self, key: str) -> Any:
+        """The value stored for a key, or None when there is no entry.
+
+        Loading an entry marks it as the most recently used.
+
+        """
+        path = self.entry(key)
+        try:
+            with path.open("rb") as src:
+                value = pickle.load(src)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Entries are replaced atomically, so this is an entry from an
+            # incompatible environment, which is discarded.
+            logger.warning("Removing unreadable cache entry %s", path)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            return None
+        os.utime(str(path))
+        return value
+
+    def store(self, key: str, value: Any) -> None:
+        """Store the value for a key, removing the least recently used entries."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.entry(key)
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with temporary.open("wb") as dst:
+            pickle.dump(value, dst, protocol=pickle.HIGHEST_PROTOCOL)
+        # Replacing the entry means other processes never read a partial entry
+        os.replace(str(temporary), str(path))
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries beyond the size of the cache."""
+        entries = []
+        for path in self.path.glob("*.pickle"):
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+        entries.sort(key=lambda entry: entry[0].st_mtime_ns, reverse=True)
+
+        total = 0
+        for count, (stat, path) in enumerate(entries):
+            total += stat.st_size
+            if count == 0 or (count < self.max_entries and total <= self.max_bytes):
+                continue
+            logger.debug("Removing cache entry %s", path)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def get(self, structure: Dict[str, Any], create: Callable[[], T]) -> T:
+        """The value for the structure, calling create to find it when not stored.
+
+        Args:
+            structure: The contents of the input file
+            create: A function returning the value to store for the structure
+
+        """
+        key = structure_key(structure)
+        if key is None:
+            return create()
+        value = self.load(key)
+        if value is None:
+            logger.debug("Cache miss for %s", key)
+            value = create()
+            self.store(key, value)
+        return value
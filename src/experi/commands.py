@@ -8,23 +8,146 @@
 
 """Command class."""
 
+import hashlib
+import io
 import logging
+from array import array
+from collections.abc import Sequence
+from itertools import repeat
 from pathlib import Path
 from string import Formatter
-from typing import Any, Dict, List, Optional, Set, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    MutableSequence,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+    overload,
+)
+
+from .dependencies import DigestStore, FileIndex, is_up_to_date
+from .profiling import phase
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .journal import Journal
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+class _Missing:
+    """Placeholder for a variable which has no value in a combination."""
+
+    def __repr__(self) -> str:
+        return "MISSING"
+
+    def __reduce__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+class CommandTemplate:
+    """The format strings which make up a command.
+
+    The format strings are parsed once when the template is created, finding the
+    variables they contain. A single template is shared between all the
+    :class:`Command` instances created from the same command in the input file, with
+    each Command providing different values for the variables.
+
+    """
+
+    __slots__ = ("cmd", "creates", "requires", "variables", "keys", "_uses_files")
+    __formatter = Formatter()
+
+    def __init__(
+        self, cmd: Union[List[str], str], creates: str = "", requires: str = ""
+    ) -> None:
+        if isinstance(cmd, str):
+            self.cmd: Tuple[str, ...] = (cmd,)
+        else:
+            self.cmd = tuple(cmd)
+        self.creates = creates
+        self.requires = requires
+
+        fields = self._fields(self.cmd)
+        # creates and requires are special values which are not variables
+        self.variables: FrozenSet[str] = frozenset(fields - {"creates", "requires"})
+        self._uses_files = bool(fields & {"creates", "requires"})
+        # All the variables which change the rendered command, including those in the
+        # creates and requires strings.
+        self.keys: Tuple[str, ...] = tuple(
+            sorted(
+                self.variables
+                | (self._fields((creates, requires)) - {"creates", "requires"})
+            )
+        )
+
+    @classmethod
+    def _fields(cls, strings: Iterable[str]) -> Set[str]:
+        """The names of the variables in the format strings.
+
+        A field can index or access an attribute of a variable, like ``{var[0]}`` or
+        ``{var.real}``, where the name of the variable is the part before either.
+
+        """
+        return {
+            field.split(".", 1)[0].split("[", 1)[0]
+            for string in strings
+            for _, field, _, _ in cls.__formatter.parse(string)
+            if field is not None
+        }
+
+    def project(self, variables: Dict[str, Any]) -> Tuple[Tuple, Tuple]:
+        """The values of the variables used by the template.
+
+        This is the subset of the variables which affect the rendered command, so two
+        combinations of variables with the same projection create the same command.
+        The types of the values are included since values which compare equal, like
+        ``1`` and ``1.0``, can be formatted differently.
+
+        """
+        values = tuple(map(variables.get, self.keys, repeat(MISSING)))
+        return values, tuple(map(type, values))
+
+    def missing_variables(self, variables: Dict[str, Any]) -> Set[str]:
+        """The variables in the template which have no value."""
+        return set(self.variables.difference(variables))
+
+    def render(self, variables: Dict[str, Any]) -> Tuple[Tuple[str, ...], str, str]:
+        """Substitute the variables into each of the format strings.
+
+        Returns: The commands, and the creates and requires strings.
+
+        """
+        creates = self.creates.format_map(variables) if self.creates else ""
+        requires = self.requires.format_map(variables) if self.requires else ""
+        if self._uses_files:
+            variables = dict(variables, creates=creates, requires=requires)
+        return (
+            tuple(string.format_map(variables) for string in self.cmd),
+            creates,
+            requires,
+        )
+
+
 class Command:
     """A command to be run for an experiment."""
 
-    _cmd: List[str]
-    variables: Dict[str, Any]
-    _creates: str = ""
-    _requires: str = ""
-    __formatter = Formatter()
+    # Using slots keeps each instance small, since there can be millions of commands.
+    __slots__ = ("_template", "_variables", "_rendered")
+
+    _template: CommandTemplate
+    _variables: Dict[str, Any]
+    _rendered: Optional[Tuple[Tuple[str, ...], str, str]]
 
     def __init__(
         self,
@@ -33,23 +156,40 @@ class Command:
         creates: str = "",
         requires: str = "",
     ) -> None:
-        self.cmd = cmd
+        self._template = CommandTemplate(cmd, creates, requires)
         if variables is not None:
             self.variables = variables
         else:
             self.variables = {}
+        self._check_variables()
+
+    @classmethod
+    def from_template(
+        cls, template: CommandTemplate, variables: Dict[str, Any], check: bool = True
+    ) -> "Command":
+        """Create a command sharing an already parsed template.
 
+        Args:
+            template: The template of the command
+            variables: The values of the variables to substitute into the template
+            check: Whether to check that all the variables in the template have a value
+
+        """
+        command = cls.__new__(cls)
+        command._template = template
+        command.variables = variables
+        if check:
+            command._check_variables()
+        return command
+
+    def _check_variables(self) -> None:
         # variables in cmd are a subset of those passed in
-        if self.get_variables() > set(self.variables.keys()):
+        missing_vars = self._template.missing_variables(self.variables)
+        if missing_vars:
             logger.debug("Command Keys: %s", self.get_variables())
             logger.debug("Variables Keys: %s", set(self.variables.keys()))
-            # Find missing variables
-            missing_vars = self.get_variables() - set(self.variables.keys())
             raise ValueError(f"The following variables have no value: {missing_vars}")
 
-        self._creates = creates
-        self._requires = requires
-
     def get_variables(self) -> Set[str]:
         """Find all the variables specified in a format string.
 
@@ -57,65 +197,249 @@ class Command:
         that is the variables inside the braces.
 
         """
-        variables = set()
-        for cmd in self._cmd:
-            for var in self.__formatter.parse(cmd):
-                logger.debug("Checking variable: %s", var)
-                # creates and requires are special class values
-                if var[1] is not None and var[1] not in ["creates", "requires"]:
-                    variables.add(var[1])
-        return variables
+        return set(self._template.variables)
+
+    @property
+    def variables(self) -> Dict[str, Any]:
+        return self._variables
+
+    @variables.setter
+    def variables(self, value: Dict[str, Any]) -> None:
+        self._variables = value
+        self._rendered = None
+
+    def _render(self) -> Tuple[Tuple[str, ...], str, str]:
+        # The rendered strings are cached since they are used for comparisons,
+        # hashing and output of the command.
+        if self._rendered is None:
+            self._rendered = self._template.render(self.variables)
+        return self._rendered
 
     @property
     def creates(self) -> str:
-        return self._creates.format(**self.variables)
+        return self._render()[1]
 
     @property
     def requires(self) -> str:
-        return self._requires.format(**self.variables)
+        return self._render()[2]
 
     @property
     def cmd(self) -> List[str]:
-        return [self._format_string(cmd) for cmd in self._cmd]
+        return list(self._render()[0])
 
     @cmd.setter
     def cmd(self, value) -> None:
-        if isinstance(value, str):
-            self._cmd = [value]
-        else:
-            self._cmd = list(value)
-
-    def _format_string(self, string: str) -> str:
-        return string.format(
-            creates=self.creates, requires=self.requires, **self.variables
+        self._template = CommandTemplate(
+            value, self._template.creates, self._template.requires
         )
+        self._rendered = None
 
     def __iter__(self):
-        yield from self.cmd
+        yield from self._render()[0]
+
+    def digest(self) -> str:
+        """A hash of the rendered command which is the same in every process.
+
+        Unlike the builtin hash this is stable between runs, identifying the command in
+        files like the journal.
+
+        """
+        steps = "\0".join(self._render()[0]).encode()
+        return hashlib.blake2b(steps, digest_size=16).hexdigest()
 
     def __str__(self) -> str:
-        return " && ".join(self.cmd).strip()
+        return " && ".join(self._render()[0]).strip()
 
     def __eq__(self, other) -> bool:
         if isinstance(other, type(self)):
-            return self.cmd == other.cmd
+            return self._render()[0] == other._render()[0]
         return False
 
     def __hash__(self):
-        return hash(tuple(self.cmd))
+        return hash(self._render()[0])
+
+
+def compact_column(column: List[Any]) -> MutableSequence:
+    """Store a column of integers or floats in an array.
+
+    An array stores the numbers directly, rather than as a pointer to a python object,
+    and is more compact to serialise. Columns of any other types are returned unchanged.
+
+    """
+    if column and all(type(value) is int for value in column):
+        try:
+            return array("q", column)
+        except OverflowError:
+            return column
+    if column and all(type(value) is float for value in column):
+        return array("d", column)
+    return column
+
+
+class VariableStore:
+    """The values of variables for many combinations stored by column.
+
+    Rather than a dictionary for each combination of variables, which repeats the
+    names of the variables and has the overhead of the dictionary, this keeps a single
+    tuple of the variable names and a column of values for each variable.
+
+    """
+
+    __slots__ = ("keys", "columns", "length")
+
+    def __init__(self) -> None:
+        self.keys: Tuple[str, ...] = ()
+        self.columns: List[MutableSequence] = []
+        self.length = 0
+
+    def append(self, variables: Dict[str, Any]) -> None:
+        """Add a combination of variables as a new row."""
+        for key in variables.keys() - set(self.keys):
+            # Variables which are not in every combination are marked as missing
+            self.keys += (key,)
+            self.columns.append([MISSING] * self.length)
+        for key, column in zip(self.keys, self.columns):
+            column.append(variables.get(key, MISSING))
+        self.length += 1
+
+    def compact(self) -> None:
+        """Convert columns of numbers to arrays once all the rows have been added."""
+        self.columns = [compact_column(list(column)) for column in self.columns]
+
+    def row(self, index: int) -> Dict[str, Any]:
+        """The variables of a single combination as a dictionary."""
+        return {
+            key: column[index]
+            for key, column in zip(self.keys, self.columns)
+            if column[index] is not MISSING
+        }
+
+    def __len__(self) -> int:
+        return self.length
+
+
+class CommandStore(Sequence):
+    """A sequence of commands sharing a template, with the variables stored by column.
+
+    Commands are created from the template and the stored variables as they are
+    accessed, so only a single template and the columns of values are kept in memory.
+
+    """
+
+    def __init__(self, template: CommandTemplate, variables: VariableStore) -> None:
+        self.template = template
+        self.variables = variables
+
+    @classmethod
+    def from_matrix(
+        cls, template: CommandTemplate, matrix: Iterable[Dict[str, Any]]
+    ) -> "CommandStore":
+        """Create the unique commands from each combination of variables in a matrix.
+
+        The combinations are first reduced to the unique values of the variables used in
+        the template, before any commands are created, so most of the work depends on
+        the number of unique commands rather than the number of combinations. Since
+        different values can still render the same command, the remaining commands are
+        compared using a digest of the rendered strings, so the memory used doesn't
+        depend on the length of the commands.
+
+        """
+        projections = dict.fromkeys(template.project(variables) for variables in matrix)
+
+        store = VariableStore()
+        seen: Set[bytes] = set()
+        with phase("render"):
+            for values, _ in projections:
+                variables = {
+                    key: value
+                    for key, value in zip(template.keys, values)
+                    if value is not MISSING
+                }
+                steps = "\0".join(Command.from_template(template, variables))
+                digest = hashlib.blake2b(steps.encode(), digest_size=16).digest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                store.append(variables)
+            store.compact()
+        return cls(template, store)
+
+    def __len__(self) -> int:
+        return len(self.variables)
+
+    @overload
+    def __getitem__(self, index: int) -> Command:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "CommandSelection":
+        ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CommandSelection(self, range(len(self))[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("CommandStore index out of range")
+        return Command.from_template(
+            self.template, self.variables.row(index), check=False
+        )
+
+
+class CommandSelection(Sequence):
+    """The commands of a sequence at the given indices, without copying them."""
+
+    def __init__(self, commands: Sequence, indices: Sequence) -> None:
+        self.commands = commands
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    @overload
+    def __getitem__(self, index: int) -> Command:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "CommandSelection":
+        ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CommandSelection(self.commands, self.indices[index])
+        return self.commands[self.indices[index]]
 
 
 class Job:
-    """A task to perform within a simulation."""
+    """A task to perform within a simulation.
 
-    commands: List[Command]
+    The commands which need to run are found once, the first time the job is iterated
+    over, with the result cached for finding the length and creating scheduler files.
+    Changing use_dependencies or calling :meth:`invalidate` checks the commands again.
+
+    """
+
+    commands: Sequence
     shell: str = "bash"
     scheduler_options: Optional[Dict[str, Any]] = None
-    use_dependencies: bool = False
     directory: Optional[Path] = None
+    journal: Optional["Journal"] = None
+    digests: Optional[DigestStore] = None
+    _use_dependencies: bool = False
+    # Whether the commands were already selected from those which need to run
+    _selected: bool = False
+    _index: Optional[FileIndex] = None
+    _pending: Optional[MutableSequence] = None
 
     def __init__(
-        self, commands, scheduler_options=None, directory=None, use_dependencies=False
+        self,
+        commands,
+        scheduler_options=None,
+        directory=None,
+        use_dependencies=False,
+        journal=None,
+        digests=None,
     ) -> None:
         if use_dependencies and directory is None:
             raise ValueError("Directory must be set when overwrite is False.")
@@ -124,18 +448,125 @@ class Job:
         self.scheduler_options = scheduler_options
         self.directory = directory
         self.use_dependencies = use_dependencies
+        self.journal = journal
+        self.digests = digests
 
-    def __iter__(self):
+    @property
+    def use_dependencies(self) -> bool:
+        return self._use_dependencies
+
+    @use_dependencies.setter
+    def use_dependencies(self, value: bool) -> None:
+        self._use_dependencies = value
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Discard the cached commands to run, checking the files again on next use."""
+        self._index = None
+        self._pending = None
+
+    @property
+    def index(self) -> FileIndex:
+        """The files in the directory of the job, which is read once."""
+        assert self.directory is not None
+        if self._index is None:
+            self._index = FileIndex(self.directory)
+        return self._index
+
+    def _pending_commands(self) -> Optional[MutableSequence]:
+        """The index of each command which needs to run, or None for every command."""
+        if self._selected or (not self.use_dependencies and self.journal is None):
+            return None
         if self.use_dependencies and self.directory is None:
             raise ValueError("Directory must be set when overwrite is False.")
-        for command in self.commands:
-            if self.use_dependencies and (self.directory / command.creates).is_file():
-                # This file already exists, we don't need to create it again
-                continue
-            yield command
+        if self._pending is None:
+            with phase("filter"):
+                self._pending = array(
+                    "q",
+                    (
+                        index
+                        for index, command in enumerate(self.commands)
+                        if not self.skip(command)
+                    ),
+                )
+        return self._pending
+
+    def __iter__(self):
+        pending = self._pending_commands()
+        if pending is None:
+            yield from self.commands
+        else:
+            for index in pending:
+                yield self.commands[index]
 
     def __len__(self) -> int:
-        return len(list(self.__iter__()))
+        pending = self._pending_commands()
+        if pending is None:
+            return len(self.commands)
+        return len(pending)
+
+    def split(self, size: int) -> List["Job"]:
+        """Split the commands which need to run into jobs of at most size commands.
+
+        The jobs share the options and journal of this job, with the journal only used
+        for recording the exit status of each command. The commands are selected once,
+        so the journal and dependencies of the commands of each job aren't checked
+        again.
+
+        """
+        assert size > 0
+        pending = self._pending_commands()
+        indices: Sequence = range(len(self.commands)) if pending is None else pending
+        parts = []
+        for start in range(0, len(indices), size):
+            part = Job(
+                CommandSelection(self.commands, indices[start : start + size]),
+                self.scheduler_options,
+                self.directory,
+                journal=self.journal,
+            )
+            part._selected = True
+            parts.append(part)
+        return parts
+
+    def skip(self, command: Command) -> bool:
+        """Whether a command doesn't need to run."""
+        if self.use_dependencies and self.is_up_to_date(command):
+            # The file already exists, we don't need to create it again
+            return True
+        if self.journal is not None and self.journal.is_complete(command):
+            # The command succeeded in a previous run
+            return True
+        return False
+
+    def is_up_to_date(self, command: Command) -> bool:
+        """Whether the file a command creates is newer than the file it requires.
+
+        When the job has a store of digests, the contents of the required file are
+        compared rather than the modification times.
+
+        """
+        assert self.directory is not None
+        return is_up_to_date(self.directory, command, self.digests, self.index)
+
+    def record(self, command: Command, status: int) -> None:
+        """Record the exit status of a command which has finished running."""
+        if self.journal is not None:
+            self.journal.record(command, status)
+        if self.digests is not None and status == 0:
+            self.digests.record(command)
+
+    def write_bash_array(self, stream: TextIO) -> None:
+        """Write the commands of the job to a stream as a bash array.
+
+        Each command is written as it is created, so the memory used is independent of
+        the number of commands.
+
+        """
+        stream.write("( \\\n")
+        for command in self:
+            stream.write(f'"{command}" \\\n')
+        stream.write(")")
 
     def as_bash_array(self) -> str:
         """Return a representation as a bash array.
@@ -143,8 +574,6 @@ class Job:
         This creates a string formatted as a bash array containing all the commands in the job.
 
         """
-        return_string = "( \\\n"
-        for command in self:
-            return_string += '"' + str(command) + '" \\\n'
-        return_string += ")"
-        return return_string
+        stream = io.StringIO()
+        self.write_bash_array(stream)
+        return stream.getvalue()
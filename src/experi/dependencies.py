@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Check whether the files created by a command are up to date.
+
+This follows the rules of make, where the file a command creates is up to date when it
+exists and is not older than the file the command requires. Where the modification
+times of files are unreliable, like on some network filesystems, the contents of the
+required file can be compared instead, using the digest of the required file recorded
+when the command last succeeded.
+
+Checking the files of many commands one at a time is slow on network filesystems, where
+each check is a request to the server, so the files are found using a
+:class:`FileIndex`, which reads each directory once.
+
+"""
+
+import hashlib
+import logging
+import os
+import stat
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Union
+
+from .journal import STATE_DIRECTORY, AppendFile
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .commands import Command
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+# The location of the digests of required files relative to the experiment directory
+DIGEST_FILE = Path(STATE_DIRECTORY) / "digests"
+
+# The size of the blocks read when computing the digest of a file
+BLOCK_SIZE = 2 ** 20
+
+
+def modified_time(path: PathLike) -> Optional[int]:
+    """The modification time of a file in nanoseconds, or None when it doesn't exist.
+
+    Directories and other types of file are treated as not existing, matching the
+    check for the file using :meth:`pathlib.Path.is_file`.
+
+    """
+    try:
+        result = os.stat(str(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not stat.S_ISREG(result.st_mode):
+        return None
+    return result.st_mtime_ns
+
+
+def file_digest(path: PathLike) -> str:
+    """A digest of the contents of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(str(path), "rb") as src:
+        for block in iter(lambda: src.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileIndex:
+    """The files within the directories of an experiment, read a directory at a time.
+
+    Each directory is read once with :func:`os.scandir` the first time a file within it
+    is checked. This finds whether each file exists without a system call for every
+    file, with the modification time only read for the files which exist. The index
+    reflects the files at the time each directory was read.
+
+    Args:
+        directory: The directory the paths of the files are relative to
+
+    """
+
+    def __init__(self, directory: PathLike) -> None:
+        self.directory = str(directory)
+        self._directories: Dict[str, Dict[str, os.DirEntry]] = {}
+
+    def _entries(self, parent: str) -> Dict[str, os.DirEntry]:
+        entries = self._directories.get(parent)
+        if entries is None:
+            try:
+                with os.scandir(parent) as iterator:
+                    entries = {entry.name: entry for entry in iterator}
+            except (FileNotFoundError, NotADirectoryError):
+                entries = {}
+            self._directories[parent] = entries
+        return entries
+
+    def _entry(self, path: PathLike) -> Optional[os.DirEntry]:
+        parent, name = os.path.split(
+            os.path.normpath(os.path.join(self.directory, str(path)))
+        )
+        # A file in the current directory has no parent when the directory is relative
+        entry = self._entries(parent or os.curdir).get(name)
+        if entry is None or not entry.is_file():
+            return None
+        return entry
+
+    def exists(self, path: PathLike) -> bool:
+        """Whether the path is a file, matching :meth:`pathlib.Path.is_file`."""
+        return self._entry(path) is not None
+
+    def modified_time(self, path: PathLike) -> Optional[int]:
+        """The modification time of a file, or None when it doesn't exist."""
+        entry = self._entry(path)
+        if entry is None:
+            return None
+        try:
+            return entry.stat().st_mtime_ns
+        except FileNotFoundError:
+            # The file was removed after the directory was read
+            return None
+
+
+class DigestStore:
+    """The digest of the required file when each command last succeeded.
+
+    The digests are stored in ``.experi/digests`` within the experiment directory,
+    keyed by the file the command creates, with the file only ever appended to. The
+    digests are only recorded for commands run locally, the elements of an array job
+    submitted to a scheduler never update them.
+
+    Args:
+        directory: The experiment directory
+
+    """
+
+    def __init__(self, directory: PathLike) -> None:
+        self.directory = Path(directory)
+        self.path = self.directory / DIGEST_FILE
+        self._digests: Optional[Dict[str, str]] = None
+        self._file = AppendFile(self.path)
+
+    @property
+    def digests(self) -> Dict[str, str]:
+        if self._digests is None:
+            self._digests = {}
+            try:
+                with self.path.open("r") as src:
+                    for line in src:
+                        digest, _, creates = line.rstrip("\n").partition(" ")
+                        if creates:
+                            self._digests[creates] = digest
+            except FileNotFoundError:
+                pass
+        return self._digests
+
+    def get(self, creates: str) -> Optional[str]:
+        """The digest of the required file when the file was last created."""
+        return self.digests.get(creates)
+
+    def record(self, command: "Command") -> None:
+        """Store the digest of the file required by a command which succeeded."""
+        if not command.creates or not command.requires:
+            return
+        try:
+            digest = file_digest(self.directory / command.requires)
+        except FileNotFoundError:
+            return
+        self._file.write(f"{digest} {command.creates}\n")
+        self.digests[command.creates] = digest
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _modified_time(
+    directory: PathLike, path: str, index: Optional[FileIndex]
+) -> Optional[int]:
+    if index is not None:
+        return index.modified_time(path)
+    return modified_time(Path(directory) / path)
+
+
+def is_up_to_date(
+    directory: PathLike,
+    command: "Command",
+    digests: Optional[DigestStore] = None,
+    index: Optional[FileIndex] = None,
+) -> bool:
+    """Whether the file created by a command is up to date with the file it requires.
+
+    Args:
+        directory: The directory the files are relative to
+        command: The command to check
+        digests: Compare the contents of the required file with the digest stored when
+            the command last succeeded. Where there is no stored digest, this falls
+            back to comparing the modification times.
+        index: The index of the files in the directory, which is used rather than
+            checking each file.
+
+    Returns: True when the command doesn't need to run.
+
+    """
+    if not command.creates:
+        return False
+    if not command.requires and index is not None:
+        return index.exists(command.creates)
+    created = _modified_time(directory, command.creates, index)
+    if created is None:
+        return False
+    if not command.requires:
+        return True
+
+    required_path = Path(directory) / command.requires
+    if digests is not None:
+        stored = digests.get(command.creates)
+        if stored is not None:
+            try:
+                return file_digest(required_path) == stored
+            except FileNotFoundError:
+                return False
+
+    required = _modified_time(directory, command.requires, index)
+    if required is None:
+        # The command can't run without the file it requires
+        logger.debug("Required file %s doesn't exist", required_path)
+        return False
+    return created >= required
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""The dependencies between the commands of all the jobs in an experiment.
+
+Rather than waiting for every command of a job to finish before starting the next job,
+each command which requires a file created by a command of an earlier job only waits
+for that command. Commands which don't require a file created by an earlier job wait
+for all the commands of the previous job, the same as running each job in turn.
+
+"""
+
+import logging
+import os
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set
+
+from .commands import Command, Job
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+class Task:
+    """A command within the graph, or the completion of a job when command is None."""
+
+    __slots__ = ("command", "job", "waiting", "dependents", "failed")
+
+    def __init__(self, command: Optional[Command], job: Job) -> None:
+        self.command = command
+        self.job = job
+        # The number of tasks this task is waiting on
+        self.waiting = 0
+        self.dependents: List["Task"] = []
+        # Whether a task this depends on has failed
+        self.failed = False
+
+    def add_dependent(self, task: "Task") -> None:
+        self.dependents.append(task)
+        task.waiting += 1
+
+
+def normalise(path: str) -> str:
+    return os.path.normpath(path)
+
+
+class CommandGraph:
+    """The commands of every job, linked by the files they create and require.
+
+    Each command is linked to the commands of earlier jobs which create the file it
+    requires. Where no earlier job creates the file, the command depends on the
+    completion of the previous job, which is a task depending on every command in that
+    job along with the completion of the job before it.
+
+    Commands which don't need to run, as determined by :meth:`experi.commands.Job.skip`,
+    are left out of the graph, unless a command creating the file they require is
+    going to run, which makes the file they create out of date.
+
+    Args:
+        jobs: The jobs in the order they are run
+
+    """
+
+    def __init__(self, jobs: Iterable[Job]) -> None:
+        self.ready: Deque[Task] = deque()
+        self.failed = 0
+        self.tasks: List[Task] = []
+
+        # The tasks which create each file, and all the files created by earlier jobs
+        producers: Dict[str, List[Task]] = {}
+        created: Set[str] = set()
+        previous: Optional[Task] = None
+        for job in jobs:
+            completion = Task(None, job)
+            job_producers: Dict[str, List[Task]] = {}
+            job_created: Set[str] = set()
+            for command in job.commands:
+                if command.creates:
+                    # Files created by skipped commands still resolve dependencies
+                    job_created.add(normalise(command.creates))
+                requires = normalise(command.requires) if command.requires else None
+                sources = producers.get(requires, []) if requires else []
+                if not sources and job.skip(command):
+                    continue
+
+                task = Task(command, job)
+                if requires in created:
+                    for source in sources:
+                        source.add_dependent(task)
+                elif previous is not None:
+                    previous.add_dependent(task)
+                task.add_dependent(completion)
+                self.tasks.append(task)
+
+                if command.creates:
+                    creates = normalise(command.creates)
+                    job_producers.setdefault(creates, []).append(task)
+
+            created.update(job_created)
+            producers.update(job_producers)
+
+            if previous is not None:
+                previous.add_dependent(completion)
+            self.tasks.append(completion)
+            previous = completion
+
+        # Completing a task can make others ready, so find the initial tasks first
+        for task in [task for task in self.tasks if task.waiting == 0]:
+            self._start(task)
+
+    def _start(self, task: Task) -> None:
+        if task.command is None:
+            self.complete(task, True)
+        else:
+            self.ready.append(task)
+
+    def __len__(self) -> int:
+        """The number of commands in the graph."""
+        return sum(1 for task in self.tasks if task.command is not None)
+
+    def take(self, size: int = 1) -> List[Task]:
+        """Remove up to size tasks from the same job which are ready to run."""
+        batch = [self.ready.popleft()]
+        while len(batch) < size and self.ready and self.ready[0].job is batch[0].job:
+            batch.append(self.ready.popleft())
+        return batch
+
+    def complete(self, task: Task, success: bool) -> None:
+        """Mark a task as complete, finding the tasks which are now ready to run.
+
+        When a task fails, all the tasks which depend on it are skipped.
+
+        """
+        stack = [(task, success)]
+        while stack:
+            task, success = stack.pop()
+            if not success and task.command is not None:
+                self.failed += 1
+            for dependent in task.dependents:
+                dependent.waiting -= 1
+                if not success:
+                    dependent.failed = True
+                if dependent.waiting > 0:
+                    continue
+                if dependent.failed:
+                    if dependent.command is not None:
+                        logger.warning(
+                            "Skipping %s since a command it requires failed",
+                            dependent.command,
+                        )
+                    stack.append((dependent, False))
+                elif dependent.command is None:
+                    stack.append((dependent, True))
+                else:
+                    self.ready.append(dependent)
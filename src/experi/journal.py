@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""A record of the commands which have completed.
+
+The journal is a file in the experiment directory with a line for each command which
+has finished, containing the digest of the command and its exit status. When running
+an experiment again, commands which have already succeeded are skipped, so only the
+remaining commands are run.
+
+The journal is only ever appended to, with each line written using a single write to
+a file opened in append mode, so many processes, like the elements of an array job,
+are able to write to the same journal at the same time.
+
+"""
+
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Set, Union
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .commands import Command
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+# The directory for the files experi creates within the experiment directory
+STATE_DIRECTORY = ".experi"
+# The location of the journal relative to the experiment directory
+JOURNAL_FILE = Path(STATE_DIRECTORY) / "journal"
+
+
+class AppendFile:
+    """A file which many processes append lines to at the same time.
+
+    Each line is written using a single write to a file opened in append mode, while
+    holding an exclusive lock on the file, so the lines written by different processes
+    are never interleaved. The file is opened on the first write.
+
+    """
+
+    def __init__(self, path: PathLike) -> None:
+        self.path = Path(path)
+        self._fd: Optional[int] = None
+
+    def write(self, line: str) -> None:
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(
+                str(self.path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            os.write(self._fd, line.encode())
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Journal:
+    """An append only record of the exit status of each command.
+
+    Args:
+        directory: The experiment directory, with the journal stored in
+            ``.experi/journal`` within it.
+
+    """
+
+    def __init__(self, directory: PathLike) -> None:
+        self.path = Path(directory) / JOURNAL_FILE
+        self._completed: Optional[Set[str]] = None
+        self._file = AppendFile(self.path)
+
+    def read(self) -> Dict[str, int]:
+        """The most recent exit status of each command in the journal."""
+        statuses: Dict[str, int] = {}
+        try:
+            with self.path.open("r") as src:
+                for line in src:
+                    # A line can be incomplete when a process was killed while writing
+                    digest, _, status = line.partition(" ")
+                    try:
+                        statuses[digest] = int(status)
+                    except ValueError:
+                        logger.debug("Skipping invalid journal entry: %s", line)
+        except FileNotFoundError:
+            pass
+        return statuses
+
+    @property
+    def completed(self) -> Set[str]:
+        """The digests of the commands which have succeeded.
+
+        This is read once, so the commands skipped are those which had completed before
+        the experiment started running.
+
+        """
+        if self._completed is None:
+            self._completed = {
+                digest for digest, status in self.read().items() if status == 0
+            }
+        return self._completed
+
+    def is_complete(self, command: "Command") -> bool:
+        return command.digest() in self.completed
+
+    def record(self, command: "Command", status: int) -> None:
+        """Append the exit status of a command to the journal."""
+        self._file.write(f"{command.digest()} {status}\n")
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,830 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Run commands on the local machine.
+
+This uses asyncio to manage the subprocesses, allowing for many short lived commands to
+be running at the same time from a single thread. Each command starts once the commands
+it depends on have succeeded, as described by a :class:`experi.graph.CommandGraph`.
+Rather than each command writing directly to the terminal, the output of each command
+is read a line at a time and written with a label of the variables of the command, so
+the output of concurrent commands is not interleaved within a line.
+
+Commands can either be run in a new shell, sent to a pool of long running shells,
+or combined into batches which run in a single shell, with the last two removing the
+cost of starting a process for each command.
+
+Where a job requests resources, each command is allocated the cpus, memory and gpus it
+requires from those of the machine, with the command pinned to the allocated cpus.
+
+"""
+
+import asyncio
+import logging
+import os
+import re
+import secrets
+import shlex
+import sys
+import time
+from functools import partial
+from pathlib import Path
+from subprocess import DEVNULL
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+from .commands import Command, Job
+from .graph import CommandGraph, Task
+from .pbs import SchedulerOptions
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+# A function called with each command and its exit status once it has finished
+Recorder = Callable[[Command, int], None]
+
+# The size of the chunks read from the output of a command
+CHUNK_SIZE = 2 ** 16
+
+# A long running shell reads scripts separated by null bytes from stdin, evaluating
+# each of them in turn. The scripts are created by batch_script.
+WORKER_SCRIPT = """
+while IFS= read -r -d '' script; do
+    eval "$script"
+done
+"""
+
+# Each command of a batch is evaluated in a subshell so changes to the directory and
+# environment don't persist, and a syntax error only affects that command. Once the
+# command has finished a marker is written to stderr, then the marker along with the
+# exit status to stdout, which separates the output of each command.
+BATCH_COMMAND = """
+( eval {script} ) < /dev/null
+status=$?
+printf '\\0%s\\n' {marker} >&2
+printf '\\0%s %d\\n' {marker} "$status"
+"""
+
+# Variables setting the number of threads used by common numerical libraries, which
+# otherwise start a thread for every cpu of the machine.
+THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+# The scheduler options which request resources for each command
+RESOURCE_OPTIONS = ("ncpus", "cpus", "mem", "memory", "ngpus", "gpus")
+
+# The units of memory accepted by PBS and SLURM
+MEMORY_UNITS = {
+    "": 1,
+    "b": 1,
+    "k": 2 ** 10,
+    "kb": 2 ** 10,
+    "m": 2 ** 20,
+    "mb": 2 ** 20,
+    "g": 2 ** 30,
+    "gb": 2 ** 30,
+    "t": 2 ** 40,
+    "tb": 2 ** 40,
+}
+
+
+def command_label(command: Command) -> str:
+    """A label identifying the command for prefixing lines of output."""
+    if command.variables:
+        return " ".join(f"{key}={value}" for key, value in command.variables.items())
+    return str(command)
+
+
+def write_line(output: TextIO, label: str, line: bytes) -> None:
+    output.write(f"[{label}] {line.decode(errors='replace')}\n")
+
+
+async def forward_output(
+    stream: asyncio.StreamReader, output: TextIO, label: str
+) -> None:
+    """Write each line of a stream to the output, prefixed with the label.
+
+    The stream is read in chunks rather than using readline, which has a limit on the
+    length of a line.
+
+    """
+    partial = b""
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            write_line(output, label, line)
+    if partial:
+        write_line(output, label, partial)
+
+
+class MarkedReader:
+    """Read the output of many commands from a single stream.
+
+    The output of each command is terminated by a marker, which is followed by the exit
+    status of the command on stdout. Any output after the marker is kept for the next
+    command.
+
+    """
+
+    def __init__(self, stream: asyncio.StreamReader, marker: bytes) -> None:
+        self.stream = stream
+        self.marker = b"\0" + marker
+        self.buffer = b""
+        self.finished = False
+
+    async def forward(self, output: TextIO, label: str) -> Optional[bytes]:
+        """Write lines to the output until the marker is found.
+
+        Returns: The text following the marker, or None when the stream ended before
+            the marker was found.
+
+        """
+        while True:
+            start = 0
+            end = self.buffer.find(b"\n")
+            while end >= 0:
+                line = self.buffer[start:end]
+                start = end + 1
+                text, found, status = line.partition(self.marker)
+                if text:
+                    write_line(output, label, text)
+                if found:
+                    self.buffer = self.buffer[start:]
+                    return status.strip()
+                end = self.buffer.find(b"\n", start)
+            self.buffer = self.buffer[start:]
+
+            chunk = await self.stream.read(CHUNK_SIZE)
+            if not chunk:
+                if self.buffer:
+                    write_line(output, label, self.buffer)
+                    self.buffer = b""
+                self.finished = True
+                return None
+            self.buffer += chunk
+
+
+def command_script(
+    command: Command, directory: PathLike, environment: Dict[str, str] = None
+) -> str:
+    """A shell script running the steps of a command in order within the directory.
+
+    Each step is run in a separate subshell, matching running each step with a new
+    shell, with the script stopping at the first step to fail.
+
+    """
+    exports = "".join(
+        f"export {key}={shlex.quote(value)}\n"
+        for key, value in (environment or {}).items()
+    )
+    steps = " && ".join(f"(\n{cmd}\n)" for cmd in command)
+    return f"cd {shlex.quote(str(directory))} || exit 1\n{exports}{steps}\n"
+
+
+def batch_script(
+    commands: List[Command],
+    directory: PathLike,
+    marker: bytes,
+    environment: Dict[str, str] = None,
+) -> str:
+    """A shell script running each of the commands, reporting each exit status."""
+    return "".join(
+        BATCH_COMMAND.format(
+            script=shlex.quote(command_script(command, directory, environment)),
+            marker=marker.decode(),
+        )
+        for command in commands
+    )
+
+
+async def read_statuses(
+    stdout: MarkedReader,
+    stderr: MarkedReader,
+    commands: List[Command],
+    record: Optional[Recorder] = None,
+) -> List[bool]:
+    """Forward the output of each command in a batch, returning whether each succeeded.
+
+    Where the shell exits before all the commands are complete, the remaining commands
+    are considered to have failed, without their status being recorded.
+
+    """
+    results: List[bool] = []
+    for command in commands:
+        label = command_label(command)
+        _, status = await asyncio.gather(
+            stderr.forward(sys.stderr, label), stdout.forward(sys.stdout, label)
+        )
+        if status is None:
+            logger.error("Shell exited before running %s", command)
+            results += [False] * (len(commands) - len(results))
+            break
+        if int(status) != 0:
+            logger.error("Command failed: %s", command)
+        if record is not None:
+            record(command, int(status))
+        results.append(int(status) == 0)
+    return results
+
+
+def parse_memory(value: Union[int, str]) -> int:
+    """The number of bytes in a memory requirement, like ``4gb`` or ``500M``."""
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*", str(value))
+    if match is None or match.group(2).lower() not in MEMORY_UNITS:
+        raise ValueError(f"Unable to understand the memory requirement '{value}'.")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()])
+
+
+def available_cpus() -> List[int]:
+    """The cpus this process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def total_memory() -> Optional[int]:
+    """The physical memory of the machine in bytes, or None when it can't be found."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def visible_gpus() -> List[str]:
+    """The gpus this process is allowed to use, as set by CUDA_VISIBLE_DEVICES."""
+    devices = os.environ.get("CUDA_VISIBLE_DEVICES", "")
+    return [device for device in devices.split(",") if device.strip()]
+
+
+class Resources:
+    """The resources required to run each command of a job.
+
+    These are the resources requested from a scheduler for each element of an array
+    job, that is the ``ncpus``, ``mem`` and ``ngpus`` options.
+
+    """
+
+    def __init__(self, cpus: int = 1, memory: int = 0, gpus: int = 0) -> None:
+        self.cpus = cpus
+        self.memory = memory
+        self.gpus = gpus
+
+    @classmethod
+    def from_options(
+        cls, scheduler_options: Optional[Dict[str, Any]]
+    ) -> Optional["Resources"]:
+        """The resources requested in the scheduler options of a job.
+
+        Returns: The resources, or None where the scheduler options of the job don't
+            request any resources.
+
+        """
+        if scheduler_options is None or not any(
+            option in scheduler_options for option in RESOURCE_OPTIONS
+        ):
+            return None
+        resources = SchedulerOptions(**scheduler_options).resources
+        return cls(
+            cpus=int(resources.get("ncpus", 1)),
+            memory=parse_memory(resources.get("mem", 0)),
+            gpus=int(resources.get("ngpus", 0)),
+        )
+
+    def __repr__(self) -> str:
+        return f"Resources(cpus={self.cpus}, memory={self.memory}, gpus={self.gpus})"
+
+
+class Allocation:
+    """The resources allocated to a running command."""
+
+    def __init__(
+        self, cpus: List[int], memory: int, gpus: List[str], pin: bool
+    ) -> None:
+        self.cpus = cpus
+        self.memory = memory
+        self.gpus = gpus
+        self.pin = pin
+
+    def environment(self) -> Dict[str, str]:
+        """Environment variables limiting the command to the allocated resources."""
+        environment = {variable: str(len(self.cpus)) for variable in THREAD_VARIABLES}
+        if self.gpus:
+            environment["CUDA_VISIBLE_DEVICES"] = ",".join(self.gpus)
+        return environment
+
+    def set_affinity(self, pid: int = 0) -> None:
+        """Restrict a process to the allocated cpus, which is inherited by children."""
+        if self.pin:
+            os.sched_setaffinity(pid, self.cpus)
+
+
+class ResourcePool:
+    """The resources of the machine which are shared between the running commands.
+
+    Each of the slots is a cpu, so when running with ``slots`` of 8, a command
+    requiring 4 cpus takes half of the slots. Where there is a cpu available for each
+    slot, the commands are pinned to the cpus allocated to them, so concurrent
+    commands never share a cpu. With more slots than cpus the slots are only used for
+    counting, and commands are not pinned.
+
+    """
+
+    def __init__(self, slots: int) -> None:
+        cpus = available_cpus()
+        self.pin = hasattr(os, "sched_setaffinity") and slots <= len(cpus)
+        self.cpus = cpus[:slots] if self.pin else list(range(slots))
+        self.slots = slots
+        self.total_memory = total_memory()
+        self.memory = self.total_memory
+        self.gpus = visible_gpus()
+        self.total_gpus = len(self.gpus)
+        self.condition = asyncio.Condition()
+
+    def fit(self, resources: Resources) -> Resources:
+        """Limit the resources to those of the machine.
+
+        A command requiring more resources than the machine has would never run, so
+        instead it is run with all of that resource.
+
+        """
+        cpus = resources.cpus
+        if cpus > self.slots:
+            logger.warning(
+                "Commands require %d cpus, only %d are available", cpus, self.slots
+            )
+            cpus = self.slots
+        memory = resources.memory
+        if self.total_memory is not None and memory > self.total_memory:
+            logger.warning(
+                "Commands require %d bytes of memory, only %d are available",
+                memory,
+                self.total_memory,
+            )
+            memory = self.total_memory
+        gpus = resources.gpus
+        if gpus > self.total_gpus:
+            logger.warning(
+                "Commands require %d gpus, only %d are set in CUDA_VISIBLE_DEVICES",
+                gpus,
+                self.total_gpus,
+            )
+            gpus = self.total_gpus
+        return Resources(max(1, cpus), memory, gpus)
+
+    def concurrency(self, resources: Resources) -> int:
+        """The maximum number of commands which can be running at the same time."""
+        return max(1, self.slots // resources.cpus)
+
+    def _available(self, resources: Resources) -> bool:
+        return (
+            len(self.cpus) >= resources.cpus
+            and (self.memory is None or self.memory >= resources.memory)
+            and len(self.gpus) >= resources.gpus
+        )
+
+    async def acquire(self, resources: Resources) -> Allocation:
+        """Wait for the resources to be available, allocating them to a command."""
+        async with self.condition:
+            await self.condition.wait_for(partial(self._available, resources))
+            cpus, self.cpus = self.cpus[: resources.cpus], self.cpus[resources.cpus :]
+            gpus, self.gpus = self.gpus[: resources.gpus], self.gpus[resources.gpus :]
+            if self.memory is not None:
+                self.memory -= resources.memory
+            return Allocation(cpus, resources.memory, gpus, self.pin)
+
+    async def release(self, allocation: Allocation) -> None:
+        """Return the resources of a completed command to the pool."""
+        async with self.condition:
+            # Keeping the cpus sorted allocates neighbouring cpus to each command
+            self.cpus = sorted(self.cpus + allocation.cpus)
+            self.gpus += allocation.gpus
+            if self.memory is not None:
+                self.memory += allocation.memory
+            self.condition.notify_all()
+
+
+def process_environment(allocation: Optional[Allocation]) -> Optional[Dict[str, str]]:
+    """The environment of a process running with the allocation."""
+    if allocation is None:
+        return None
+    return dict(os.environ, **allocation.environment())
+
+
+def process_affinity(allocation: Optional[Allocation]) -> Optional[Callable[[], None]]:
+    """A function setting the cpus of a new process before it runs the command."""
+    if allocation is None or not allocation.pin:
+        return None
+    return allocation.set_affinity
+
+
+async def run_command(
+    shell: str,
+    command: Command,
+    directory: PathLike,
+    allocation: Optional[Allocation] = None,
+    record: Optional[Recorder] = None,
+    labelled: bool = True,
+) -> bool:
+    """Run each of the steps of a command in order, stopping at the first failure.
+
+    Where the output is not labelled, the command writes directly to the terminal,
+    which is only suitable when a single command is running at a time.
+
+    Returns: Whether all the steps of the command succeeded.
+
+    """
+    label = command_label(command)
+    output = asyncio.subprocess.PIPE if labelled else None
+    status = 0
+    for cmd in command:
+        logger.info(cmd)
+        process = await asyncio.create_subprocess_exec(
+            shell,
+            "-c",
+            cmd,
+            cwd=str(directory),
+            stdin=DEVNULL,
+            stdout=output,
+            stderr=output,
+            env=process_environment(allocation),
+            preexec_fn=process_affinity(allocation),
+        )
+        if labelled:
+            assert process.stdout is not None and process.stderr is not None
+            await asyncio.gather(
+                forward_output(process.stdout, sys.stdout, label),
+                forward_output(process.stderr, sys.stderr, label),
+            )
+        status = await process.wait()
+        if status != 0:
+            logger.error("Command failed: %s", command)
+            break
+    if record is not None:
+        record(command, status)
+    return status == 0
+
+
+async def run_batch(
+    shell: str,
+    commands: List[Command],
+    directory: PathLike,
+    allocation: Optional[Allocation] = None,
+    record: Optional[Recorder] = None,
+) -> bool:
+    """Run a batch of commands in a single shell.
+
+    The script is sent to the shell through stdin like the long running shells, since
+    the length of a single argument is limited by the operating system. The shell
+    exits once stdin is closed.
+
+    Returns: Whether all the commands succeeded.
+
+    """
+    for command in commands:
+        logger.info(command)
+    marker = secrets.token_hex(16).encode()
+    process = await asyncio.create_subprocess_exec(
+        shell,
+        "-c",
+        WORKER_SCRIPT,
+        cwd=str(directory),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=process_environment(allocation),
+        preexec_fn=process_affinity(allocation),
+    )
+    assert process.stdin is not None
+    assert process.stdout is not None and process.stderr is not None
+    process.stdin.write(batch_script(commands, directory, marker).encode() + b"\0")
+    await process.stdin.drain()
+    process.stdin.close()
+    results = await read_statuses(
+        MarkedReader(process.stdout, marker),
+        MarkedReader(process.stderr, marker),
+        commands,
+        record,
+    )
+    await process.wait()
+    return all(results)
+
+
+class ShellWorker:
+    """A long running shell which runs batches of commands sent to it."""
+
+    def __init__(self, shell: str, directory: PathLike) -> None:
+        self.shell = shell
+        self.directory = directory
+        self.marker = secrets.token_hex(16).encode()
+        self.process: Optional[asyncio.subprocess.Process] = None
+        # The cpus the shell is pinned to, or None when it can use every cpu
+        self.cpus: Optional[List[int]] = None
+
+    async def start(self) -> None:
+        self.process = await asyncio.create_subprocess_exec(
+            self.shell,
+            "-c",
+            WORKER_SCRIPT,
+            cwd=str(self.directory),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        assert self.process.stdout is not None and self.process.stderr is not None
+        self.stdout = MarkedReader(self.process.stdout, self.marker)
+        self.stderr = MarkedReader(self.process.stderr, self.marker)
+
+    @property
+    def running(self) -> bool:
+        return (
+            self.process is not None
+            and self.process.returncode is None
+            and not self.stdout.finished
+        )
+
+    def set_affinity(self, allocation: Optional[Allocation]) -> None:
+        """Pin the shell to the allocated cpus.
+
+        The shell keeps its cpus between batches, so a batch without an allocation
+        returns the shell to all the cpus available to this process.
+
+        """
+        assert self.process is not None
+        cpus = allocation.cpus if allocation is not None and allocation.pin else None
+        if cpus == self.cpus:
+            return
+        os.sched_setaffinity(self.process.pid, cpus or available_cpus())
+        self.cpus = cpus
+
+    async def run(
+        self,
+        commands: List[Command],
+        allocation: Optional[Allocation] = None,
+        record: Optional[Recorder] = None,
+    ) -> List[bool]:
+        """Run a batch of commands in the shell.
+
+        Since the shell is already running, the allocated cpus are set on the shell
+        before the commands are sent, with the environment variables exported by the
+        script of each command.
+
+        Returns: Whether each of the commands succeeded.
+
+        """
+        assert self.process is not None and self.process.stdin is not None
+        self.set_affinity(allocation)
+        environment = None
+        if allocation is not None:
+            environment = allocation.environment()
+        script = batch_script(commands, self.directory, self.marker, environment)
+        self.process.stdin.write(script.encode() + b"\0")
+        await self.process.stdin.drain()
+        return await read_statuses(self.stdout, self.stderr, commands, record)
+
+    async def stop(self) -> None:
+        if self.running:
+            assert self.process is not None and self.process.stdin is not None
+            self.process.stdin.close()
+            await self.process.wait()
+
+
+class WorkerPool:
+    """A pool of long running shells to run commands.
+
+    Starting a new shell for every command has a cost which can be longer than
+    commands which take milliseconds to run. Instead, scripts are sent to a long
+    running shell through a pipe, with the output and exit status separated by a
+    marker written after each command.
+
+    """
+
+    def __init__(self, shell: str, directory: PathLike, size: int) -> None:
+        self.shell = shell
+        self.directory = directory
+        self.size = size
+        self.workers: List[ShellWorker] = []
+        self.idle: "asyncio.Queue[ShellWorker]" = asyncio.Queue()
+
+    async def start(self) -> None:
+        for _ in range(self.size):
+            await self._add_worker()
+
+    async def _add_worker(self) -> None:
+        worker = ShellWorker(self.shell, self.directory)
+        await worker.start()
+        self.workers.append(worker)
+        self.idle.put_nowait(worker)
+
+    async def run_batch(
+        self,
+        commands: List[Command],
+        allocation: Optional[Allocation] = None,
+        record: Optional[Recorder] = None,
+    ) -> bool:
+        """Run a batch of commands using the next available shell.
+
+        Returns: Whether all the commands succeeded.
+
+        """
+        for command in commands:
+            logger.info(command)
+        worker = await self.idle.get()
+        results = await worker.run(commands, allocation, record)
+        if not worker.running:
+            # The shell exited while running the commands, so replace it
+            logger.warning("Shell exited while running commands, restarting it")
+            self.workers.remove(worker)
+            await self._add_worker()
+        else:
+            self.idle.put_nowait(worker)
+        return all(results)
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+
+class BatchSize:
+    """The number of commands to run in each batch.
+
+    This is either a fixed number, or when created with ``"auto"``, chosen so that each
+    batch takes around ``target`` seconds to run, estimated from the duration of the
+    batches which have already completed.
+
+    """
+
+    def __init__(
+        self, size: Union[int, str] = 1, target: float = 1.0, maximum: int = 1000
+    ) -> None:
+        self.auto = size == "auto"
+        self.size = 1 if self.auto else int(size)
+        self.target = target
+        self.maximum = maximum
+        self.duration: Optional[float] = None
+
+    def record(self, count: int, elapsed: float) -> None:
+        """Update the batch size from the time taken to run count commands."""
+        if not self.auto:
+            return
+        duration = elapsed / count
+        if self.duration is None:
+            self.duration = duration
+        else:
+            # Exponential moving average, weighting recent batches more heavily
+            self.duration = 0.7 * self.duration + 0.3 * duration
+        self.size = max(1, min(self.maximum, int(self.target / self.duration)))
+
+
+async def run_graph_tasks(
+    shell: str,
+    graph: CommandGraph,
+    directory: PathLike,
+    max_workers: int,
+    persistent: bool,
+    batch_size: BatchSize,
+) -> bool:
+    """Run the tasks of a graph, starting each task once its dependencies are complete.
+
+    Each batch of tasks is from a single job, with the resources required by each job
+    allocated from a pool shared by all the jobs. Running one command at a time, the
+    commands are neither pinned nor have the number of threads set. The output of each command is
+    labelled with its variables, except when running a single command at a time in a
+    new shell, where the output is written directly to the terminal.
+
+    Returns: Whether all the commands succeeded.
+
+    """
+    resource_pool = ResourcePool(max_workers)
+    requirements: Dict[int, Tuple[Resources, bool]] = {}
+
+    def requirement(job: Job) -> Tuple[Resources, bool]:
+        """The resources allocated to the job, and whether they were requested."""
+        if id(job) not in requirements:
+            resources = None
+            # Running a single command at a time, it has the whole machine to itself
+            if max_workers > 1:
+                resources = Resources.from_options(job.scheduler_options)
+            requirements[id(job)] = (
+                resource_pool.fit(resources or Resources()),
+                resources is not None,
+            )
+        return requirements[id(job)]
+
+    labelled = max_workers > 1
+    workers = None
+    if persistent:
+        workers = WorkerPool(shell, directory, max_workers)
+        await workers.start()
+
+    async def run_tasks(tasks: List[Task]) -> Tuple[List[Task], List[bool]]:
+        job = tasks[0].job
+        # Only tasks with a command are ready to run
+        commands = [task.command for task in tasks if task.command is not None]
+        statuses: Dict[int, int] = {}
+
+        def record(command: Command, status: int) -> None:
+            statuses[id(command)] = status
+            job.record(command, status)
+
+        resources, requested = requirement(job)
+        allocation = await resource_pool.acquire(resources)
+        try:
+            start = time.perf_counter()
+            assigned = allocation if requested else None
+            if workers is not None:
+                await workers.run_batch(commands, assigned, record)
+            elif len(commands) > 1:
+                await run_batch(job.shell, commands, directory, assigned, record)
+            else:
+                await run_command(
+                    job.shell, commands[0], directory, assigned, record, labelled
+                )
+            batch_size.record(len(commands), time.perf_counter() - start)
+        finally:
+            await resource_pool.release(allocation)
+        # Commands which didn't report a status are considered to have failed
+        return tasks, [statuses.get(id(command)) == 0 for command in commands]
+
+    running: Set[asyncio.Future] = set()
+    try:
+        while True:
+            while graph.ready and len(running) < max_workers:
+                tasks = graph.take(batch_size.size)
+                running.add(asyncio.ensure_future(run_tasks(tasks)))
+            if not running:
+                break
+            done, running = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                for task, success in zip(*future.result()):
+                    graph.complete(task, success)
+    finally:
+        if workers is not None:
+            await workers.stop()
+    return graph.failed == 0
+
+
+def run_until_complete(coroutine: Awaitable) -> Any:
+    """Run a coroutine in a new event loop, equivalent to asyncio.run in python 3.7."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def run_graph(
+    shell: str,
+    graph: CommandGraph,
+    directory: PathLike,
+    max_workers: int,
+    persistent: bool = False,
+    batch_size: Union[int, str] = 1,
+) -> bool:
+    """Run the commands of all the jobs, with each command starting once the commands
+    it depends on have succeeded.
+
+    Args:
+        shell: The shell in which to run the commands
+        graph: The dependencies between the commands
+        directory: The directory in which to run the commands
+        max_workers: The maximum number of commands to run at the same time
+        persistent: Run the commands using a pool of long running shells, rather than
+            starting a new shell for each command.
+        batch_size: The number of commands to run one after the other in a single
+            shell, or "auto" to choose the number from the time taken by each command.
+
+    Returns: Whether all the commands succeeded.
+
+    """
+    return run_until_complete(
+        run_graph_tasks(
+            shell, graph, directory, max_workers, persistent, BatchSize(batch_size)
+        )
+    )
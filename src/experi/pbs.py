@@ -10,28 +10,179 @@
 
 This will generate a .pbs file with all the information required to run a single command
 from the list of commands. The variables will be generated and iterated over using the
-job array feature of pbs. """
+job array feature of pbs.
 
+With the ``manifest`` option the commands are written to a separate manifest file rather
+than the pbs file, along with an index of the offset of each command within the
+manifest. Each element of the array reads only its own command, so the pbs file is the
+same size however many commands there are.
+
+"""
+
+import io
 import logging
+import os
+import re
 from collections import OrderedDict
 from copy import deepcopy
-from typing import Any, Dict, List, Union
+from pathlib import Path
+from string import Formatter
+from typing import Any, Callable, Dict, List, Optional, TextIO, Union
 
 from .commands import Job
+from .journal import JOURNAL_FILE
+from .profiling import phase
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
 
 
+# The command is evaluated by the shell, in the same way as running the command locally
+# or from a manifest, so operators like && and redirections work.
 SCHEDULER_TEMPLATE = """
 cd "{workdir}"
 {setup}
 
 COMMAND={command_list}
 
-${{COMMAND[{array_index}]}}
+eval "${{COMMAND[{array_index}]}}"
+"""
+
+# With a journal, the exit status of the command is appended to the journal, which is
+# a single write so the elements of the array can write at the same time.
+SCHEDULER_JOURNAL_TEMPLATE = """
+cd "{workdir}"
+{setup}
+
+COMMAND={command_list}
+DIGEST={digest_list}
+
+eval "${{COMMAND[{array_index}]}}"
+status=$?
+mkdir -p "{journal_directory}"
+printf '%s %d\\n' "${{DIGEST[{array_index}]}}" "$status" >> "{journal}"
+exit $status
+"""
+
+
+# Each element of the array finds its command in the manifest using the offset in the
+# index, reading only the bytes it needs. The command is stored using ANSI-C quoting
+# so each command is a single line.
+SCHEDULER_MANIFEST_TEMPLATE = """
+cd "{workdir}"
+{setup}
+
+OFFSET=$(tail -c +$(({array_index} * {width} + 1)) "{index}" | head -c {digits})
+LINE=$(tail -c +$((10#$OFFSET + 1)) "{manifest}" | head -n 1)
+eval "COMMAND=$LINE"
+
+eval "$COMMAND"
+"""
+
+SCHEDULER_MANIFEST_JOURNAL_TEMPLATE = """
+cd "{workdir}"
+{setup}
+
+OFFSET=$(tail -c +$(({array_index} * {width} + 1)) "{index}" | head -c {digits})
+LINE=$(tail -c +$((10#$OFFSET + 1)) "{manifest}" | head -n 1)
+read -r DIGEST LINE <<< "$LINE"
+eval "COMMAND=$LINE"
+
+eval "$COMMAND"
+status=$?
+mkdir -p "{journal_directory}"
+printf '%s %d\\n' "$DIGEST" "$status" >> "{journal}"
+exit $status
+"""
+
+# With the chunk option each element of the array runs a number of consecutive
+# commands, using a function which runs the command at an index in a subshell, so a
+# command can't exit the element or change the environment of the next command. The
+# exit status of each command is kept, with the element failing when any fail.
+CHUNK_TEMPLATE = """
+cd "{workdir}"
+{setup}
+{data}
+run_command() (
+{run})
+
+run_chunk_command() {{
+    run_command "$1"
+    local status=$?
+    if [ $status -ne 0 ]; then
+        echo "Command $1 failed with exit status $status" >&2
+    fi
+    return $status
+}}
+
+START=$(({array_index} * {chunk}))
+STOP=$((START + {chunk} < {num_commands} ? START + {chunk} : {num_commands}))
+STATUS=0
+{driver}
+exit $STATUS
+"""
+
+CHUNK_SERIAL = """for ((INDEX = START; INDEX < STOP; INDEX++)); do
+    run_chunk_command $INDEX || STATUS=$?
+done"""
+
+# Up to the given number of commands run at the same time, starting another command
+# each time one of them finishes.
+CHUNK_PARALLEL = """RUNNING=0
+for ((INDEX = START; INDEX < STOP; INDEX++)); do
+    if [ $RUNNING -ge {workers} ]; then
+        wait -n || STATUS=$?
+        RUNNING=$((RUNNING - 1))
+    fi
+    run_chunk_command $INDEX &
+    RUNNING=$((RUNNING + 1))
+done
+while [ $RUNNING -gt 0 ]; do
+    wait -n || STATUS=$?
+    RUNNING=$((RUNNING - 1))
+done"""
+
+CHUNK_RUN = """    eval "${{COMMAND[$1]}}"
+"""
+
+CHUNK_MANIFEST_RUN = """\
+    offset=$(tail -c +$(($1 * {width} + 1)) "{index}" | head -c {digits})
+    line=$(tail -c +$((10#$offset + 1)) "{manifest}" | head -n 1)
+    eval "line=$line"
+    eval "$line"
+"""
+
+CHUNK_JOURNAL_RUN = """    ( eval "${{COMMAND[$1]}}" )
+    status=$?
+    mkdir -p "{journal_directory}"
+    printf '%s %d\\n' "${{DIGEST[$1]}}" "$status" >> "{journal}"
+    exit $status
+"""
+
+CHUNK_MANIFEST_JOURNAL_RUN = """\
+    offset=$(tail -c +$(($1 * {width} + 1)) "{index}" | head -c {digits})
+    line=$(tail -c +$((10#$offset + 1)) "{manifest}" | head -n 1)
+    read -r digest line <<< "$line"
+    eval "line=$line"
+    ( eval "$line" )
+    status=$?
+    mkdir -p "{journal_directory}"
+    printf '%s %d\\n' "$digest" "$status" >> "{journal}"
+    exit $status
 """
 
+# The number of digits of each offset in the index of a manifest, which with the
+# newline gives the fixed width of each entry.
+INDEX_DIGITS = 15
+INDEX_WIDTH = INDEX_DIGITS + 1
+
+# The buffer used when writing the manifest
+MANIFEST_BUFFER_SIZE = 2 ** 20
+
+# Characters which need escaping within ANSI-C quoting
+ANSI_C_ESCAPES = {"\\": "\\\\", "'": "\\'", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+ANSI_C_SPECIAL = re.compile(r"[\\'\x00-\x1f\x7f]")
+
 
 class SchedulerOptions:
     prefix: str = "#SHELL"
@@ -264,8 +415,260 @@ def get_array_string(scheduler: str, num_commands: int) -> str:
     return header_string
 
 
-def create_scheduler_file(scheduler: str, job: Job) -> str:
-    """Substitute values into a template scheduler file."""
+def split_job(job: Job) -> List[Job]:
+    """Split a job into jobs which are within the maximum size of an array.
+
+    The ``max_array_size`` option is the largest number of elements of an array job
+    accepted by the scheduler, with each element running ``chunk`` commands. A job
+    with more commands is split into jobs of the largest size, which are submitted as
+    separate arrays.
+
+    """
+    options = job.scheduler_options or {}
+    max_array_size = options.get("max_array_size")
+    if not max_array_size:
+        return [job]
+    size = int(max_array_size) * int(options.get("chunk", 1))
+    if size < 1:
+        raise ValueError(f"The max_array_size must be at least 1, got {max_array_size}")
+    if len(job) <= size:
+        return [job]
+    return job.split(size)
+
+
+def array_shape(job: Job) -> tuple:
+    """The options which determine the elements of the arrays a job is submitted as."""
+    options = job.scheduler_options or {}
+    return int(options.get("chunk", 1)), options.get("max_array_size")
+
+
+def elementwise_dependency(previous: Job, job: Job) -> bool:
+    """Whether each element of a job only requires the same element of the previous job.
+
+    This is the case when both jobs are submitted as arrays of the same shape, and the
+    file required by each command is the file created by the command of the previous
+    job at the same index. Each element can then start once the same element of the
+    previous job has finished, rather than waiting for the whole previous job.
+
+    """
+    if len(previous) != len(job) or array_shape(previous) != array_shape(job):
+        return False
+    for source, command in zip(previous, job):
+        if not command.requires or not source.creates:
+            return False
+        if os.path.normpath(command.requires) != os.path.normpath(source.creates):
+            return False
+    return True
+
+
+def write_digest_array(job: Job, stream: TextIO) -> None:
+    """Write a bash array of the digest of each command in the job."""
+    stream.write("( \\\n")
+    for command in job:
+        stream.write(f"{command.digest()} \\\n")
+    stream.write(")")
+
+
+def ansi_c_quote(string: str) -> str:
+    """Quote a string for bash using ANSI-C quoting, which has no newlines."""
+
+    def escape(match):
+        char = match.group(0)
+        return ANSI_C_ESCAPES.get(char, f"\\x{ord(char):02x}")
+
+    return "$'" + ANSI_C_SPECIAL.sub(escape, string) + "'"
+
+
+def manifest_index(manifest: Path) -> Path:
+    """The path of the index of the offsets of each command in a manifest."""
+    return manifest.with_name(manifest.name + ".index")
+
+
+def write_manifest(job: Job, manifest: Path) -> None:
+    """Write the commands of a job to a manifest, along with the index of offsets.
+
+    Each command is a line of the manifest, and the offset of each line is written to
+    the index with a fixed width, so the offset of any command is read from a known
+    position in the index. When the job has a journal, each line starts with the
+    digest of the command.
+
+    """
+    offset = 0
+    index_path = manifest_index(manifest)
+    with manifest.open("wb", buffering=MANIFEST_BUFFER_SIZE) as dst, index_path.open(
+        "wb", buffering=MANIFEST_BUFFER_SIZE
+    ) as index:
+        for command in job:
+            line = ansi_c_quote(str(command))
+            if job.journal is not None:
+                line = f"{command.digest()} {line}"
+            data = f"{line}\n".encode()
+            index.write(f"{offset:0{INDEX_DIGITS}d}\n".encode())
+            dst.write(data)
+            offset += len(data)
+    logger.debug("Created manifest %s", manifest)
+
+
+def parse_walltime(value: Union[str, int], scheduler: str) -> int:
+    """The number of seconds in a walltime.
+
+    The walltime has the form ``hours:minutes:seconds``, with the hours and minutes
+    optional, or the slurm form ``days-hours:minutes:seconds``. A number of its own is
+    the seconds for pbs, and the minutes for slurm.
+
+    """
+    text = str(value).strip()
+    try:
+        days = 0
+        if "-" in text:
+            day_text, text = text.split("-", 1)
+            days = int(day_text)
+            fields = [int(field) for field in text.split(":")]
+            # The fields after the days start with the hours
+            fields = fields + [0] * (3 - len(fields))
+        else:
+            fields = [int(field) for field in text.split(":")]
+            if len(fields) == 1 and scheduler.upper() == "SLURM":
+                fields = [fields[0], 0]
+            fields = [0] * (3 - len(fields)) + fields
+    except ValueError:
+        raise ValueError(f"Unable to parse the walltime '{value}'")
+    if len(fields) != 3:
+        raise ValueError(f"Unable to parse the walltime '{value}'")
+    hours, minutes, seconds = fields
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def format_walltime(seconds: int) -> str:
+    """Format a number of seconds as hours:minutes:seconds."""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def scale_times(
+    scheduler: str, scheduler_options: Dict[str, Any], commands: int, rounds: int
+) -> None:
+    """Scale the times requested for a command to those of a chunk of commands.
+
+    The walltime is multiplied by the number of rounds of commands run one after the
+    other, while the cputime is multiplied by the number of commands.
+
+    """
+    times = SchedulerOptions(**scheduler_options).time
+    for key, value in times.items():
+        factor = rounds if key == "walltime" else commands
+        scheduler_options[key] = format_walltime(
+            parse_walltime(value, scheduler) * factor
+        )
+
+
+def write_template(
+    stream: TextIO,
+    template: str,
+    writers: Dict[str, Callable[[TextIO], None]],
+    **kwargs: Any,
+) -> None:
+    """Substitute values into a template, writing the result to a stream.
+
+    This is equivalent to writing ``template.format(**kwargs)``, except the fields in
+    writers are written by calling the function with the stream, so large values are
+    never held in memory.
+
+    """
+    formatter = Formatter()
+    for literal, field, spec, conversion in formatter.parse(template):
+        stream.write(literal)
+        if field is None:
+            continue
+        if field in writers:
+            writers[field](stream)
+        else:
+            value = formatter.convert_field(kwargs[field], conversion)
+            stream.write(formatter.format_field(value, spec or ""))
+
+
+def write_chunk_template(
+    stream: TextIO, job: Job, manifest: Optional[Path], workers: int, **kwargs: Any
+) -> None:
+    """Write the body of a scheduler file running a chunk of commands in each element.
+
+    Args:
+        stream: Where the scheduler file is written
+        job: The job to run
+        manifest: The path of the manifest of commands, or None to write the commands
+            to the scheduler file.
+        workers: The number of commands of a chunk to run at the same time
+        kwargs: The values of the fields of :data:`CHUNK_TEMPLATE`
+
+    """
+    values = dict(kwargs, journal_directory=JOURNAL_FILE.parent, journal=JOURNAL_FILE)
+
+    def write_data(stream: TextIO) -> None:
+        if manifest is not None:
+            return
+        stream.write("\nCOMMAND=")
+        job.write_bash_array(stream)
+        stream.write("\n")
+        if job.journal is not None:
+            stream.write("DIGEST=")
+            write_digest_array(job, stream)
+            stream.write("\n")
+
+    if manifest is not None:
+        write_manifest(job, manifest)
+        values.update(
+            width=INDEX_WIDTH,
+            digits=INDEX_DIGITS,
+            index=manifest_index(manifest).name,
+            manifest=manifest.name,
+        )
+        if job.journal is not None:
+            run = CHUNK_MANIFEST_JOURNAL_RUN
+        else:
+            run = CHUNK_MANIFEST_RUN
+    elif job.journal is not None:
+        run = CHUNK_JOURNAL_RUN
+    else:
+        run = CHUNK_RUN
+
+    if workers > 1:
+        driver = CHUNK_PARALLEL.format(workers=workers)
+    else:
+        driver = CHUNK_SERIAL
+
+    def write_run(stream: TextIO) -> None:
+        stream.write(run.format(**values))
+
+    def write_driver(stream: TextIO) -> None:
+        stream.write(driver)
+
+    write_template(
+        stream,
+        CHUNK_TEMPLATE,
+        {"data": write_data, "run": write_run, "driver": write_driver},
+        **values,
+    )
+
+
+def write_scheduler_file(
+    scheduler: str, job: Job, stream: TextIO, manifest: Optional[Path] = None
+) -> None:
+    """Substitute values into a template scheduler file, writing it to a stream.
+
+    The commands are written to the stream as they are created, so with a buffered
+    file the memory used and the time taken are proportional to the number of
+    commands.
+
+    Args:
+        scheduler: The scheduler to create the file for, one of pbs or slurm
+        job: The job to run
+        stream: Where the scheduler file is written
+        manifest: The path of the manifest the commands are written to when the
+            ``manifest`` option of the job is set. The scheduler file refers to the
+            manifest by name, so it is in the directory the job is submitted from.
+
+    """
     logger.debug("Create Scheduler File Function")
 
     if job.scheduler_options is None:
@@ -277,9 +680,29 @@ def create_scheduler_file(scheduler: str, job: Job) -> str:
         del scheduler_options["setup"]
     except KeyError:
         setup_string = ""
+    use_manifest = bool(scheduler_options.pop("manifest", False))
+    if use_manifest and manifest is None:
+        raise ValueError("The manifest option requires the path of the manifest.")
+    chunk = int(scheduler_options.pop("chunk", 1))
+    if chunk < 1:
+        raise ValueError(f"The chunk option must be at least 1, got {chunk}")
+    chunk_parallel = bool(scheduler_options.pop("chunk_parallel", False))
+    # The job is split by split_job before writing the file
+    scheduler_options.pop("max_array_size", None)
+
+    num_commands = len(job)
+    num_elements = num_commands
+    workers = 1
+    if chunk > 1:
+        num_elements = -(-num_commands // chunk)
+        if chunk_parallel:
+            workers = int(SchedulerOptions(**scheduler_options).resources["ncpus"])
+        commands = min(chunk, num_commands)
+        scale_times(scheduler, scheduler_options, commands, -(-commands // workers))
+
     # Create header
-    header_string = create_header_string(scheduler, **scheduler_options)
-    header_string += get_array_string(scheduler, len(job))
+    stream.write(create_header_string(scheduler, **scheduler_options))
+    stream.write(get_array_string(scheduler, num_elements))
 
     if scheduler.upper() == "SLURM":
         workdir = r"$SLURM_SUBMIT_DIR"
@@ -288,9 +711,73 @@ def create_scheduler_file(scheduler: str, job: Job) -> str:
         workdir = r"$PBS_O_WORKDIR"
         array_index = r"$PBS_ARRAY_INDEX"
 
-    return header_string + SCHEDULER_TEMPLATE.format(
+    if chunk > 1:
+        write_chunk_template(
+            stream,
+            job,
+            manifest if use_manifest else None,
+            workdir=workdir,
+            setup=setup_string,
+            array_index=array_index,
+            chunk=chunk,
+            num_commands=num_commands,
+            workers=workers,
+        )
+        return
+
+    if use_manifest:
+        assert manifest is not None
+        write_manifest(job, manifest)
+        if job.journal is not None:
+            template = SCHEDULER_MANIFEST_JOURNAL_TEMPLATE
+        else:
+            template = SCHEDULER_MANIFEST_TEMPLATE
+        stream.write(
+            template.format(
+                workdir=workdir,
+                setup=setup_string,
+                array_index=array_index,
+                width=INDEX_WIDTH,
+                digits=INDEX_DIGITS,
+                index=manifest_index(manifest).name,
+                manifest=manifest.name,
+                journal_directory=JOURNAL_FILE.parent,
+                journal=JOURNAL_FILE,
+            )
+        )
+        return
+
+    if job.journal is not None:
+        write_template(
+            stream,
+            SCHEDULER_JOURNAL_TEMPLATE,
+            {
+                "command_list": job.write_bash_array,
+                "digest_list": lambda stream: write_digest_array(job, stream),
+            },
+            workdir=workdir,
+            setup=setup_string,
+            array_index=array_index,
+            journal_directory=JOURNAL_FILE.parent,
+            journal=JOURNAL_FILE,
+        )
+        return
+
+    write_template(
+        stream,
+        SCHEDULER_TEMPLATE,
+        {"command_list": job.write_bash_array},
         workdir=workdir,
-        command_list=job.as_bash_array(),
         setup=setup_string,
         array_index=array_index,
     )
+
+
+def create_scheduler_file(
+    scheduler: str, job: Job, manifest: Optional[Path] = None
+) -> str:
+    """Substitute values into a template scheduler file."""
+    stream = io.StringIO()
+    with phase("script"):
+        write_scheduler_file(scheduler, job, stream, manifest)
+    return stream.getvalue()
@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Measure the time and memory taken by each phase of running an experiment.
+
+The commands of an experiment are generated as they are required, so the phases, like
+expanding the variables and writing the scheduler files, are interleaved. Each phase
+is marked using :func:`phase`, with the time spent in a phase excluding the time spent
+in the phases within it, so the time is only counted once.
+
+Profiling is disabled unless :meth:`Profiler.start` is called on the :data:`PROFILER`,
+in which case marking a phase costs almost nothing.
+
+"""
+
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# The order of the phases in the report, with any other phases following
+PHASES = ["read", "expand", "render", "filter", "script", "run"]
+
+PHASE_DESCRIPTIONS = {
+    "read": "Reading the input file",
+    "expand": "Expanding the variables",
+    "render": "Rendering and removing duplicate commands",
+    "filter": "Finding the commands which need to run",
+    "script": "Writing scheduler files",
+    "run": "Submitting or running commands",
+}
+
+
+class Profiler:
+    """The time and peak memory of each phase.
+
+    Args:
+        trace_memory: Measure the peak memory of each phase using :mod:`tracemalloc`,
+            which makes running slower.
+
+    """
+
+    def __init__(self, trace_memory: bool = True) -> None:
+        self.enabled = False
+        self.trace_memory = trace_memory
+        self.times: Dict[str, float] = OrderedDict()
+        self.peak_memory: Dict[str, int] = OrderedDict()
+        self._stack: List[List] = []
+        # tracemalloc is imported when profiling starts, keeping the start up fast
+        self._tracemalloc: Any = None
+        self._start = 0.0
+        self._total = 0.0
+
+    def start(self) -> None:
+        self.enabled = True
+        self.times.clear()
+        self.peak_memory.clear()
+        if self.trace_memory:
+            import tracemalloc
+
+            self._tracemalloc = tracemalloc
+            tracemalloc.start()
+        self._start = time.perf_counter()
+
+    def stop(self) -> None:
+        self._total = time.perf_counter() - self._start
+        if self._tracemalloc is not None:
+            self._tracemalloc.stop()
+            self._tracemalloc = None
+        self.enabled = False
+
+    def _switch(self, now: float) -> None:
+        """Attribute the time and memory since the last switch to the current phase."""
+        if not self._stack:
+            return
+        current = self._stack[-1]
+        name = current[0]
+        self.times[name] = self.times.get(name, 0.0) + now - current[1]
+        current[1] = now
+        tracemalloc = self._tracemalloc
+        if tracemalloc is not None:
+            _, peak = tracemalloc.get_traced_memory()
+            self.peak_memory[name] = max(self.peak_memory.get(name, 0), peak)
+            # Before python 3.9 the peak is the largest since profiling started
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Mark the code within the context as part of a phase."""
+        if not self.enabled:
+            yield
+            return
+        self._switch(time.perf_counter())
+        self._stack.append([name, time.perf_counter()])
+        try:
+            yield
+        finally:
+            self._switch(time.perf_counter())
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] = time.perf_counter()
+
+    def report(self) -> str:
+        """A table of the time and peak memory of each phase."""
+        names = [name for name in PHASES if name in self.times]
+        names += [name for name in self.times if name not in PHASES]
+        lines = [f"{'Phase':<45} {'Time (s)':>10} {'Peak memory (MiB)':>18}"]
+        for name in names:
+            description = PHASE_DESCRIPTIONS.get(name, name)
+            memory = ""
+            if name in self.peak_memory:
+                memory = f"{self.peak_memory[name] / 2 ** 20:.1f}"
+            lines.append(f"{description:<45} {self.times[name]:>10.3f} {memory:>18}")
+        lines.append(f"{'Total':<45} {self._total:>10.3f}")
+        return "\n".join(lines)
+
+
+PROFILER = Profiler()
+
+
+def phase(name: str):
+    """Mark the code within the context as part of a phase of the global profiler."""
+    return PROFILER.phase(name)
+
+
+@contextmanager
+def profiled(enabled: bool = True, output: Optional[str] = None) -> Iterator[None]:
+    """Report the time and peak memory of each phase within the context.
+
+    The report is written to stderr once the context exits, even when an exception is
+    raised.
+
+    Args:
+        enabled: Whether to profile the phases, doing nothing otherwise.
+        output: A file to write the statistics of :mod:`cProfile` to, which can be
+            read using :mod:`pstats`.
+
+    """
+    if not enabled:
+        yield
+        return
+    profile = None
+    if output is not None:
+        import cProfile
+
+        profile = cProfile.Profile()
+    PROFILER.start()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            assert output is not None
+            profile.disable()
+            profile.dump_stats(output)
+        PROFILER.stop()
+        print(PROFILER.report(), file=sys.stderr)
@@ -13,17 +13,29 @@ import os
 import shutil
 import subprocess
 import sys
-from collections import ChainMap
-from itertools import chain, product, repeat
+from itertools import chain, repeat
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, Iterator, List, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import click
-import numpy as np
-import yaml
 
-from .commands import Command, Job
-from .pbs import create_scheduler_file
+from .cache import ExpansionCache
+from .commands import Command, CommandStore, CommandTemplate, Job
+from .dependencies import DigestStore
+from .journal import Journal
+from .profiling import phase, profiled
+from .space import VariableSpace, arange_values
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
@@ -33,17 +45,62 @@ PathLike = Union[str, Path]
 YamlValue = Union[str, int, float]
 CommandInput = Union[str, Dict[str, YamlValue]]
 VarType = Union[YamlValue, List[YamlValue], Dict[str, YamlValue]]
-VarMatrix = List[Dict[str, YamlValue]]
+VarMatrix = Iterable[Dict[str, YamlValue]]
+
+# The buffer used when writing scheduler files, which can contain millions of commands
+WRITE_BUFFER_SIZE = 2 ** 20
+
+
+class LazyMatrix:
+    """A variable matrix which is only generated when it is iterated over.
+
+    Rather than storing all the combinations of variables, this stores the function
+    and the arguments which create them, calling the function each time the matrix
+    is iterated over. This allows the same matrix to be iterated over many times, as
+    is required for the product of multiple matrices, without holding the values in
+    memory.
+
+    """
+
+    def __init__(self, function: Callable[..., VarMatrix], *args) -> None:
+        self.function = function
+        self.args = args
+
+    def __iter__(self) -> Iterator[Dict[str, YamlValue]]:
+        return iter(self.function(*self.args))
+
 
+def lazy_product(*iterables: Iterable) -> Iterator[tuple]:
+    """Cartesian product of iterables which doesn't store the input values.
 
-def combine_dictionaries(dicts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    This produces the same sequence as :func:`itertools.product`, however rather than
+    converting each of the input iterables to a tuple, each iterable is iterated over
+    again for every combination of the preceding iterables. As a result the inputs
+    must support repeated iteration, like a list or a :class:`LazyMatrix`.
+
+    """
+    if not iterables:
+        yield ()
+        return
+
+    first, rest = iterables[0], iterables[1:]
+    for item in first:
+        for items in lazy_product(*rest):
+            yield (item,) + items
+
+
+def combine_dictionaries(dicts: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
     """Merge a list of dictionaries into a single dictionary.
 
-    Where there are collisions the first value in the list will be set
-    as this function is using ChainMap to combine the dicts.
+    Where there are collisions the first value in the list will be set, with the
+    dictionaries being updated in reverse order, which is the same result as using
+    a ChainMap, without creating the ChainMap for each combination.
 
     """
-    return dict(ChainMap(*dicts))
+    result: Dict[str, Any] = {}
+    for item in reversed(dicts):
+        result.update(item)
+    return result
 
 
 def iterator_zip(variables: VarType, parent: str = None) -> Iterable[VarMatrix]:
@@ -61,9 +118,9 @@ def iterator_zip(variables: VarType, parent: str = None) -> Iterable[VarMatrix]:
     logger.debug("Yielding from zip iterator")
     if isinstance(variables, list):
         for item in variables:
-            yield list(variable_matrix(item, parent, "zip"))
+            yield LazyMatrix(variable_matrix, item, parent, "zip")
     else:
-        yield list(variable_matrix(variables, parent, "zip"))
+        yield LazyMatrix(variable_matrix, variables, parent, "zip")
 
 
 def iterator_product(variables: VarType, parent: str = None) -> Iterable[VarMatrix]:
@@ -84,7 +141,7 @@ def iterator_product(variables: VarType, parent: str = None) -> Iterable[VarMatr
             f"Product only takes mappings of values, got {variables} of type {type(variables)}"
         )
 
-    yield list(variable_matrix(variables, parent, "product"))
+    yield LazyMatrix(variable_matrix, variables, parent, "product")
 
 
 def iterator_chain(variables: VarType, parent: str = None) -> Iterable[VarMatrix]:
@@ -106,18 +163,15 @@ def iterator_chain(variables: VarType, parent: str = None) -> Iterable[VarMatrix
             f"Append keyword only takes a list of arguments, got {variables} of type {type(variables)}"
         )
 
-    # Create a single list containing all the values
-    yield list(
-        chain.from_iterable(
-            variable_matrix(item, parent, "product") for item in variables
-        )
-    )
+    # Create a single matrix containing all the values
+    yield LazyMatrix(chain_matrix, variables, parent)
 
 
-def arange(start=None, stop=None, step=None, dtype=None) -> np.ndarray:
-    if stop and not start:
-        return np.arange(stop)
-    return np.arange(start=start, stop=stop, step=step, dtype=dtype)
+def chain_matrix(variables: List[VarType], parent: str = None) -> VarMatrix:
+    """Generate the values of each element of a list one after the other."""
+    return chain.from_iterable(
+        variable_matrix(item, parent, "product") for item in variables
+    )
 
 
 def iterator_arange(variables: VarType, parent: str) -> Iterable[VarMatrix]:
@@ -131,19 +185,7 @@ def iterator_arange(variables: VarType, parent: str) -> Iterable[VarMatrix]:
 
     """
     assert parent is not None
-    if isinstance(variables, (int, float)):
-        yield [{parent: i} for i in np.arange(variables)]
-
-    elif isinstance(variables, dict):
-        if variables.get("stop"):
-            yield [{parent: i} for i in arange(**variables)]
-        else:
-            raise ValueError(f"Stop is a required keyword for the arange iterator.")
-
-    else:
-        raise ValueError(
-            f"The arange keyword only takes a dict as arguments, got {variables} of type {type(variables)}"
-        )
+    yield [{parent: i} for i in arange_values(variables)]
 
 
 def iterator_cycle(variables: VarType, parent: str) -> Iterable[VarMatrix]:
@@ -153,15 +195,16 @@ def iterator_cycle(variables: VarType, parent: str) -> Iterable[VarMatrix]:
         variables: The input variables for the creation of the range
         parent: The variable for which the values are being generated.
 
-    Returns: A list of dictionaries mapping the parent to each value.
+    Returns: A matrix repeating the values the specified number of times.
 
     """
     if isinstance(variables, dict):
         if variables.get("times"):
             times = int(variables["times"])
-            del variables["times"]
+            # Copy rather than delete the key so the input can be processed again
+            values = {key: value for key, value in variables.items() if key != "times"}
 
-            yield list(variable_matrix(variables, parent, "product")) * times
+            yield LazyMatrix(cycle_matrix, values, parent, times)
 
         else:
             raise ValueError(f"times is a required keyword for the repeat iterator.")
@@ -171,16 +214,25 @@ def iterator_cycle(variables: VarType, parent: str) -> Iterable[VarMatrix]:
         )
 
 
+def cycle_matrix(variables: VarType, parent: str, times: int) -> VarMatrix:
+    """Generate the values of the variables repeated a number of times."""
+    return chain.from_iterable(
+        repeat(LazyMatrix(variable_matrix, variables, parent, "product"), times)
+    )
+
+
 def variable_matrix(
     variables: VarType, parent: str = None, iterator: str = "product"
 ) -> Iterable[Dict[str, YamlValue]]:
     """Process the variables into a list of the appropriate combinations.
 
     This function performs recursive processing of the input variables, creating an
-    iterator which has all the combinations of variables specified in the input.
+    iterator which has all the combinations of variables specified in the input. The
+    combinations are generated as they are required, so the memory use is independent
+    of the total number of combinations.
 
     """
-    _iters: Dict[str, Callable] = {"product": product, "zip": zip}
+    _iters: Dict[str, Callable] = {"product": lazy_product, "zip": zip}
     _special_keys: Dict[str, Callable[[VarType, Any], Iterable[VarMatrix]]] = {
         "zip": iterator_zip,
         "product": iterator_product,
@@ -192,7 +244,7 @@ def variable_matrix(
     }
 
     if isinstance(variables, dict):
-        key_vars: List[List[Dict[str, YamlValue]]] = []
+        key_vars: List[VarMatrix] = []
 
         # Handling of specialised iterators
         for key, function in _special_keys.items():
@@ -202,16 +254,24 @@ def variable_matrix(
                 for val in function(item, parent):
                     key_vars.append(val)
 
-                del variables[key]
-
         for key, value in variables.items():
-            key_vars.append(list(variable_matrix(value, key, iterator)))
+            if key in _special_keys and variables.get(key):
+                # Already handled as a specialised iterator
+                continue
+            if isinstance(value, dict) or (
+                isinstance(value, list)
+                and any(isinstance(item, (list, dict)) for item in value)
+            ):
+                # Nested variables are generated each time they are required
+                key_vars.append(LazyMatrix(variable_matrix, value, key, iterator))
+            else:
+                # A list of values is no larger than the input so it can be stored
+                key_vars.append(list(variable_matrix(value, key, iterator)))
 
         logger.debug("key vars: %s", key_vars)
 
         # Iterate through all possible products generating a dictionary
         for i in _iters[iterator](*key_vars):
-            logger.debug("dicts: %s", i)
             yield combine_dictionaries(i)
 
     # Iterate through a list of values
@@ -226,7 +286,7 @@ def variable_matrix(
         yield {parent: variables}
 
 
-def uniqueify(my_list: Any) -> List[Any]:
+def uniqueify(my_list: Iterable[Any]) -> List[Any]:
     """Remove duplicate entries in a list retaining order."""
     if sys.version_info >= (3, 6):
         # An implementation specific detail of py3.6 is the retention of order
@@ -244,6 +304,8 @@ def process_jobs(
     scheduler_options: Dict[str, Any] = None,
     directory: Path = None,
     use_dependencies: bool = False,
+    journal: Optional[Journal] = None,
+    digests: Optional[DigestStore] = None,
 ) -> Iterator[Job]:
     assert jobs is not None
 
@@ -257,58 +319,134 @@ def process_jobs(
             scheduler_options,
             directory,
             use_dependencies,
+            journal,
+            digests,
         )
 
 
-def process_command(command: CommandInput, matrix: VarMatrix) -> List[Command]:
+def process_command(command: CommandInput, matrix: VarMatrix) -> CommandStore:
     """Generate all combinations of commands given a variable matrix.
 
-    Processes the commands to be sequences of strings.
+    Processes the commands to be sequences of strings. The matrix is only iterated
+    over once, so this can be an iterator generating the combinations.
 
     """
+    # The template is parsed once and shared between all the commands, with only the
+    # variables of the unique commands being stored.
+    with phase("expand"):
+        return CommandStore.from_matrix(process_template(command), matrix)
+
+
+def process_template(command: CommandInput) -> CommandTemplate:
+    """Create the template of a command from the input file."""
     assert command is not None
-    if isinstance(command, str):
-        command_list = [Command(command, variables=variables) for variables in matrix]
-    elif isinstance(command, list):
-        command_list = [Command(command, variables=variables) for variables in matrix]
+    if isinstance(command, (str, list)):
+        return CommandTemplate(command)
+
+    if command.get("command") is not None:
+        cmd = command.get("command")
     else:
-        if command.get("command") is not None:
-            cmd = command.get("command")
-        else:
-            cmd = command.get("cmd")
-        creates = str(command.get("creates", ""))
-        requires = str(command.get("requires", ""))
+        cmd = command.get("cmd")
+    creates = str(command.get("creates", ""))
+    requires = str(command.get("requires", ""))
 
-        assert isinstance(cmd, (list, str))
-        command_list = [
-            Command(cmd, variables, creates, requires) for variables in matrix
-        ]
-    return uniqueify(command_list)
+    assert isinstance(cmd, (list, str))
+    return CommandTemplate(cmd, creates, requires)
 
 
 def read_file(filename: PathLike = "experiment.yml") -> Dict[str, Any]:
-    """Read and parse yaml file."""
+    """Read and parse yaml file.
+
+    This uses the LibYAML parser when it is available, which is much faster than the
+    pure python parser for large files.
+
+    """
+    # Importing yaml is a noticeable part of the start up time, so it is only imported
+    # when a file is read.
+    import yaml
+
     logger.debug("Input file: %s", filename)
 
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open(filename, "r") as stream:
-        structure = yaml.safe_load(stream)
+        structure = yaml.load(stream, Loader=loader)
     return structure
 
 
+def get_jobs(structure: Dict[str, Any]) -> List[Dict]:
+    """The jobs of an experiment, where each job is a dictionary with a command."""
+    jobs_dict = structure.get("jobs")
+    if jobs_dict is None:
+        input_command = structure.get("command")
+        if isinstance(input_command, list):
+            jobs_dict = [{"command": cmd} for cmd in input_command]
+        else:
+            jobs_dict = [{"command": input_command}]
+    return jobs_dict
+
+
+def resolve_command(
+    structure: Dict[str, Any], index: int, job_index: int = 0
+) -> Command:
+    """The command of a job for a single combination of the variables.
+
+    The combination is found from the structure of the variables using a
+    :class:`experi.space.VariableSpace`, so the time taken is independent of the number
+    of combinations. Unlike :func:`process_structure`, duplicate commands are not
+    removed, so the index is that of the combination of the variables.
+
+    Args:
+        structure: The contents of the input file
+        index: The index of the combination of the variables
+        job_index: The index of the job within the experiment
+
+    """
+    input_variables = structure.get("variables")
+    if input_variables is None:
+        raise KeyError('The key "variables" was not found in the input file.')
+
+    jobs = get_jobs(structure)
+    if not 0 <= job_index < len(jobs):
+        raise IndexError(
+            f"Job {job_index} doesn't exist, the experiment has {len(jobs)} jobs."
+        )
+    command = jobs[job_index].get("command")
+    assert command is not None
+    template = process_template(command)
+    return Command.from_template(template, VariableSpace(input_variables)[index])
+
+
 def process_structure(
     structure: Dict[str, Any],
     scheduler: str = "shell",
     directory: Path = None,
     use_dependencies: bool = False,
+    journal: Optional[Journal] = None,
+    digests: Optional[DigestStore] = None,
+    cache: Optional[ExpansionCache] = None,
 ) -> Iterator[Job]:
+    """Create the jobs of an experiment from the contents of the input file.
+
+    Args:
+        structure: The contents of the input file
+        scheduler: The scheduler the jobs are run with
+        directory: The directory of the experiment
+        use_dependencies: Skip the commands where the file they create is up to date
+        journal: The record of the commands which have completed
+        digests: The digests of the files required by each command
+        cache: Load the commands of each job from the cache, which is much faster for
+            large experiments than generating them. When the commands are not in the
+            cache, the commands of every job are generated and stored.
+
+    """
     input_variables = structure.get("variables")
     if input_variables is None:
         raise KeyError('The key "variables" was not found in the input file.')
     assert isinstance(input_variables, Dict)
 
-    # create variable matrix
-    variables = list(variable_matrix(input_variables))
-    assert variables
+    # create variable matrix, which is generated separately for each job
+    variables = LazyMatrix(variable_matrix, input_variables)
+    assert next(iter(variables), None) is not None
 
     scheduler_options = None
 
@@ -322,17 +460,36 @@ def process_structure(
             # set the name attribute in pbs to global name if no name defined in pbs
             scheduler_options.setdefault("name", structure.get("name"))
 
-    jobs_dict = structure.get("jobs")
-    if jobs_dict is None:
-        input_command = structure.get("command")
-        if isinstance(input_command, list):
-            jobs_dict = [{"command": cmd} for cmd in input_command]
-        else:
-            jobs_dict = [{"command": input_command}]
+    # When running locally, the resources requested from a scheduler are used to share
+    # the machine between commands, with any options of the shell taking precedence.
+    if scheduler == "shell":
+        for other in ["pbs", "slurm"]:
+            if isinstance(structure.get(other), dict):
+                scheduler_options = {**structure[other], **(scheduler_options or {})}
+                break
 
-    yield from process_jobs(
-        jobs_dict, variables, scheduler_options, directory, use_dependencies
-    )
+    jobs_dict = get_jobs(structure)
+    if cache is None:
+        yield from process_jobs(
+            jobs_dict,
+            variables,
+            scheduler_options,
+            directory,
+            use_dependencies,
+            journal,
+            digests,
+        )
+        return
+
+    with phase("expand"):
+        command_stores = cache.get(
+            structure,
+            lambda: [process_command(job["command"], variables) for job in jobs_dict],
+        )
+    for commands in command_stores:
+        yield Job(
+            commands, scheduler_options, directory, use_dependencies, journal, digests
+        )
 
 
 def run_jobs(
@@ -340,9 +497,19 @@ def run_jobs(
     scheduler: str = "shell",
     directory=Path.cwd(),
     dry_run: bool = False,
+    max_workers: int = 1,
+    persistent: bool = False,
+    batch_size: Union[int, str] = 1,
 ) -> None:
     if scheduler == "shell":
-        run_bash_jobs(jobs, directory, dry_run=dry_run)
+        run_bash_jobs(
+            jobs,
+            directory,
+            dry_run=dry_run,
+            max_workers=max_workers,
+            persistent=persistent,
+            batch_size=batch_size,
+        )
     elif scheduler == "pbs":
         run_pbs_jobs(jobs, directory, dry_run=dry_run)
     elif scheduler == "slurm":
@@ -354,40 +521,96 @@ def run_jobs(
 
 
 def run_bash_jobs(
-    jobs: Iterator[Job], directory: PathLike = Path.cwd(), dry_run: bool = False
+    jobs: Iterator[Job],
+    directory: PathLike = Path.cwd(),
+    dry_run: bool = False,
+    max_workers: int = 1,
+    persistent: bool = False,
+    batch_size: Union[int, str] = 1,
 ) -> None:
     """Submit commands to the bash shell.
 
-    This function runs the commands iteratively but handles errors in the
-    same way as with the pbs_commands function. A command will run for all
-    combinations of variables in the variable matrix, however if any one of
-    those commands fails then the next command will not run.
+    A command will run for all combinations of variables in the variable matrix,
+    with every command of a job being run even when some of them fail. Rather than
+    waiting for all the commands of a job to complete, a command which requires a file
+    created by a command of an earlier job starts as soon as that command has
+    succeeded, while the other commands wait for all the commands of the previous job.
+    Only the commands depending on a failed command are skipped.
+
+    Args:
+        jobs: The jobs to run
+        directory: The directory in which to run the commands
+        dry_run: Print the commands rather than running them
+        max_workers: The number of commands to run at the same time. The steps
+            within each command are always run in order. When running more than one
+            command, the output of each command is labelled with the values of its
+            variables.
+        persistent: Run the commands using a pool of long running shells rather than
+            starting a new shell for each command.
+        batch_size: The number of commands to run one after the other in a single
+            shell, with the exit status of each command recorded separately. This is
+            either a number, or "auto" to choose the number of commands from the time
+            taken to run them.
+
+    When running commands concurrently, the ncpus, mem and ngpus of the scheduler
+    options are the resources required by each command. Each of the max_workers is
+    then a cpu, with each command pinned to the cpus it is allocated, and the number
+    of threads used by numerical libraries set to match.
 
     """
+    # Imported when required, keeping the start up of the exec command fast
+    from .graph import CommandGraph
+    from .local import run_graph
+
     logger.debug("Running commands in bash shell")
-    # iterate through command groups
-    for job in jobs:
+    job_list = list(jobs)
+    for job in job_list:
         # Check shell exists
         if shutil.which(job.shell) is None:
-            raise ProcessLookupError("The shell '{job.shell}' was not found.")
+            raise ProcessLookupError(f"The shell '{job.shell}' was not found.")
 
-        failed = False
-        for command in job:
-            for cmd in command:
-                logger.info(cmd)
-                if dry_run:
+    if dry_run:
+        for job in job_list:
+            for command in job:
+                for cmd in command:
+                    logger.info(cmd)
                     print(f"{job.shell} -c '{cmd}'")
-                else:
-                    result = subprocess.run(
-                        [job.shell, "-c", f"{cmd}"], cwd=str(directory)
-                    )
-                    if result.returncode != 0:
-                        failed = True
-                        logger.error("Command failed: %s", command)
-                        break
-        if failed:
-            logger.error("A command failed, not continuing further.")
-            return
+        return
+
+    if not job_list:
+        return
+    # Finding the commands to run is part of creating the graph
+    with phase("filter"):
+        graph = CommandGraph(job_list)
+    if not run_graph(
+        job_list[0].shell,
+        graph,
+        directory,
+        max_workers,
+        persistent,
+        batch_size,
+    ):
+        logger.error("A command failed, skipping the commands which depend on it.")
+
+
+def scheduler_files(
+    directory: Path, basename: str, extension: str, index: int, job: Job
+) -> Iterator[Tuple[Path, Job]]:
+    """The scheduler file of each array job required to run the commands of a job.
+
+    A job larger than the max_array_size of its scheduler options is split into a
+    number of array jobs, with a file for each part named <basename>_<index>_<part>.
+
+    """
+    from .pbs import split_job
+
+    parts = split_job(job)
+    if len(parts) == 1:
+        yield directory / "{}_{:02d}.{}".format(basename, index, extension), job
+        return
+    for part_index, part in enumerate(parts):
+        fname = "{}_{:02d}_{:03d}.{}".format(basename, index, part_index, extension)
+        yield directory / fname, part
 
 
 def run_pbs_jobs(
@@ -404,12 +627,17 @@ def run_pbs_jobs(
 
     To ensure that commands run consecutively the aditional requirement to the run
     script `-W depend=afterok:<prev_jobid>` is added. This allows for all the components
-    of the experiment to be conducted in a single script.
+    of the experiment to be conducted in a single script. A job which is split into
+    multiple arrays by the max_array_size option is submitted as a number of array
+    jobs, with the following jobs depending on all of them. A job where none of the
+    commands need to run, as all of them are complete or up to date, is skipped.
 
     Note: Having this function submit jobs requires that the command `qsub` exists,
     implying that a job scheduler is installed.
 
     """
+    from .pbs import write_scheduler_file
+
     submit_job = True
     logger.debug("Creating commands in pbs files.")
     # Check qsub exists
@@ -424,44 +652,53 @@ def run_pbs_jobs(
     directory = Path(directory)
 
     # remove existing files
-    for fname in directory.glob(basename + "*.pbs"):
-        print("Removing {}".format(fname))
-        os.remove(str(fname))
+    for pattern in ["*.pbs", "*.commands", "*.commands.index"]:
+        for fname in directory.glob(basename + pattern):
+            print("Removing {}".format(fname))
+            os.remove(str(fname))
 
     # Write new files and generate commands
     prev_jobids: List[str] = []
     for index, job in enumerate(jobs):
-        # Generate pbs file
-        content = create_scheduler_file("pbs", job)
-        logger.debug("File contents:\n%s", content)
-        # Write file to disk
-        fname = Path(directory / "{}_{:02d}.pbs".format(basename, index))
-        with fname.open("w") as dst:
-            dst.write(content)
-
-        if submit_job or dry_run:
-            # Construct command
-            submit_cmd = ["qsub"]
-
-            if prev_jobids:
-                # Continue to append all previous jobs to submit_cmd so subsequent jobs die along
-                # with the first.
-                submit_cmd += ["-W", "depend=afterok:{} ".format(":".join(prev_jobids))]
-
-            # actually run the command
-            logger.info(str(submit_cmd))
-            try:
-                if dry_run:
-                    print(f"{submit_cmd} {fname.name}")
-                    prev_jobids.append("dry_run")
-                else:
-                    cmd_res = subprocess.check_output(
-                        submit_cmd + [fname.name], cwd=str(directory)
-                    )
-                    prev_jobids.append(cmd_res.decode().strip())
-            except subprocess.CalledProcessError:
-                logger.error("Submitting job to the queue failed.")
-                break
+        if len(job) == 0:
+            logger.info("Skipping job %d, none of its commands need to run", index)
+            continue
+        job_ids: List[str] = []
+        for fname, part in scheduler_files(directory, basename, "pbs", index, job):
+            # Generate pbs file, writing it directly to disk
+            manifest = fname.with_suffix(".commands")
+            with phase("script"), fname.open("w", buffering=WRITE_BUFFER_SIZE) as dst:
+                write_scheduler_file("pbs", part, dst, manifest)
+            logger.debug("Created file %s", fname)
+
+            if submit_job or dry_run:
+                # Construct command
+                submit_cmd = ["qsub"]
+
+                if prev_jobids:
+                    # Continue to append all previous jobs to submit_cmd so subsequent
+                    # jobs die along with the first.
+                    submit_cmd += [
+                        "-W",
+                        "depend=afterok:{} ".format(":".join(prev_jobids)),
+                    ]
+
+                # actually run the command
+                logger.info(str(submit_cmd))
+                try:
+                    if dry_run:
+                        print(f"{submit_cmd} {fname.name}")
+                        job_ids.append("dry_run")
+                    else:
+                        cmd_res = subprocess.check_output(
+                            submit_cmd + [fname.name], cwd=str(directory)
+                        )
+                        job_ids.append(cmd_res.decode().strip())
+                except subprocess.CalledProcessError:
+                    logger.error("Submitting job to the queue failed.")
+                    return
+        # The following jobs depend on every part of this job
+        prev_jobids += job_ids
 
 
 def run_slurm_jobs(
@@ -478,12 +715,17 @@ def run_slurm_jobs(
 
     To ensure that commands run consecutively the aditional requirement to the run script `-W
     depend=afterok:<prev_jobid>` is added. This allows for all the components of the experiment to
-    be conducted in a single script.
+    be conducted in a single script. Where each command of a job requires the file created by the
+    command at the same index of the previous job, and both are arrays of the same shape, the
+    dependency is `aftercorr`, with each element starting once the same element of the previous
+    job has succeeded. A job where none of the commands need to run is skipped.
 
     Note: Running this function requires that the command `qsub` exists, implying that a job
     scheduler is installed.
 
     """
+    from .pbs import elementwise_dependency, write_scheduler_file
+
     submit_job = True
     logger.debug("Creating commands in slurm files.")
     # Check qsub exists
@@ -498,48 +740,68 @@ def run_slurm_jobs(
     directory = Path(directory)
 
     # remove existing files
-    for fname in directory.glob(basename + "*.slurm"):
-        print("Removing {}".format(fname))
-        os.remove(str(fname))
+    for pattern in ["*.slurm", "*.commands", "*.commands.index"]:
+        for fname in directory.glob(basename + pattern):
+            print("Removing {}".format(fname))
+            os.remove(str(fname))
 
     # Write new files and generate commands
     prev_jobids: List[str] = []
+    # The previous job, along with the ids of each of its parts
+    previous: Optional[Job] = None
+    previous_ids: List[str] = []
     for index, job in enumerate(jobs):
-        # Generate pbs file
-        content = create_scheduler_file("slurm", job)
-        # Write file to disk
-        fname = Path(directory / "{}_{:02d}.slurm".format(basename, index))
-        with fname.open("w") as dst:
-            dst.write(content)
-
-        if submit_job:
-            # Construct command
-            submit_cmd = ["sbatch"]
-
-            if prev_jobids:
-                # Continue to append all previous jobs to submit_cmd so subsequent jobs die along
-                # with the first.
-                submit_cmd += [
-                    "--dependency",
-                    "afterok:{} ".format(":".join(prev_jobids)),
-                ]
-
-            # acutally run the command
-            logger.info(str(submit_cmd))
-            try:
-                if dry_run:
-                    print(f"{submit_cmd} {fname.name}")
-                    prev_jobids.append("dry_run")
-                else:
-                    cmd_res = subprocess.check_output(
-                        submit_cmd + [fname.name], cwd=str(directory)
-                    )
-                    prev_jobids.append(cmd_res.decode().strip())
-            except subprocess.CalledProcessError:
-                logger.error("Submitting job to the queue failed.")
-                break
-
-            prev_jobids.append(cmd_res.decode().strip())
+        if len(job) == 0:
+            logger.info("Skipping job %d, none of its commands need to run", index)
+            continue
+        elementwise = previous is not None and elementwise_dependency(previous, job)
+        job_ids: List[str] = []
+        for part_index, (fname, part) in enumerate(
+            scheduler_files(directory, basename, "slurm", index, job)
+        ):
+            # Generate slurm file, writing it directly to disk
+            manifest = fname.with_suffix(".commands")
+            with phase("script"), fname.open("w", buffering=WRITE_BUFFER_SIZE) as dst:
+                write_scheduler_file("slurm", part, dst, manifest)
+            logger.debug("Created file %s", fname)
+
+            if submit_job:
+                # Construct command
+                submit_cmd = ["sbatch"]
+
+                if elementwise:
+                    # Each element only waits for the same element of the previous job
+                    earlier = prev_jobids[: len(prev_jobids) - len(previous_ids)]
+                    dependency = "aftercorr:{}".format(previous_ids[part_index])
+                    if earlier:
+                        earlier_ids = ":".join(earlier)
+                        dependency = "afterok:{},{}".format(earlier_ids, dependency)
+                    submit_cmd += ["--dependency", dependency]
+                elif prev_jobids:
+                    # Continue to append all previous jobs to submit_cmd so subsequent
+                    # jobs die along with the first.
+                    submit_cmd += [
+                        "--dependency",
+                        "afterok:{} ".format(":".join(prev_jobids)),
+                    ]
+
+                # acutally run the command
+                logger.info(str(submit_cmd))
+                try:
+                    if dry_run:
+                        print(f"{submit_cmd} {fname.name}")
+                        job_ids.append("dry_run")
+                    else:
+                        cmd_res = subprocess.check_output(
+                            submit_cmd + [fname.name], cwd=str(directory)
+                        )
+                        job_ids.append(cmd_res.decode().strip())
+                except subprocess.CalledProcessError:
+                    logger.error("Submitting job to the queue failed.")
+                    return
+        # The following jobs depend on every part of this job
+        prev_jobids += job_ids
+        previous, previous_ids = job, job_ids
 
 
 def process_scheduler(structure: Dict[str, Any]) -> str:
@@ -567,6 +829,18 @@ def process_scheduler(structure: Dict[str, Any]) -> str:
     return "shell"
 
 
+def _parse_batch_size(ctx, param, value):
+    if value == "auto":
+        return value
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise click.BadParameter("must be a positive integer or 'auto'")
+    return size
+
+
 def _set_verbosity(ctx, param, value):
     if value == 1:
         logging.basicConfig(level=logging.INFO)
@@ -574,12 +848,14 @@ def _set_verbosity(ctx, param, value):
         logging.basicConfig(level=logging.DEBUG)
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.version_option()
 @click.option(
     "-f",
     "--input-file",
-    type=click.Path(exists=True, dir_okay=False),
+    # The existence of the file is checked when running the experiment, so the
+    # default file is not required when running a subcommand.
+    type=click.Path(dir_okay=False),
     default="experiment.yml",
     help="""Path to a YAML file containing experiment data. Note that the experiment
     will be run from the directory in which the file exists, not the directory the
@@ -589,7 +865,17 @@ def _set_verbosity(ctx, param, value):
     "--use-dependencies",
     default=False,
     is_flag=True,
-    help="Use the dependencies specified in the command to reduce the processing",
+    help="""Use the dependencies specified in the command to reduce the processing,
+    skipping commands where the file they create is newer than the file they
+    require.""",
+)
+@click.option(
+    "--hash-dependencies",
+    default=False,
+    is_flag=True,
+    help="""Use the dependencies of the commands, comparing the contents of the
+    required files with those when the command last succeeded, rather than the
+    modification times. This implies --use-dependencies.""",
 )
 @click.option(
     "--dry-run",
@@ -597,6 +883,65 @@ def _set_verbosity(ctx, param, value):
     default=False,
     help="Don't run commands or submit jobs, just show the commands that would be run.",
 )
+@click.option(
+    "-j",
+    "--jobs",
+    "max_workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="""The number of commands to run at the same time when running in the shell.
+    A command requiring a file created by a command of an earlier job starts once that
+    command has succeeded, while other commands wait for all the commands of the
+    previous job.""",
+)
+@click.option(
+    "--persistent-shells",
+    "persistent",
+    is_flag=True,
+    default=False,
+    help="""Send commands to a pool of long running shells, rather than starting a new
+    shell for every command. This is much faster for many short commands.""",
+)
+@click.option(
+    "--batch-size",
+    callback=_parse_batch_size,
+    default="1",
+    help="""The number of commands to run one after the other in a single shell, or
+    'auto' to choose the number from the time each command takes. This removes the
+    cost of starting a shell for each of many short commands.""",
+)
+@click.option(
+    "--journal",
+    "use_journal",
+    is_flag=True,
+    default=False,
+    help="""Record the exit status of each command in the file .experi/journal in the
+    experiment directory, skipping the commands which have already succeeded. This also
+    applies to the commands run by a scheduler.""",
+)
+@click.option(
+    "--cache",
+    "use_cache",
+    is_flag=True,
+    default=False,
+    help="""Store the commands generated from the input file in the directory
+    .experi/cache in the experiment directory, loading them rather than generating
+    them again when the input file is unchanged.""",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="""Report the time and peak memory of each phase of running the experiment,
+    from reading the input file to running or submitting the commands.""",
+)
+@click.option(
+    "--profile-output",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="""Write the statistics of the python profiler, which can be read using the
+    pstats module, to this file. This also reports each phase like --profile.""",
+)
 @click.option(
     "-v",
     "--verbose",
@@ -605,12 +950,124 @@ def _set_verbosity(ctx, param, value):
     count=True,
     help="Increase the verbosity of logging events.",
 )
-def main(input_file, use_dependencies, dry_run) -> None:
+@click.pass_context
+def main(
+    ctx,
+    input_file,
+    use_dependencies,
+    hash_dependencies,
+    dry_run,
+    max_workers,
+    persistent,
+    batch_size,
+    use_journal,
+    use_cache,
+    profile,
+    profile_output,
+) -> None:
+    if ctx.invoked_subcommand is not None:
+        return
     # Process and run commands
     input_file = Path(input_file)
+    if not input_file.is_file():
+        raise click.BadParameter(
+            f"File '{input_file}' does not exist.", param_hint="'-f' / '--input-file'"
+        )
+    with profiled(profile or profile_output is not None, profile_output):
+        with phase("read"):
+            structure = read_file(input_file)
+        scheduler = process_scheduler(structure)
+        journal = Journal(input_file.parent) if use_journal else None
+        digests = DigestStore(input_file.parent) if hash_dependencies else None
+        cache = ExpansionCache(input_file.parent) if use_cache else None
+        # The jobs are generated as they are run, so most phases happen within run
+        jobs = process_structure(
+            structure,
+            scheduler,
+            Path(input_file.parent),
+            use_dependencies or hash_dependencies,
+            journal,
+            digests,
+            cache,
+        )
+        try:
+            with phase("run"):
+                run_jobs(
+                    jobs,
+                    scheduler,
+                    input_file.parent,
+                    dry_run,
+                    max_workers,
+                    persistent,
+                    batch_size,
+                )
+        finally:
+            if journal is not None:
+                journal.close()
+            if digests is not None:
+                digests.close()
+
+
+@main.command("exec")
+@click.option(
+    "-f",
+    "--input-file",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="""Path to a YAML file containing experiment data. The command is run from the
+    directory in which the file exists. This defaults to the input file given before
+    the subcommand.""",
+)
+@click.option(
+    "--index",
+    type=click.IntRange(min=0),
+    required=True,
+    envvar=["SLURM_ARRAY_TASK_ID", "PBS_ARRAY_INDEX"],
+    help="""The index of the combination of the variables, which defaults to the index
+    of the array job.""",
+)
+@click.option(
+    "--job",
+    "job_index",
+    type=click.IntRange(min=0),
+    default=0,
+    help="The index of the job within the experiment, starting from 0.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Print the command rather than running it.",
+)
+@click.pass_context
+def exec_command(ctx, input_file, index, job_index, dry_run) -> None:
+    """Run the command for a single combination of the variables.
+
+    This is for running the commands of an array job, where each element of the array
+    finds its own command from the input file, so the job script is the same however
+    many commands there are. The index is of the combination of the variables, so
+    unlike running the experiment, duplicate commands are not removed.
+
+    """
+    if input_file is None:
+        input_file = ctx.parent.params["input_file"]
+    input_file = Path(input_file)
+    if not input_file.is_file():
+        raise click.BadParameter(
+            f"File '{input_file}' does not exist.", param_hint="'-f' / '--input-file'"
+        )
     structure = read_file(input_file)
-    scheduler = process_scheduler(structure)
-    jobs = process_structure(
-        structure, scheduler, Path(input_file.parent), use_dependencies
-    )
-    run_jobs(jobs, scheduler, input_file.parent, dry_run)
+    try:
+        command = resolve_command(structure, index, job_index)
+    except IndexError as error:
+        # Either the index or the job is out of range, which the message describes
+        raise click.UsageError(str(error))
+
+    if dry_run:
+        click.echo(command)
+        return
+
+    logger.info(command)
+    os.chdir(str(input_file.parent))
+    sys.stdout.flush()
+    os.execvp("bash", ["bash", "-c", str(command)])
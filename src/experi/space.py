@@ -0,0 +1,325 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Random access to the combinations of variables.
+
+The variables section of an input file describes a tree of iterators; product, zip,
+chain, cycle and arange. Rather than generating every combination of the variables,
+the :class:`VariableSpace` keeps this tree, which allows for calculating the number of
+combinations, and finding the values of the nth combination by decoding the index at
+each level of the tree.
+
+"""
+
+import logging
+from bisect import bisect_right
+from collections.abc import Sequence
+from itertools import accumulate
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Union, overload
+
+if TYPE_CHECKING:  # pragma: no cover
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+YamlValue = Union[str, int, float]
+VarType = Union[YamlValue, List[YamlValue], Dict[str, YamlValue]]
+Combination = Dict[str, YamlValue]
+# The values of an arange iterator, which are a NumPy array where they can't be python
+# values without changing how they are formatted.
+ArangeValues = Union[Sequence, "np.ndarray"]
+
+
+def is_integer(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def integer_range(start=None, stop=None, step=None, dtype=None) -> Sequence:
+    """The values of :func:`arange` for integer arguments, without using NumPy.
+
+    A range contains the same values as the array, as python ints, with the values
+    only being created as they are accessed.
+
+    """
+    if stop and not start:
+        return range(stop)
+    return range(start or 0, stop, 1 if step is None else step)
+
+
+def arange(start=None, stop=None, step=None, dtype=None) -> "np.ndarray":
+    # NumPy is slow to import, so it is only imported when it is required
+    import numpy as np
+
+    if stop and not start:
+        return np.arange(stop)
+    return np.arange(start=start, stop=stop, step=step, dtype=dtype)
+
+
+def native_values(values: "np.ndarray") -> ArangeValues:
+    """Convert an array to a list of python values where this doesn't change them.
+
+    Python ints and floats are much faster to format than the NumPy scalars, and are
+    formatted identically for integer and 64 bit float arrays. Other types, like 32 bit
+    floats, are left as NumPy scalars to retain their formatting.
+
+    """
+    kind = values.dtype.kind
+    if kind in "biu" or (kind == "f" and values.itemsize == 8):
+        return values.tolist()
+    return values
+
+
+def arange_values(variables: VarType) -> ArangeValues:
+    """The values specified by the arguments to the arange iterator.
+
+    Where all the arguments are integers, the values are a :class:`range`, which is
+    identical to the values from NumPy without the cost of importing it.
+
+    Args:
+        variables: Either the stop value, or a dictionary of the arguments to
+            :func:`numpy.arange`.
+
+    """
+    if isinstance(variables, int) and not isinstance(variables, bool):
+        return range(variables)
+
+    if isinstance(variables, (int, float)):
+        return native_values(arange(variables))
+
+    if isinstance(variables, dict):
+        if variables.get("stop"):
+            arguments = [variables.get(key) for key in ["start", "stop", "step"]]
+            if variables.get("dtype") is None and all(
+                value is None or is_integer(value) for value in arguments
+            ):
+                return integer_range(**variables)
+            return native_values(arange(**variables))
+        raise ValueError(f"Stop is a required keyword for the arange iterator.")
+
+    raise ValueError(
+        f"The arange keyword only takes a dict as arguments, got {variables} of type {type(variables)}"
+    )
+
+
+class Node:
+    """A level of the tree of iterators.
+
+    Each node knows the number of combinations it generates, and is able to return
+    any one of them. The index is assumed to be within the bounds of the node, with
+    the checking performed by the :class:`VariableSpace`.
+
+    """
+
+    length: int = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> Combination:
+        raise NotImplementedError
+
+
+class Values(Node):
+    """A sequence of values for a single variable."""
+
+    def __init__(self, name: str, values: Any) -> None:
+        self.name = name
+        self.values = values
+        self.length = len(values)
+
+    def __getitem__(self, index: int) -> Combination:
+        return {self.name: self.values[index]}
+
+
+class Product(Node):
+    """Every combination of the values of each child, with the last varying fastest."""
+
+    def __init__(self, children: List[Node]) -> None:
+        self.children = children
+        self.length = 1
+        for child in children:
+            self.length *= len(child)
+
+    def __getitem__(self, index: int) -> Combination:
+        result: Combination = {}
+        # Mixed radix decoding of the index, where the last child is the least
+        # significant digit. Going in reverse also means the values of the first
+        # child take precedence when variables are duplicated.
+        for child in reversed(self.children):
+            index, digit = divmod(index, len(child))
+            result.update(child[digit])
+        return result
+
+
+class Zip(Node):
+    """The nth value of every child combined, stopping at the shortest child."""
+
+    def __init__(self, children: List[Node]) -> None:
+        self.children = children
+        self.length = min((len(child) for child in children), default=0)
+
+    def __getitem__(self, index: int) -> Combination:
+        result: Combination = {}
+        for child in reversed(self.children):
+            result.update(child[index])
+        return result
+
+
+class Chain(Node):
+    """All the values of each child one after the other."""
+
+    def __init__(self, children: List[Node]) -> None:
+        self.children = children
+        self.offsets = list(accumulate(len(child) for child in children))
+        self.length = self.offsets[-1] if self.offsets else 0
+
+    def __getitem__(self, index: int) -> Combination:
+        position = bisect_right(self.offsets, index)
+        if position > 0:
+            index -= self.offsets[position - 1]
+        return self.children[position][index]
+
+
+class Cycle(Node):
+    """The values of the child repeated a number of times."""
+
+    def __init__(self, child: Node, times: int) -> None:
+        self.child = child
+        self.times = times
+        self.length = len(child) * times
+
+    def __getitem__(self, index: int) -> Combination:
+        return self.child[index % len(self.child)]
+
+
+def space_zip(variables: VarType, parent: str = None) -> List[Node]:
+    if isinstance(variables, list):
+        return [build_tree(item, parent, "zip") for item in variables]
+    return [build_tree(variables, parent, "zip")]
+
+
+def space_product(variables: VarType, parent: str = None) -> List[Node]:
+    if isinstance(variables, list):
+        raise ValueError(
+            f"Product only takes mappings of values, got {variables} of type {type(variables)}"
+        )
+    return [build_tree(variables, parent, "product")]
+
+
+def space_arange(variables: VarType, parent: str = None) -> List[Node]:
+    assert parent is not None
+    return [Values(parent, arange_values(variables))]
+
+
+def space_chain(variables: VarType, parent: str = None) -> List[Node]:
+    if not isinstance(variables, list):
+        raise ValueError(
+            f"Append keyword only takes a list of arguments, got {variables} of type {type(variables)}"
+        )
+    return [Chain([build_tree(item, parent, "product") for item in variables])]
+
+
+def space_cycle(variables: VarType, parent: str = None) -> List[Node]:
+    if not isinstance(variables, dict):
+        raise ValueError(
+            f"The repeat operator only takes a dict as arguments, got {variables} of type {type(variables)}"
+        )
+    if not variables.get("times"):
+        raise ValueError(f"times is a required keyword for the repeat iterator.")
+
+    values = {key: value for key, value in variables.items() if key != "times"}
+    return [Cycle(build_tree(values, parent, "product"), int(variables["times"]))]
+
+
+SPECIAL_KEYS: Dict[str, Callable[[VarType, Any], List[Node]]] = {
+    "zip": space_zip,
+    "product": space_product,
+    "arange": space_arange,
+    "chain": space_chain,
+    "append": space_chain,
+    "cycle": space_cycle,
+    "repeat": space_cycle,
+}
+
+
+def build_tree(
+    variables: VarType, parent: str = None, iterator: str = "product"
+) -> Node:
+    """Convert the variables into a tree of nodes.
+
+    This follows the same rules as :func:`experi.run.variable_matrix`, with the nodes
+    of the tree generating the same sequence of combinations.
+
+    """
+    if isinstance(variables, dict):
+        children: List[Node] = []
+
+        # Handling of specialised iterators
+        for key, function in SPECIAL_KEYS.items():
+            if variables.get(key):
+                children.extend(function(variables[key], parent))
+
+        for key, value in variables.items():
+            if key in SPECIAL_KEYS and variables.get(key):
+                continue
+            children.append(build_tree(value, key, iterator))
+
+        if iterator == "zip":
+            return Zip(children)
+        return Product(children)
+
+    if isinstance(variables, list):
+        if any(isinstance(item, (list, dict)) for item in variables):
+            return Chain([build_tree(item, parent, iterator) for item in variables])
+        assert parent is not None
+        return Values(parent, variables)
+
+    assert parent is not None
+    return Values(parent, [variables])
+
+
+class VariableSpace(Sequence):
+    """All the combinations of the variables, without generating them.
+
+    This behaves like a list of the combinations generated by
+    :func:`experi.run.variable_matrix`, where the length is calculated from the
+    structure of the variables, and the combination at any index is found in time
+    proportional to the depth of the structure, independent of the number of
+    combinations.
+
+    Args:
+        variables: The variables section of the input file.
+
+    """
+
+    def __init__(
+        self, variables: VarType, parent: str = None, iterator: str = "product"
+    ) -> None:
+        self.root = build_tree(variables, parent, iterator)
+
+    def __len__(self) -> int:
+        return len(self.root)
+
+    @overload
+    def __getitem__(self, index: int) -> Combination:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Combination]:
+        ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        length = len(self.root)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError(f"Index out of range for {length} combinations.")
+        return self.root[index]
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the cache of the commands generated from an input file."""
+
+import os
+
+import pytest
+
+from experi.cache import CACHE_DIRECTORY, ExpansionCache, structure_key
+from experi.run import process_structure
+
+STRUCTURE = {
+    "jobs": [
+        {"command": "echo {var1} {var2}"},
+        {"command": {"cmd": "touch {creates}", "creates": "{var1}.txt"}},
+    ],
+    "variables": {"var1": {"arange": 3}, "var2": ["a", "b"]},
+}
+
+
+def commands(jobs):
+    return [[str(command) for command in job] for job in jobs]
+
+
+def test_structure_key():
+    reordered = {"variables": STRUCTURE["variables"], "jobs": STRUCTURE["jobs"]}
+    assert structure_key(STRUCTURE) == structure_key(reordered)
+    changed = dict(STRUCTURE, variables={"var1": 3, "var2": ["a", "b"]})
+    assert structure_key(STRUCTURE) != structure_key(changed)
+
+
+def test_cached_commands(tmp_dir):
+    expected = commands(process_structure(STRUCTURE))
+    cache = ExpansionCache(tmp_dir)
+    assert commands(process_structure(STRUCTURE, cache=cache)) == expected
+    assert len(list((tmp_dir / CACHE_DIRECTORY).glob("*.pickle"))) == 1
+
+    def fail():
+        raise AssertionError("The commands should be loaded from the cache")
+
+    assert commands(ExpansionCache(tmp_dir).get(STRUCTURE, fail)) == expected
+
+
+def test_corrupt_entry(tmp_dir):
+    cache = ExpansionCache(tmp_dir)
+    cache.store("key", [1, 2])
+    cache.entry("key").write_bytes(b"not a pickle")
+    assert cache.load("key") is None
+    assert not cache.entry("key").exists()
+
+
+def set_times(cache, keys):
+    for time, key in enumerate(keys):
+        os.utime(str(cache.entry(key)), (time, time))
+
+
+@pytest.mark.parametrize(
+    "max_entries, max_bytes, remaining",
+    [(2, 2 ** 20, ["b", "c"]), (8, 1, ["c"]), (8, 2 ** 20, ["a", "b", "c"])],
+    ids=["entries", "bytes", "within"],
+)
+def test_evict(tmp_dir, max_entries, max_bytes, remaining):
+    """The least recently used entries are removed."""
+    for key in ["a", "b", "c"]:
+        ExpansionCache(tmp_dir).store(key, key * 100)
+    cache = ExpansionCache(tmp_dir, max_entries, max_bytes)
+    set_times(cache, ["a", "b", "c"])
+    cache.evict()
+    assert sorted(path.stem for path in cache.path.glob("*.pickle")) == remaining
+
+
+def test_evict_loaded(tmp_dir):
+    """Loading an entry makes it the most recently used."""
+    cache = ExpansionCache(tmp_dir, max_entries=2)
+    for key in ["a", "b"]:
+        cache.store(key, key)
+    set_times(cache, ["a", "b"])
+    assert cache.load("a") == "a"
+    cache.store("c", "c")
+    assert sorted(path.stem for path in cache.path.glob("*.pickle")) == ["a", "c"]
@@ -8,13 +8,17 @@
 
 """Test CLI interaction."""
 
+import pstats
+import subprocess
+import sys
 import textwrap
 from pathlib import Path
 
 import pytest
 from click.testing import CliRunner
 
-from experi.run import main
+from experi.run import main, read_file, resolve_command
+from experi.space import VariableSpace
 import pkg_resources
 
 
@@ -76,3 +80,176 @@ def test_dry_run(runner, test_file):
             print(result.output)
             assert "bash -c" in result.output
             assert not Path("experi_00.pbs").is_file()
+
+
+def test_journal(runner):
+    with runner.isolated_filesystem():
+        with open("experiment.yml", "w") as dst:
+            dst.write(
+                "command: echo {var1} >> runs.txt\nvariables:\n    var1: [1, 2]\n"
+            )
+
+        for _ in range(2):
+            result = runner.invoke(main, ["--journal"])
+            assert result.exit_code == 0, result.exception
+
+        assert Path(".experi/journal").is_file()
+        assert sorted(Path("runs.txt").read_text().split()) == ["1", "2"]
+
+
+@pytest.mark.parametrize("dry_run", [True, False], ids=["dry-run", "run"])
+def test_profile(runner, test_file, dry_run):
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text(test_file)
+        args = ["--use-dependencies", "--profile-output", "run.prof"]
+        result = runner.invoke(main, args + (["--dry-run"] if dry_run else []))
+        assert result.exit_code == 0, result.exception
+
+        for description in ["Reading", "Expanding", "Rendering", "Finding", "Total"]:
+            assert description in result.output
+        assert ("Writing scheduler files" in result.output) is ("pbs" in test_file)
+        stats = pstats.Stats("run.prof")
+        assert any(function == "read_file" for _, _, function in stats.stats)
+
+
+EXEC_FILE = """
+jobs:
+  - command: echo first {a} {b}
+  - command:
+      cmd: echo second {b} > {creates}
+      creates: out{b}.txt
+variables:
+  a: [1, 2]
+  b:
+    arange: 3
+"""
+
+
+@pytest.mark.parametrize(
+    "args, expected",
+    [
+        (["--index", "0"], "echo first 1 0"),
+        (["--index", "4"], "echo first 2 1"),
+        (["--index", "4", "--job", "1"], "echo second 1 > out1.txt"),
+    ],
+)
+def test_exec_dry_run(runner, args, expected):
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text(EXEC_FILE)
+        result = runner.invoke(main, ["exec", "--dry-run"] + args)
+        assert result.exit_code == 0, result.exception
+        assert result.output == expected + "\n"
+
+
+@pytest.mark.parametrize("position", ["group", "subcommand"])
+def test_exec_input_file(runner, position):
+    """The input file can be given either before or after the subcommand."""
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text("command: echo {a}\nvariables:\n    a: [1]\n")
+        Path("exp2.yml").write_text(EXEC_FILE)
+        args = ["exec", "--dry-run", "--index", "4"]
+        if position == "group":
+            args = ["-f", "exp2.yml"] + args
+        else:
+            args = args + ["-f", "exp2.yml"]
+        result = runner.invoke(main, args)
+        assert result.exit_code == 0, result.output
+        assert result.output == "echo first 2 1\n"
+
+
+def test_exec_missing_input_file(runner):
+    with runner.isolated_filesystem():
+        result = runner.invoke(main, ["exec", "--index", "0"])
+        assert result.exit_code == 2
+        assert "does not exist" in result.output
+
+
+@pytest.mark.parametrize("variable", ["PBS_ARRAY_INDEX", "SLURM_ARRAY_TASK_ID"])
+def test_exec_array_index(runner, variable):
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text(EXEC_FILE)
+        result = runner.invoke(main, ["exec", "--dry-run"], env={variable: "5"})
+        assert result.output == "echo first 2 2\n"
+
+
+@pytest.mark.parametrize("args", [["--index", "6"], ["--index", "0", "--job", "2"]])
+def test_exec_invalid(runner, args):
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text(EXEC_FILE)
+        result = runner.invoke(main, ["exec"] + args)
+        assert result.exit_code == 2
+
+
+def test_exec_missing_variable(runner):
+    """An error in the template is reported as itself, not as an invalid option."""
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text(
+            "command: echo {missing}\nvariables:\n    var1: [1, 2]\n"
+        )
+        result = runner.invoke(main, ["exec", "--index", "0"])
+        assert isinstance(result.exception, ValueError)
+        assert "missing" in str(result.exception)
+        assert "--job" not in result.output
+
+
+def test_exec(tmp_dir):
+    """The command runs in the directory of the input file."""
+    (tmp_dir / "experiment.yml").write_text(EXEC_FILE)
+    args = ["-f", str(tmp_dir / "experiment.yml"), "--index", "2", "--job", "1"]
+    result = subprocess.run(
+        [sys.executable, "-c", "from experi.run import main; main()", "exec"] + args
+    )
+    assert result.returncode == 0
+    assert (tmp_dir / "out2.txt").read_text() == "second 2\n"
+
+
+@pytest.mark.parametrize("input_file", sorted(Path("test/data/iter").glob("*.yml")))
+def test_resolve_command(input_file):
+    """The commands of each combination are the commands of the full experiment."""
+    structure = read_file(input_file)
+    num_combinations = len(VariableSpace(structure["variables"]))
+    for job_index, expected in enumerate(structure["result"]):
+        commands = [
+            str(resolve_command(structure, index, job_index))
+            for index in range(num_combinations)
+        ]
+        assert list(dict.fromkeys(commands)) == expected
+
+
+# The longest time in seconds importing the command line interface should take
+IMPORT_BUDGET = 0.5
+
+STARTUP_CODE = """
+import sys
+from experi.run import main
+main({args}, standalone_mode=False)
+print(" ".join(sys.modules))
+"""
+
+
+def test_import_budget():
+    """Importing the command line interface is fast."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import experi.run"],
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    # The last line is the cumulative time in microseconds of importing experi.run
+    last = result.stderr.decode().splitlines()[-1]
+    assert last.split("|")[-1].strip() == "experi.run"
+    assert int(last.split("|")[1]) < IMPORT_BUDGET * 1e6
+
+
+def test_exec_imports(tmp_dir):
+    """Running a command with integer variables doesn't import numpy."""
+    (tmp_dir / "experiment.yml").write_text(EXEC_FILE)
+    args = ["exec", "--dry-run", "-f", str(tmp_dir / "experiment.yml"), "--index", "1"]
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_CODE.format(args=args)],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    command, modules = result.stdout.decode().splitlines()
+    assert command == "echo first 1 1"
+    assert "numpy" not in modules.split()
+    assert "asyncio" not in modules.split()
@@ -13,7 +13,14 @@ from tempfile import TemporaryDirectory
 
 import pytest
 
-from experi.commands import Command, Job
+from experi.commands import (
+    Command,
+    CommandStore,
+    CommandTemplate,
+    Job,
+    VariableStore,
+)
+from experi.journal import Journal
 from experi.run import uniqueify
 
 
@@ -121,6 +128,33 @@ def test_command_init():
         Command("{test1} {test2}", variables={"test1": ""})
 
 
+def test_command_template():
+    template = CommandTemplate("echo {var1} > {creates}", creates="{var1}.out")
+    assert template.variables == {"var1"}
+    commands = [Command.from_template(template, {"var1": i}) for i in range(3)]
+    assert [str(command) for command in commands] == [
+        f"echo {i} > {i}.out" for i in range(3)
+    ]
+    assert [command.creates for command in commands] == [f"{i}.out" for i in range(3)]
+
+
+def test_command_template_missing():
+    template = CommandTemplate("{test1} {test2}")
+    with pytest.raises(ValueError):
+        Command.from_template(template, {"test1": ""})
+
+
+def test_command_template_field_access():
+    """Indexing or accessing an attribute of a variable uses the variable."""
+    template = CommandTemplate("echo {var1[0]} {var2.real}", creates="{var1[1]}")
+    assert template.variables == {"var1", "var2"}
+    assert template.keys == ("var1", "var2")
+    matrix = [{"var1": "xy", "var2": 3}, {"var1": "zw", "var2": 3}]
+    store = CommandStore.from_matrix(template, matrix)
+    assert [str(command) for command in store] == ["echo x 3", "echo z 3"]
+    assert [command.creates for command in store] == ["y", "w"]
+
+
 def test_job_length():
     job = Job([Command("echo")])
     assert len(job) == 1
@@ -134,3 +168,84 @@ def test_job_length_depends(tmp_dir):
         [Command("echo", creates="test.txt")], directory=tmp_dir, use_dependencies=True
     )
     assert len(job) == 0
+
+
+def test_job_split(tmp_dir):
+    """Only the commands which need to run are split into jobs."""
+    (tmp_dir / "1.txt").touch()
+    commands = [Command("touch {creates}", creates=f"{i}.txt") for i in range(6)]
+    job = Job(commands, {"ncpus": 2}, directory=tmp_dir, use_dependencies=True)
+    parts = job.split(2)
+    assert [[command.creates for command in part] for part in parts] == [
+        ["0.txt", "2.txt"],
+        ["3.txt", "4.txt"],
+        ["5.txt"],
+    ]
+    assert all(part.scheduler_options is job.scheduler_options for part in parts)
+
+
+def test_job_split_journal(tmp_dir):
+    """The journal of the parts records the status, without checking the commands."""
+    journal = Journal(tmp_dir)
+    job = Job([Command(f"echo {i}") for i in range(6)], journal=journal)
+    parts = job.split(4)
+    checked = []
+    journal.is_complete = lambda command: checked.append(command)
+    assert [len(part) for part in parts] == [4, 2]
+    assert all(part.journal is journal for part in parts)
+    assert checked == []
+
+
+def test_command_store():
+    template = CommandTemplate("echo {var1} {var2}")
+    matrix = [{"var1": i, "var2": "a"} for i in range(3)] * 2
+    store = CommandStore.from_matrix(template, matrix)
+    assert len(store) == 3
+    assert [str(command) for command in store] == [f"echo {i} a" for i in range(3)]
+    assert store[-1].variables == {"var1": 2, "var2": "a"}
+    assert [str(command) for command in store[1:]] == ["echo 1 a", "echo 2 a"]
+
+
+def test_variable_store():
+    store = VariableStore()
+    store.append({"var1": 1, "var2": 0.5})
+    store.append({"var1": 2, "var3": "a"})
+    store.compact()
+    assert len(store) == 2
+    assert store.row(0) == {"var1": 1, "var2": 0.5}
+    assert store.row(1) == {"var1": 2, "var3": "a"}
+
+
+def test_command_store_projection():
+    """Only the unique values of the variables in the template are rendered."""
+    renders = []
+
+    class CountingTemplate(CommandTemplate):
+        def render(self, variables):
+            renders.append(variables)
+            return super().render(variables)
+
+    template = CountingTemplate("echo {var1}", creates="{var2}.out")
+    matrix = [{"var1": i % 2, "var2": "a", "var3": i} for i in range(100)]
+    store = CommandStore.from_matrix(template, matrix)
+    assert len(renders) == 2
+    assert [str(command) for command in store] == ["echo 0", "echo 1"]
+
+
+def test_command_store_types():
+    """Values which are equal but formatted differently are separate commands."""
+    template = CommandTemplate("echo {var1}")
+    store = CommandStore.from_matrix(template, [{"var1": 1}, {"var1": 1.0}])
+    assert [str(command) for command in store] == ["echo 1", "echo 1.0"]
+
+
+def test_command_store_rendered_duplicates():
+    """Different values rendering the same command are only kept once."""
+    template = CommandTemplate(["echo {var1:.1f}", "echo {var2}"])
+    matrix = [{"var1": 1.0, "var2": "a"}, {"var1": 1.01, "var2": "a"}]
+    matrix += [{"var1": 1.0, "var2": "b"}]
+    store = CommandStore.from_matrix(template, matrix)
+    assert [str(command) for command in store] == [
+        "echo 1.0 && echo a",
+        "echo 1.0 && echo b",
+    ]
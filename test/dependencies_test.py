@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the checking of dependencies between files."""
+
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import pytest
+
+from experi.commands import Command, CommandTemplate, Job
+from experi.dependencies import DigestStore, FileIndex, is_up_to_date
+from experi.pbs import create_scheduler_file
+from experi.run import run_bash_jobs
+
+
+def set_time(path, time):
+    os.utime(str(path), (time, time))
+
+
+@pytest.fixture
+def command():
+    return Command("cp {requires} {creates}", creates="out.txt", requires="in.txt")
+
+
+def test_missing_creates(tmp_dir, command):
+    (tmp_dir / "in.txt").write_text("input")
+    assert not is_up_to_date(tmp_dir, command)
+
+
+def test_no_requires(tmp_dir):
+    command = Command("touch {creates}", creates="out.txt")
+    assert not is_up_to_date(tmp_dir, command)
+    (tmp_dir / "out.txt").touch()
+    assert is_up_to_date(tmp_dir, command)
+
+
+def test_missing_requires(tmp_dir, command):
+    (tmp_dir / "out.txt").write_text("output")
+    assert not is_up_to_date(tmp_dir, command)
+
+
+def test_directory_creates(tmp_dir):
+    (tmp_dir / "out").mkdir()
+    assert not is_up_to_date(tmp_dir, Command("mkdir {creates}", creates="out"))
+
+
+@pytest.mark.parametrize(
+    "created, required, expected",
+    [(200, 100, True), (100, 100, True), (100, 200, False)],
+)
+def test_modified_time(tmp_dir, command, created, required, expected):
+    (tmp_dir / "in.txt").write_text("input")
+    (tmp_dir / "out.txt").write_text("output")
+    set_time(tmp_dir / "out.txt", created)
+    set_time(tmp_dir / "in.txt", required)
+    assert is_up_to_date(tmp_dir, command) is expected
+
+
+def test_digests(tmp_dir, command):
+    """The contents of the required file are compared rather than the times."""
+    (tmp_dir / "in.txt").write_text("input")
+    (tmp_dir / "out.txt").write_text("output")
+    set_time(tmp_dir / "out.txt", 100)
+    digests = DigestStore(tmp_dir)
+    # Without a stored digest the modification times are used
+    assert not is_up_to_date(tmp_dir, command, digests)
+
+    digests.record(command)
+    assert is_up_to_date(tmp_dir, command, DigestStore(tmp_dir))
+
+    (tmp_dir / "in.txt").write_text("changed")
+    set_time(tmp_dir / "in.txt", 50)
+    assert not is_up_to_date(tmp_dir, command, DigestStore(tmp_dir))
+
+
+def _record_digests(args):
+    directory, worker = args
+    digests = DigestStore(directory)
+    for i in range(200):
+        digests.record(
+            Command("cp {requires} {creates}", creates=f"{worker}-{i}", requires="in")
+        )
+    digests.close()
+
+
+def test_concurrent_digests(tmp_dir):
+    (tmp_dir / "in").write_text("input")
+    with Pool(4) as pool:
+        pool.map(_record_digests, [(tmp_dir, worker) for worker in range(4)])
+    lines = DigestStore(tmp_dir).path.read_text().splitlines()
+    assert len(lines) == 800
+    assert len(DigestStore(tmp_dir).digests) == 800
+
+
+def pipeline_jobs(directory, digests=None):
+    first = CommandTemplate(
+        "echo first{var} >> runs.txt && cp {requires} {creates}",
+        creates="mid{var}.txt",
+        requires="in{var}.txt",
+    )
+    second = CommandTemplate(
+        "echo second{var} >> runs.txt && cp {requires} {creates}",
+        creates="out{var}.txt",
+        requires="mid{var}.txt",
+    )
+    return [
+        Job(
+            [Command.from_template(template, {"var": i}) for i in range(3)],
+            directory=directory,
+            use_dependencies=True,
+            digests=digests,
+        )
+        for template in [first, second]
+    ]
+
+
+@pytest.mark.parametrize("use_digests", [False, True], ids=["mtime", "digest"])
+def test_rerun_modified_input(tmp_dir, use_digests):
+    """Changing one input only runs the commands which depend on it."""
+
+    def digests():
+        return DigestStore(tmp_dir) if use_digests else None
+
+    for i in range(3):
+        (tmp_dir / f"in{i}.txt").write_text(f"input{i}")
+    run_bash_jobs(pipeline_jobs(tmp_dir, digests()), tmp_dir)
+    assert len((tmp_dir / "runs.txt").read_text().split()) == 6
+
+    for path in tmp_dir.glob("*.txt"):
+        set_time(path, 100)
+    (tmp_dir / "runs.txt").unlink()
+    (tmp_dir / "in1.txt").write_text("modified")
+    set_time(tmp_dir / "in1.txt", 200)
+
+    run_bash_jobs(pipeline_jobs(tmp_dir, digests()), tmp_dir)
+    assert (tmp_dir / "runs.txt").read_text().split() == ["first1", "second1"]
+    assert (tmp_dir / "out1.txt").read_text() == "modified"
+
+
+def test_file_index(tmp_dir):
+    (tmp_dir / "sub").mkdir()
+    (tmp_dir / "sub" / "file.txt").write_text("contents")
+    set_time(tmp_dir / "sub" / "file.txt", 100)
+    index = FileIndex(tmp_dir)
+    assert index.exists("sub/file.txt")
+    assert index.exists("./sub/../sub/file.txt")
+    assert not index.exists("sub")
+    assert not index.exists("missing/file.txt")
+    assert index.modified_time("sub/file.txt") == 100 * 10 ** 9
+    assert index.modified_time("sub/missing.txt") is None
+
+
+def test_file_index_relative(tmp_dir, monkeypatch):
+    """The index works from the current directory, the default of the cli."""
+    (tmp_dir / "file.txt").touch()
+    monkeypatch.chdir(tmp_dir)
+    index = FileIndex(Path("."))
+    assert index.exists("file.txt")
+    assert index.exists("./file.txt")
+    assert not index.exists("missing.txt")
+
+
+@pytest.fixture
+def count_scans(monkeypatch):
+    calls = []
+    scandir = os.scandir
+
+    def _scandir(path):
+        calls.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", _scandir)
+    return calls
+
+
+def test_job_single_scan(tmp_dir, count_scans):
+    """Each directory is read once for the length, iteration and scheduler file."""
+    for directory in ["a", "b"]:
+        (tmp_dir / directory).mkdir()
+        (tmp_dir / directory / "0.txt").touch()
+    template = CommandTemplate("touch {creates}", creates="{dir}/{var}.txt")
+    commands = [
+        Command.from_template(template, {"dir": directory, "var": i})
+        for directory in ["a", "b"]
+        for i in range(50)
+    ]
+    job = Job(commands, directory=tmp_dir, use_dependencies=True)
+    assert len(job) == 98
+    assert len(list(job)) == 98
+    create_scheduler_file("pbs", job)
+    assert len(count_scans) == 2
+
+
+def test_job_invalidate(tmp_dir):
+    command = Command("touch {creates}", creates="test.txt")
+    job = Job([command], directory=tmp_dir, use_dependencies=True)
+    assert len(job) == 1
+    (tmp_dir / "test.txt").touch()
+    # The cached result is used until the job is invalidated
+    assert len(job) == 1
+    job.invalidate()
+    assert len(job) == 0
+    job.use_dependencies = False
+    assert len(job) == 1
@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the dependencies between commands of different jobs."""
+
+import os
+
+import pytest
+
+from experi.commands import Command, CommandTemplate, Job
+from experi.graph import CommandGraph
+from experi.run import run_bash_jobs
+
+
+def pipeline(directory=None, use_dependencies=False):
+    """Jobs which generate, then simulate each value before a final analysis."""
+    generate = CommandTemplate("generate {var}", creates="init{var}.txt")
+    simulate = CommandTemplate(
+        "simulate {var}", creates="sim{var}.txt", requires="./init{var}.txt"
+    )
+    return [
+        Job(
+            [Command.from_template(template, {"var": i}) for i in range(3)],
+            directory=directory,
+            use_dependencies=use_dependencies,
+        )
+        for template in [generate, simulate]
+    ] + [Job([Command("analyse")], directory=directory)]
+
+
+def ready_commands(graph):
+    return [str(task.command) for task in graph.ready]
+
+
+def test_graph_dependencies():
+    graph = CommandGraph(pipeline())
+    assert len(graph) == 7
+    assert ready_commands(graph) == ["generate 0", "generate 1", "generate 2"]
+
+    first = graph.take()[0]
+    graph.complete(first, True)
+    # Only the command requiring the output of the first command is ready
+    assert ready_commands(graph) == ["generate 1", "generate 2", "simulate 0"]
+
+    for task in graph.take(3):
+        graph.complete(task, True)
+    assert ready_commands(graph) == ["simulate 0", "simulate 1", "simulate 2"]
+    for task in graph.take(2):
+        graph.complete(task, True)
+    assert ready_commands(graph) == ["simulate 2"]
+    graph.complete(graph.take()[0], True)
+    assert ready_commands(graph) == ["analyse"]
+
+
+def test_graph_failure():
+    """Commands depending on a failed command are skipped."""
+    graph = CommandGraph(pipeline())
+    tasks = graph.take(3)
+    graph.complete(tasks[0], False)
+    graph.complete(tasks[1], True)
+    graph.complete(tasks[2], True)
+    assert ready_commands(graph) == ["simulate 1", "simulate 2"]
+    for task in graph.take(2):
+        graph.complete(task, True)
+    # The failure of generate 0 skips simulate 0 and the analysis
+    assert not graph.ready
+    assert graph.failed == 3
+
+
+def test_graph_batches():
+    """Batches only contain tasks of a single job."""
+    graph = CommandGraph(pipeline())
+    tasks = graph.take(2)
+    for task in tasks:
+        graph.complete(task, True)
+    assert [str(task.command) for task in graph.take(3)] == ["generate 2"]
+
+
+def test_graph_up_to_date(tmp_dir):
+    """Up to date commands are skipped, unless a command they require runs."""
+    for i in range(3):
+        (tmp_dir / f"init{i}.txt").touch()
+        (tmp_dir / f"sim{i}.txt").touch()
+        os.utime(str(tmp_dir / f"init{i}.txt"), (100, 100))
+        os.utime(str(tmp_dir / f"sim{i}.txt"), (200, 200))
+    # The output of simulate 0 is out of date, and init 1 needs to be created
+    os.utime(str(tmp_dir / "init0.txt"), (300, 300))
+    (tmp_dir / "init1.txt").unlink()
+
+    graph = CommandGraph(pipeline(tmp_dir, use_dependencies=True))
+    assert ready_commands(graph) == ["generate 1", "simulate 0"]
+    graph.complete(graph.take()[0], True)
+    # simulate 1 runs since the file it requires is being created
+    assert ready_commands(graph) == ["simulate 0", "simulate 1"]
+    assert len(graph) == 4
+
+
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+def test_run_without_barrier(tmp_dir, persistent):
+    """A command starts once the command it requires is complete."""
+    slow = Command(
+        "for i in $(seq 100); do test -f sim1.txt && break; sleep 0.05; done; "
+        "test -f sim1.txt && touch overlap; touch {creates}",
+        creates="init0.txt",
+    )
+    generate = [slow, Command("touch {creates}", creates="init1.txt")]
+    simulate = CommandTemplate(
+        "cp {requires} {creates}", creates="sim{var}.txt", requires="init{var}.txt"
+    )
+    jobs = [
+        Job(generate),
+        Job([Command.from_template(simulate, {"var": i}) for i in range(2)]),
+    ]
+    run_bash_jobs(jobs, tmp_dir, max_workers=4, persistent=persistent)
+    assert (tmp_dir / "overlap").is_file()
+    assert (tmp_dir / "sim0.txt").is_file()
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_run_failure(tmp_dir, batch_size, max_workers):
+    generate = [
+        Command("false", creates="init0.txt"),
+        Command("touch {creates}", creates="init1.txt"),
+    ]
+    simulate = CommandTemplate(
+        "cp {requires} {creates}", creates="sim{var}.txt", requires="init{var}.txt"
+    )
+    jobs = [
+        Job(generate),
+        Job([Command.from_template(simulate, {"var": i}) for i in range(2)]),
+        Job([Command("touch analysed")]),
+    ]
+    run_bash_jobs(jobs, tmp_dir, max_workers=max_workers, batch_size=batch_size)
+    assert (tmp_dir / "sim1.txt").is_file()
+    assert not (tmp_dir / "sim0.txt").exists()
+    assert not (tmp_dir / "analysed").exists()
@@ -12,11 +12,18 @@ This is a series of tests that are defining the interface of the module,
 primarily the iteration of the variables."""
 
 import sys
+from itertools import islice
 from pathlib import Path
 
 import pytest
 
-from experi.run import process_command, process_jobs, read_file, variable_matrix
+from experi.run import (
+    process_command,
+    process_jobs,
+    process_structure,
+    read_file,
+    variable_matrix,
+)
 
 test_cases = sorted(Path("test/data/iter").glob("*.yml"))
 
@@ -46,3 +53,34 @@ def test_behaviour(test_file):
     for job in jobs:
         result.append([str(command) for command in job])
     assert result == structure["result"]
+
+
+def test_matrix_generated_lazily():
+    """The combinations of a large product are generated as they are required."""
+    variables = {f"var{i}": list(range(20)) for i in range(6)}
+    result = list(islice(variable_matrix(variables), 3))
+    expected = [{**{f"var{i}": 0 for i in range(5)}, "var5": j} for j in range(3)]
+    assert result == expected
+
+
+def test_matrix_repeatable():
+    """Processing the variables doesn't modify them, so they can be processed again."""
+    variables = {
+        "zip": {"var1": [1, 2, 3, 4], "cycle": {"times": 2, "var2": [1, 2]}},
+        "var3": [{"var4": 1}, {"var4": 2}],
+    }
+    first = list(variable_matrix(variables))
+    assert len(first) == 8
+    assert list(variable_matrix(variables)) == first
+
+
+def test_structure_multiple_jobs():
+    structure = {
+        "jobs": [{"command": "echo {var1}"}, {"command": "echo {var1} {var2}"}],
+        "variables": {"cycle": {"times": 2, "var1": [1, 2]}, "var2": [3, 4]},
+    }
+    result = [[str(command) for command in job] for job in process_structure(structure)]
+    assert result == [
+        ["echo 1", "echo 2"],
+        ["echo 1 3", "echo 1 4", "echo 2 3", "echo 2 4"],
+    ]
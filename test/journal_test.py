@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the journal of completed commands."""
+
+import os
+import subprocess
+from multiprocessing import Pool
+
+import pytest
+
+from experi.commands import Command, CommandTemplate, Job
+from experi.journal import Journal
+from experi.pbs import create_scheduler_file
+from experi.run import run_bash_jobs
+
+
+def test_digest_stable():
+    command = Command(["echo {var}", "echo done"], {"var": 1})
+    assert command.digest() == Command(["echo 1", "echo done"]).digest()
+    assert command.digest() != Command("echo 1 && echo done").digest()
+
+
+def test_record(tmp_dir):
+    journal = Journal(tmp_dir)
+    success, failure = Command("true"), Command("false")
+    journal.record(success, 0)
+    journal.record(failure, 1)
+    journal.close()
+    assert journal.read() == {success.digest(): 0, failure.digest(): 1}
+    assert Journal(tmp_dir).is_complete(success)
+    assert not Journal(tmp_dir).is_complete(failure)
+
+
+def test_latest_status(tmp_dir):
+    """The last status of a command in the journal is used."""
+    journal = Journal(tmp_dir)
+    command = Command("flaky")
+    journal.record(command, 1)
+    journal.record(command, 0)
+    journal.close()
+    assert Journal(tmp_dir).is_complete(command)
+
+
+def test_incomplete_line(tmp_dir):
+    journal = Journal(tmp_dir)
+    journal.record(Command("true"), 0)
+    journal.close()
+    with journal.path.open("a") as dst:
+        dst.write("0123abcd")
+    assert len(Journal(tmp_dir).completed) == 1
+
+
+def _record_commands(args):
+    directory, worker = args
+    journal = Journal(directory)
+    for i in range(200):
+        journal.record(Command(f"echo {worker} {i}"), 0)
+    journal.close()
+
+
+def test_concurrent_writers(tmp_dir):
+    with Pool(4) as pool:
+        pool.map(_record_commands, [(tmp_dir, worker) for worker in range(4)])
+    lines = Journal(tmp_dir).path.read_text().splitlines()
+    assert len(lines) == 800
+    assert len(Journal(tmp_dir).completed) == 800
+
+
+@pytest.mark.parametrize(
+    "max_workers, persistent, batch_size",
+    [(1, False, 1), (4, False, 1), (4, True, 1), (4, False, 3)],
+    ids=["sequential", "spawn", "persistent", "batch"],
+)
+def test_rerun_skips_completed(tmp_dir, max_workers, persistent, batch_size):
+    """Only the failed commands run again."""
+    template = CommandTemplate("echo {var} >> runs.txt && test -f {var}.ok")
+    commands = [Command.from_template(template, {"var": i}) for i in range(6)]
+    for i in range(3):
+        (tmp_dir / f"{i}.ok").touch()
+
+    def run():
+        journal = Journal(tmp_dir)
+        run_bash_jobs(
+            [Job(commands, journal=journal)],
+            tmp_dir,
+            max_workers=max_workers,
+            persistent=persistent,
+            batch_size=batch_size,
+        )
+        journal.close()
+
+    run()
+    for i in range(3, 6):
+        (tmp_dir / f"{i}.ok").touch()
+    run()
+    runs = (tmp_dir / "runs.txt").read_text().split()
+    assert sorted(runs) == ["0", "1", "2", "3", "3", "4", "4", "5", "5"]
+    assert len(Journal(tmp_dir).completed) == 6
+
+
+def test_scheduler_journal(tmp_dir):
+    """The scheduler script appends the exit status to the journal."""
+    command = Command("touch created")
+    journal = Journal(tmp_dir)
+    script = tmp_dir / "job.pbs"
+    script.write_text(create_scheduler_file("pbs", Job([command], journal=journal)))
+    env = dict(os.environ, PBS_O_WORKDIR=str(tmp_dir))
+    subprocess.run(["bash", str(script)], env=env, check=True)
+    assert (tmp_dir / "created").is_file()
+    assert Journal(tmp_dir).is_complete(command)
+    # Completed commands are left out of the scheduler file
+    assert "touch created" not in create_scheduler_file(
+        "pbs", Job([command], journal=Journal(tmp_dir))
+    )
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the memory used expanding and writing large experiments stays within budget.
+
+The budgets are of the memory for each combination of the variables, which sets the
+largest experiment which can be expanded on a login node without running out of
+memory. Writing the scheduler files shouldn't use more memory as the number of
+commands grows.
+
+"""
+
+import logging
+import subprocess
+import sys
+import textwrap
+import tracemalloc
+
+import pytest
+
+from experi.pbs import write_scheduler_file
+from experi.run import process_structure
+
+# The experiments have the same shapes as the benchmarks, so both measure the same thing
+from benchmarks.benchmarks import COMMAND, SHAPES
+
+# The number of combinations in each experiment
+SIZE = 20_000
+
+# The most memory in bytes for each combination, while expanding the variables and
+# once all the commands have been created.
+PEAK_BUDGET = 1024
+RETAINED_BUDGET = 64
+RSS_BUDGET = 1024
+
+# The most the memory in bytes writing a scheduler file grows from SIZE // 4 to SIZE
+# commands, which is much less than the size of the commands written.
+SCRIPT_BUDGET = 2 ** 16
+
+
+def create_structure(variables):
+    return {"jobs": [{"command": COMMAND}], "variables": variables, "pbs": True}
+
+
+@pytest.fixture
+def no_logging():
+    """Stop logging, since the records captured by pytest keep the values they use."""
+    logging.disable(logging.DEBUG)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.fixture
+def traced(no_logging):
+    tracemalloc.start()
+    yield
+    tracemalloc.stop()
+
+
+@pytest.mark.parametrize("shape", list(SHAPES))
+def test_expansion_memory(traced, shape):
+    start, _ = tracemalloc.get_traced_memory()
+    jobs = list(process_structure(create_structure(SHAPES[shape](SIZE)), "pbs"))
+    assert len(jobs[0]) == SIZE
+    retained, peak = tracemalloc.get_traced_memory()
+    assert (peak - start) / SIZE < PEAK_BUDGET
+    assert (retained - start) / SIZE < RETAINED_BUDGET
+
+
+def scheduler_file_peak(directory, size, manifest):
+    """The peak memory writing the scheduler file of an experiment."""
+    structure = create_structure(SHAPES["product"](size))
+    structure["pbs"] = {"manifest": manifest}
+    job = next(process_structure(structure, "pbs"))
+    fname = directory / "experi_00.pbs"
+    tracemalloc.start()
+    try:
+        with fname.open("w", buffering=2 ** 16) as dst:
+            write_scheduler_file("pbs", job, dst, fname.with_suffix(".commands"))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+@pytest.mark.parametrize("manifest", [False, True], ids=["script", "manifest"])
+def test_scheduler_file_memory(no_logging, tmp_dir, manifest):
+    """The commands are written as they are created rather than stored."""
+    small = scheduler_file_peak(tmp_dir, SIZE // 4, manifest)
+    large = scheduler_file_peak(tmp_dir, SIZE, manifest)
+    assert large - small < SCRIPT_BUDGET
+
+
+RSS_CODE = """
+import resource
+from experi.pbs import write_scheduler_file
+from experi.run import process_structure
+
+structure = {structure}
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+for job in process_structure(structure, "pbs"):
+    with open("experi_00.pbs", "w", buffering=2 ** 20) as dst:
+        write_scheduler_file("pbs", job, dst)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(after - before)
+"""
+
+
+def test_rss(tmp_dir):
+    """The resident memory, including the memory python doesn't return to the system.
+
+    The peak resident memory of a process can't be reset, so this is measured in a new
+    process, with the memory from importing experi excluded.
+
+    """
+    pytest.importorskip("resource")
+    if sys.platform != "linux":
+        pytest.skip("The maximum resident memory is only in kilobytes on linux")
+    code = RSS_CODE.format(structure=create_structure(SHAPES["product"](SIZE)))
+    result = subprocess.run(
+        [sys.executable, "-c", textwrap.dedent(code)],
+        cwd=str(tmp_dir),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    assert int(result.stdout) * 1024 / SIZE < RSS_BUDGET
@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the measurement of each phase of running an experiment."""
+
+import time
+
+import pytest
+
+from experi.profiling import Profiler
+
+
+def test_disabled():
+    profiler = Profiler()
+    with profiler.phase("read"):
+        pass
+    assert not profiler.times
+
+
+def test_nested_phases():
+    """The time of a phase excludes the time of the phases within it."""
+    profiler = Profiler(trace_memory=False)
+    profiler.start()
+    with profiler.phase("run"):
+        time.sleep(0.05)
+        with profiler.phase("expand"):
+            time.sleep(0.1)
+        with profiler.phase("expand"):
+            time.sleep(0.1)
+    profiler.stop()
+    assert list(profiler.times) == ["run", "expand"]
+    assert profiler.times["expand"] == pytest.approx(0.2, abs=0.05)
+    assert profiler.times["run"] == pytest.approx(0.05, abs=0.04)
+    assert not profiler.peak_memory
+
+
+def test_peak_memory():
+    profiler = Profiler()
+    profiler.start()
+    with profiler.phase("render"):
+        values = [bytearray(2 ** 20) for _ in range(8)]
+        del values
+    profiler.stop()
+    assert profiler.peak_memory["render"] >= 8 * 2 ** 20
+    report = profiler.report().splitlines()
+    assert report[1].startswith("Rendering")
+    assert report[-1].startswith("Total")
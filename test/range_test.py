@@ -15,6 +15,7 @@ import pytest
 import yaml
 
 from experi.run import variable_matrix
+from experi.space import arange, arange_values
 
 
 def get_ranges():
@@ -90,3 +91,34 @@ def test_values(start, stop, step, dtype):
     result = parse_string(create_string(start, stop, step, dtype))
     expected = generate_comparison(np.arange(start, stop, step, dtype))
     assert result == expected
+
+
+@pytest.mark.parametrize(
+    "string, value_type", [("arange: 4", int), ("arange: {start: 0.5, stop: 4}", float)]
+)
+def test_native_types(string, value_type):
+    """Values are converted to python types which are faster to format."""
+    result = parse_string(string)
+    assert all(type(value["test"]) is value_type for value in result)
+
+
+@pytest.mark.parametrize(
+    "variables",
+    [
+        7,
+        {"stop": 7},
+        {"start": 2, "stop": 20, "step": 3},
+        {"start": 0, "stop": 20, "step": 3},
+        {"start": 20, "stop": 2, "step": -3},
+        {"start": 2, "stop": 7},
+    ],
+)
+def test_integer_range(variables):
+    """Integer arguments create a range, matching the values from numpy."""
+    values = arange_values(variables)
+    assert isinstance(values, range)
+    if isinstance(variables, dict):
+        expected = arange(**variables).tolist()
+    else:
+        expected = arange(variables).tolist()
+    assert list(values) == expected
@@ -8,13 +8,29 @@
 
 """Test the running of commands."""
 
+import os
+import sys
 from pathlib import Path
 from typing import Iterator
 
 import pytest
 
-from experi.commands import Command, Job
-from experi.run import process_scheduler, run_bash_jobs, run_pbs_jobs
+from experi.commands import Command, CommandTemplate, Job
+from experi.local import (
+    Allocation,
+    ResourcePool,
+    Resources,
+    ShellWorker,
+    available_cpus,
+    parse_memory,
+    run_until_complete,
+)
+from experi.run import (
+    process_scheduler,
+    process_structure,
+    run_bash_jobs,
+    run_pbs_jobs,
+)
 
 
 @pytest.fixture
@@ -108,3 +124,241 @@ def test_dry_run(tmp_dir):
     create_file = tmp_dir / "test"
     run_bash_jobs(jobs, tmp_dir, dry_run=True)
     assert not create_file.exists()
+
+
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_parallel_jobs(tmp_dir, max_workers, persistent):
+    """All the commands in a job run, with the next job only run on success."""
+    commands = [Command(f"touch {i}.txt") for i in range(10)]
+    jobs = [Job(commands), Job([Command("touch next.txt")])]
+    run_bash_jobs(jobs, tmp_dir, max_workers=max_workers, persistent=persistent)
+    assert all((tmp_dir / f"{i}.txt").is_file() for i in range(10))
+    assert (tmp_dir / "next.txt").is_file()
+
+
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_parallel_failure(tmp_dir, max_workers, persistent):
+    commands = [Command("false")] + [Command(f"touch {i}.txt") for i in range(10)]
+    jobs = [Job(commands), Job([Command("touch next.txt")])]
+    run_bash_jobs(jobs, tmp_dir, max_workers=max_workers, persistent=persistent)
+    assert all((tmp_dir / f"{i}.txt").is_file() for i in range(10))
+    assert not (tmp_dir / "next.txt").exists()
+
+
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+def test_parallel_steps(tmp_dir, persistent):
+    """The steps of a single command run in order."""
+    commands = [
+        Command([f"mkdir {i}", f"touch {i}/created", f"rm {i}/created"])
+        for i in range(8)
+    ]
+    run_bash_jobs([Job(commands)], tmp_dir, max_workers=4, persistent=persistent)
+    for i in range(8):
+        assert (tmp_dir / str(i)).is_dir()
+        assert not (tmp_dir / str(i) / "created").exists()
+
+
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+def test_parallel_output(tmp_dir, capsys, persistent):
+    """The output of each command is labelled with its variables."""
+    template = CommandTemplate(["echo {var1}", "echo error {var1} >&2"])
+    commands = [Command.from_template(template, {"var1": i}) for i in range(4)]
+    run_bash_jobs([Job(commands)], tmp_dir, max_workers=4, persistent=persistent)
+    captured = capsys.readouterr()
+    assert sorted(captured.out.splitlines()) == [f"[var1={i}] {i}" for i in range(4)]
+    assert sorted(captured.err.splitlines()) == [
+        f"[var1={i}] error {i}" for i in range(4)
+    ]
+
+
+def test_sequential_output(tmp_dir, capfd):
+    """Running one command at a time, the output is written directly."""
+    template = CommandTemplate("echo {var1}")
+    commands = [Command.from_template(template, {"var1": i}) for i in range(3)]
+    run_bash_jobs([Job(commands)], tmp_dir)
+    assert capfd.readouterr().out.splitlines() == ["0", "1", "2"]
+
+
+def test_persistent_isolation(tmp_dir):
+    """Changes to the directory and environment don't carry between commands."""
+    commands = [
+        Command("mkdir sub && cd sub && export EXPERI_TEST=1"),
+        Command('test -z "$EXPERI_TEST" && touch passed'),
+        Command("exit 3"),
+        Command("touch after_exit"),
+    ]
+    run_bash_jobs([Job(commands)], tmp_dir, max_workers=1, persistent=True)
+    assert (tmp_dir / "passed").is_file()
+    assert (tmp_dir / "after_exit").is_file()
+
+
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+@pytest.mark.parametrize("batch_size", [3, "auto"])
+def test_batch_jobs(tmp_dir, capsys, batch_size, persistent):
+    """Each command in a batch is run, with failures reported separately."""
+    template = CommandTemplate("echo {var1} && touch {var1}.txt")
+    commands = [Command.from_template(template, {"var1": i}) for i in range(10)]
+    commands.insert(4, Command("echo 'unterminated"))
+    jobs = [Job(commands), Job([Command("touch next.txt")])]
+    run_bash_jobs(
+        jobs, tmp_dir, max_workers=2, persistent=persistent, batch_size=batch_size
+    )
+    assert all((tmp_dir / f"{i}.txt").is_file() for i in range(10))
+    assert not (tmp_dir / "next.txt").exists()
+    captured = capsys.readouterr()
+    assert sorted(captured.out.splitlines()) == sorted(
+        f"[var1={i}] {i}" for i in range(10)
+    )
+
+
+def test_batch_success(tmp_dir):
+    commands = [Command(f"touch {i}.txt") for i in range(10)]
+    jobs = [Job(commands), Job([Command("touch next.txt")])]
+    run_bash_jobs(jobs, tmp_dir, batch_size=4)
+    assert (tmp_dir / "next.txt").is_file()
+
+
+@pytest.mark.parametrize("batch_size", [1000, "auto"])
+def test_batch_large(tmp_dir, batch_size):
+    """A batch larger than the limit on the length of an argument runs."""
+    padding = "x" * 200
+    commands = [Command(f": {padding}; echo {i} >> out.txt") for i in range(2000)]
+    run_bash_jobs([Job(commands)], tmp_dir, batch_size=batch_size)
+    assert len((tmp_dir / "out.txt").read_text().splitlines()) == 2000
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (1024, 1024),
+        ("500", 500),
+        ("4gb", 4 * 2 ** 30),
+        ("2M", 2 * 2 ** 20),
+        ("1.5kb", 1536),
+    ],
+)
+def test_parse_memory(value, expected):
+    assert parse_memory(value) == expected
+
+
+def test_parse_memory_invalid():
+    with pytest.raises(ValueError):
+        parse_memory("4 lots")
+
+
+def test_resources_from_options():
+    assert Resources.from_options(None) is None
+    assert Resources.from_options({}) is None
+    assert Resources.from_options({"name": "local", "setup": "echo"}) is None
+    resources = Resources.from_options({"ncpus": 4, "mem": "2gb", "setup": "echo"})
+    assert resources.cpus == 4
+    assert resources.memory == 2 * 2 ** 30
+    assert resources.gpus == 0
+
+
+def test_shell_scheduler_resources():
+    """Running locally uses the resources of the scheduler sections."""
+    structure = {
+        "command": "echo {var}",
+        "variables": {"var": [1, 2]},
+        "shell": {"name": "local"},
+        "pbs": {"ncpus": 4, "name": "cluster"},
+    }
+    job = next(process_structure(structure, scheduler="shell"))
+    assert job.scheduler_options == {"ncpus": 4, "name": "local"}
+
+
+def test_resource_pool_packing():
+    """Commands only run when there are enough cpus available."""
+
+    async def allocate():
+        pool = ResourcePool(4)
+        resources = Resources(cpus=2)
+        first = await pool.acquire(resources)
+        second = await pool.acquire(resources)
+        assert not set(first.cpus) & set(second.cpus)
+        assert not pool._available(resources)
+        await pool.release(first)
+        assert pool._available(resources)
+        return pool.concurrency(resources)
+
+    assert run_until_complete(allocate()) == 2
+
+
+def test_resource_pool_fit():
+    pool = ResourcePool(2)
+    assert pool.fit(Resources(cpus=8)).cpus == 2
+
+
+@pytest.mark.parametrize(
+    "persistent, batch_size",
+    [(False, 1), (True, 1), (False, 2)],
+    ids=["spawn", "persistent", "batch"],
+)
+def test_resource_threads(tmp_dir, persistent, batch_size):
+    """The number of threads is set to the cpus of each command."""
+    template = CommandTemplate("echo $OMP_NUM_THREADS > {var}.txt")
+    commands = [Command.from_template(template, {"var": i}) for i in range(4)]
+    jobs = [Job(commands, scheduler_options={"ncpus": 2})]
+    run_bash_jobs(
+        jobs, tmp_dir, max_workers=4, persistent=persistent, batch_size=batch_size
+    )
+    for i in range(4):
+        assert (tmp_dir / f"{i}.txt").read_text().strip() == "2"
+
+
+@pytest.mark.parametrize(
+    "max_workers, options",
+    [(4, {}), (4, {"name": "local"}), (1, {"ncpus": 2})],
+    ids=["empty", "no-resources", "sequential"],
+)
+def test_resources_not_requested(tmp_dir, monkeypatch, max_workers, options):
+    """The number of threads is only set for commands requiring resources."""
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+    command = Command("echo ${{OMP_NUM_THREADS-unset}} > out.txt")
+    jobs = [Job([command], scheduler_options=options)]
+    run_bash_jobs(jobs, tmp_dir, max_workers=max_workers)
+    assert (tmp_dir / "out.txt").read_text().strip() == "unset"
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "sched_getaffinity") or len(os.sched_getaffinity(0)) < 4,
+    reason="Requires at least 4 cpus",
+)
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+def test_resource_pinning(tmp_dir, persistent):
+    """Each command runs on the number of cpus it requires."""
+    # nproc is not used since it also reads OMP_NUM_THREADS
+    affinity = "import os; print(len(os.sched_getaffinity(0)))"
+    template = CommandTemplate(f"{sys.executable} -c '{affinity}' > {{var}}.txt")
+    commands = [Command.from_template(template, {"var": i}) for i in range(4)]
+    jobs = [Job(commands, scheduler_options={"ncpus": 2})]
+    run_bash_jobs(jobs, tmp_dir, max_workers=4, persistent=persistent)
+    for i in range(4):
+        assert (tmp_dir / f"{i}.txt").read_text().strip() == "2"
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "sched_getaffinity") or len(os.sched_getaffinity(0)) < 2,
+    reason="Requires at least 2 cpus",
+)
+def test_persistent_affinity_reset(tmp_dir):
+    """A shell pinned for one batch can use every cpu for a batch without resources."""
+
+    async def affinities():
+        worker = ShellWorker("bash", tmp_dir)
+        await worker.start()
+        try:
+            allocation = Allocation(available_cpus()[:1], 0, [], pin=True)
+            await worker.run([Command("true")], allocation)
+            pinned = os.sched_getaffinity(worker.process.pid)
+            await worker.run([Command("true")])
+            return pinned, os.sched_getaffinity(worker.process.pid)
+        finally:
+            await worker.stop()
+
+    pinned, reset = run_until_complete(affinities())
+    assert len(pinned) == 1
+    assert sorted(reset) == available_cpus()
@@ -8,10 +8,21 @@
 
 """Test the building of pbs files."""
 
+import io
+import os
+import subprocess
+
 import pytest
 
-from experi.commands import Command, Job
-from experi.pbs import create_scheduler_file
+from experi.commands import Command, CommandTemplate, Job
+from experi.journal import JOURNAL_FILE, Journal
+from experi.pbs import (
+    ansi_c_quote,
+    create_scheduler_file,
+    parse_walltime,
+    write_scheduler_file,
+    write_template,
+)
 from experi.run import process_structure, read_file, run_jobs
 
 DEFAULT_PBS = """#!/bin/bash
@@ -27,7 +38,7 @@ COMMAND=( \\
 "echo 1" \\
 )
 
-${COMMAND[$PBS_ARRAY_INDEX]}
+eval "${COMMAND[$PBS_ARRAY_INDEX]}"
 """
 
 DEFAULT_SLURM = """#!/bin/bash
@@ -43,7 +54,7 @@ COMMAND=( \\
 "echo 1" \\
 )
 
-${COMMAND[$SLURM_ARRAY_TASK_ID]}
+eval "${COMMAND[$SLURM_ARRAY_TASK_ID]}"
 """
 
 @pytest.mark.parametrize(
@@ -74,3 +85,359 @@ def test_pbs_creation(tmp_dir):
     expected = structure["result"]
     with (tmp_dir / "experi_00.pbs").open("r") as result:
         assert result.read().strip() == expected.strip()
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_write_scheduler_file(tmp_dir, scheduler):
+    """Writing the file to a stream matches creating the string."""
+    job = Job([Command(f"echo {i}") for i in range(1000)], {"setup": ["module load"]})
+    with (tmp_dir / "job").open("w") as dst:
+        write_scheduler_file(scheduler, job, dst)
+    assert (tmp_dir / "job").read_text() == create_scheduler_file(scheduler, job)
+
+
+def test_write_template():
+    template = "{name!r} {value:>4} ${{ARRAY[{index}]}} {array}"
+    stream = io.StringIO()
+    write_template(
+        stream,
+        template,
+        {"array": lambda stream: stream.write("( a b )")},
+        name="job",
+        value=1,
+        index="$i",
+    )
+    expected = template.format(name="job", value=1, index="$i", array="( a b )")
+    assert stream.getvalue() == expected
+
+
+ARRAY_INDEX = {"pbs": "PBS_ARRAY_INDEX", "slurm": "SLURM_ARRAY_TASK_ID"}
+WORKDIR = {"pbs": "PBS_O_WORKDIR", "slurm": "SLURM_SUBMIT_DIR"}
+
+MANIFEST_COMMANDS = [
+    "echo 'single quotes' && echo \"double $((1 + 1))\"",
+    "printf '%s|' 'multiple\nlines'",
+    "echo back\\\\slash\ttab ünïcode",
+    "exit 3",
+]
+
+
+def run_array_element(directory, scheduler, script, index):
+    env = dict(os.environ)
+    env[ARRAY_INDEX[scheduler]] = str(index)
+    env[WORKDIR[scheduler]] = str(directory)
+    return subprocess.run(
+        ["bash", str(script)], env=env, stdout=subprocess.PIPE, cwd=str(directory)
+    )
+
+
+@pytest.mark.parametrize("string", MANIFEST_COMMANDS + ["\x01\x7f", ""])
+def test_ansi_c_quote(string):
+    quoted = ansi_c_quote(string)
+    assert "\n" not in quoted
+    result = subprocess.run(
+        ["bash", "-c", f"printf '%s' {quoted}"], stdout=subprocess.PIPE
+    )
+    assert result.stdout.decode() == string
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_manifest(tmp_dir, scheduler):
+    """Each element of the array runs its command from the manifest."""
+    commands = [Command(command) for command in MANIFEST_COMMANDS]
+    job = Job(commands, {"manifest": True})
+    script = tmp_dir / f"experi_00.{scheduler}"
+    manifest = tmp_dir / "experi_00.commands"
+    script.write_text(create_scheduler_file(scheduler, job, manifest))
+    assert "manifest" not in script.read_text()
+
+    expected = [
+        b"single quotes\ndouble 2\n",
+        b"multiple\nlines|",
+        "back\\slash tab ünïcode\n".encode(),
+        b"",
+    ]
+    for index, output in enumerate(expected):
+        result = run_array_element(tmp_dir, scheduler, script, index)
+        assert result.stdout == output
+    assert result.returncode == 3
+
+
+@pytest.mark.parametrize("chunk", [1, 3])
+def test_inline_matches_manifest(tmp_dir, chunk):
+    """Commands are interpreted the same with or without a manifest."""
+    commands = [
+        Command(f"touch f{i}.txt && test {i} -ne 3 && echo done > out{i}.txt")
+        for i in range(1, 5)
+    ]
+    results = []
+    for manifest in [False, True]:
+        directory = tmp_dir / str(manifest)
+        directory.mkdir()
+        job = Job(commands, {"chunk": chunk, "manifest": manifest})
+        script = directory / "experi_00.pbs"
+        manifest_path = directory / "experi_00.commands"
+        script.write_text(create_scheduler_file("pbs", job, manifest_path))
+        statuses = [
+            run_array_element(directory, "pbs", script, index).returncode
+            for index in range(-(-len(commands) // chunk))
+        ]
+        files = sorted(path.name for path in directory.glob("*.txt"))
+        results.append((statuses, files))
+    assert results[0] == results[1]
+    assert results[0][1] == [
+        "f1.txt",
+        "f2.txt",
+        "f3.txt",
+        "f4.txt",
+        "out1.txt",
+        "out2.txt",
+        "out4.txt",
+    ]
+    assert (tmp_dir / "True" / "out1.txt").read_text() == "done\n"
+
+
+def test_manifest_size(tmp_dir):
+    """The scheduler file is the same size however many commands there are."""
+    sizes = []
+    for num_commands in [10, 10_000]:
+        commands = [Command(f"echo {i}") for i in range(num_commands)]
+        job = Job(commands, {"manifest": True})
+        manifest = tmp_dir / "experi_00.commands"
+        sizes.append(len(create_scheduler_file("pbs", job, manifest)))
+    assert sizes[1] - sizes[0] == len("9999") - len("9")
+    assert sizes[1] < 500
+
+
+def test_manifest_journal(tmp_dir):
+    commands = [Command("echo success"), Command("false")]
+    job = Job(commands, {"manifest": True}, journal=Journal(tmp_dir))
+    script = tmp_dir / "experi_00.pbs"
+    manifest = tmp_dir / "experi_00.commands"
+    script.write_text(create_scheduler_file("pbs", job, manifest))
+    for index in range(len(commands)):
+        run_array_element(tmp_dir, "pbs", script, index)
+    assert (tmp_dir / JOURNAL_FILE).read_text().splitlines() == [
+        f"{commands[0].digest()} 0",
+        f"{commands[1].digest()} 1",
+    ]
+
+
+def test_manifest_requires_path():
+    with pytest.raises(ValueError):
+        create_scheduler_file("pbs", Job([Command("echo 1")], {"manifest": True}))
+
+
+def test_manifest_run_jobs(tmp_dir):
+    job = Job([Command(f"echo {i}") for i in range(3)], {"manifest": True})
+    run_jobs([job], "pbs", tmp_dir)
+    assert (tmp_dir / "experi_00.commands").read_text().splitlines() == [
+        "$'echo 0'",
+        "$'echo 1'",
+        "$'echo 2'",
+    ]
+    assert (tmp_dir / "experi_00.commands.index").stat().st_size == 3 * 16
+
+
+@pytest.mark.parametrize(
+    "scheduler, walltime, expected",
+    [
+        ("pbs", "1:00", 60),
+        ("pbs", "2:03:04", 7384),
+        ("pbs", 90, 90),
+        ("slurm", 90, 5400),
+        ("slurm", "1-2", 93600),
+        ("slurm", "1-0:30", 88200),
+    ],
+)
+def test_parse_walltime(scheduler, walltime, expected):
+    assert parse_walltime(walltime, scheduler) == expected
+
+
+@pytest.mark.parametrize(
+    "options, array, walltime",
+    [
+        ({"chunk": 4}, "#PBS -J 0-2", "#PBS -l walltime=0:40:00"),
+        ({"chunk": 4, "chunk_parallel": True}, "#PBS -J 0-2", "walltime=0:20:00"),
+        ({"chunk": 20}, "PBS_ARRAY_INDEX=0", "#PBS -l walltime=1:40:00"),
+    ],
+)
+def test_chunk_header(options, array, walltime):
+    job = Job([Command(f"echo {i}") for i in range(10)], {"walltime": "10:00"})
+    job.scheduler_options.update(options, ncpus=2)
+    result = create_scheduler_file("pbs", job)
+    assert array in result.splitlines()
+    assert walltime in result
+    assert "chunk" not in result.split("\n\n")[0]
+
+
+CHUNK_COMMANDS = ["echo 0", "echo 1", "exit 3", "echo 3", "echo 4"]
+
+
+@pytest.mark.parametrize("manifest", [False, True], ids=["inline", "manifest"])
+@pytest.mark.parametrize("parallel", [False, True], ids=["serial", "parallel"])
+def test_chunk(tmp_dir, manifest, parallel):
+    """Every command of a chunk runs, with each exit status in the journal."""
+    commands = [Command(command) for command in CHUNK_COMMANDS]
+    options = {"chunk": 3, "chunk_parallel": parallel, "ncpus": 2, "manifest": manifest}
+    job = Job(commands, options, journal=Journal(tmp_dir))
+    script = tmp_dir / "experi_00.pbs"
+    manifest_path = tmp_dir / "experi_00.commands"
+    script.write_text(create_scheduler_file("pbs", job, manifest_path))
+
+    first = run_array_element(tmp_dir, "pbs", script, 0)
+    assert first.returncode == 3
+    assert sorted(first.stdout.split()) == [b"0", b"1"]
+    second = run_array_element(tmp_dir, "pbs", script, 1)
+    assert second.returncode == 0
+    assert sorted(second.stdout.split()) == [b"3", b"4"]
+
+    journal = Journal(tmp_dir)
+    assert journal.completed == {commands[i].digest() for i in [0, 1, 3, 4]}
+    assert not journal.is_complete(commands[2])
+
+
+def test_chunk_parallel(tmp_dir):
+    """The commands of a chunk run at the same time."""
+    wait = "for i in $(seq 100); do test -f {} && break; sleep 0.05; done; test -f {}"
+    commands = [
+        Command(f"touch first && {wait.format('second', 'second')}"),
+        Command(f"touch second && {wait.format('first', 'first')}"),
+    ]
+    options = {"chunk": 2, "chunk_parallel": True, "ncpus": 2, "manifest": True}
+    script = tmp_dir / "experi_00.pbs"
+    job = Job(commands, options)
+    script.write_text(create_scheduler_file("pbs", job, tmp_dir / "experi_00.commands"))
+    assert run_array_element(tmp_dir, "pbs", script, 0).returncode == 0
+
+
+# Logs the arguments of each submission, printing a new job id
+FAKE_SUBMIT = """#!/bin/bash
+echo "$*" >> "{log}"
+echo job$(wc -l < "{log}")
+"""
+
+
+@pytest.fixture
+def fake_submit(tmp_dir, monkeypatch):
+    """Replace qsub and sbatch with scripts logging their arguments."""
+    bin_dir = tmp_dir / "bin"
+    bin_dir.mkdir()
+    log = tmp_dir / "submitted"
+    for command in ["qsub", "sbatch"]:
+        script = bin_dir / command
+        script.write_text(FAKE_SUBMIT.format(log=log))
+        script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    def submitted():
+        return [line.split() for line in log.read_text().splitlines()]
+
+    return submitted
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_max_array_size(tmp_dir, fake_submit, scheduler):
+    """Large jobs are split into arrays, with the next job depending on every part."""
+    options = {"max_array_size": 2, "chunk": 2, "manifest": True}
+    jobs = [
+        Job([Command(f"echo {i}") for i in range(9)], options),
+        Job([Command("echo analyse")], options),
+    ]
+    run_jobs(jobs, scheduler, tmp_dir)
+
+    submitted = fake_submit()
+    files = [args[-1] for args in submitted]
+    assert files == [
+        f"experi_00_000.{scheduler}",
+        f"experi_00_001.{scheduler}",
+        f"experi_00_002.{scheduler}",
+        f"experi_01.{scheduler}",
+    ]
+    assert all(len(args) == 1 for args in submitted[:3])
+    assert submitted[3][1].endswith("afterok:job1:job2:job3")
+    assert (tmp_dir / "experi_00_002.commands").read_text() == "$'echo 8'\n"
+    assert "max_array_size" not in (tmp_dir / files[0]).read_text()
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+@pytest.mark.parametrize("manifest", [False, True], ids=["inline", "manifest"])
+def test_skip_completed_job(tmp_dir, fake_submit, scheduler, manifest):
+    """A job without any commands to run is neither written nor submitted."""
+    completed = [Command(f"echo {i}") for i in range(3)]
+    journal = Journal(tmp_dir)
+    for command in completed:
+        journal.record(command, 0)
+    journal.close()
+    options = {"manifest": manifest}
+    jobs = [
+        Job(completed, options, journal=Journal(tmp_dir)),
+        Job([Command("echo analyse")], options, journal=Journal(tmp_dir)),
+    ]
+    run_jobs(jobs, scheduler, tmp_dir)
+    assert fake_submit() == [[f"experi_01.{scheduler}"]]
+    assert not (tmp_dir / f"experi_00.{scheduler}").exists()
+    assert not (tmp_dir / "experi_00.commands").exists()
+
+
+def pipeline_jobs(num_commands, options, requires="sim{var}.txt"):
+    simulate = CommandTemplate("touch {creates}", creates="sim{var}.txt")
+    analyse = CommandTemplate(
+        "cp {requires} {creates}", creates="out{var}.txt", requires=requires
+    )
+    return [
+        Job(
+            [Command.from_template(template, {"var": i}) for i in range(num_commands)],
+            options,
+        )
+        for template in [simulate, analyse, simulate]
+    ]
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"chunk": 2, "max_array_size": 2}], ids=["array", "split"]
+)
+def test_elementwise_dependency(tmp_dir, fake_submit, options):
+    """Each element of the analysis only waits for the same simulation."""
+    run_jobs(pipeline_jobs(6, options), "slurm", tmp_dir)
+    dependencies = [args[1] for args in fake_submit() if args[0] == "--dependency"]
+    if options:
+        # The simulation and analysis are both split into two arrays
+        assert dependencies == [
+            "aftercorr:job1",
+            "aftercorr:job2",
+            "afterok:job1:job2:job3:job4",
+            "afterok:job1:job2:job3:job4",
+        ]
+    else:
+        assert dependencies == ["aftercorr:job1", "afterok:job1:job2"]
+
+
+@pytest.mark.parametrize(
+    "num_commands, requires, options",
+    [
+        (3, "sim0.txt", {}),
+        (3, "other{var}.txt", {}),
+        (3, "sim{var}.txt", {"chunk": 2}),
+    ],
+    ids=["same-file", "other-file", "shape"],
+)
+def test_no_elementwise_dependency(
+    tmp_dir, fake_submit, num_commands, requires, options
+):
+    jobs = pipeline_jobs(num_commands, {}, requires)
+    jobs[1].scheduler_options = options
+    run_jobs(jobs[:2], "slurm", tmp_dir)
+    assert fake_submit()[1][:2] == ["--dependency", "afterok:job1"]
+
+
+def test_elementwise_earlier_jobs(tmp_dir, fake_submit):
+    jobs = pipeline_jobs(3, {})
+    run_jobs([jobs[2]] + jobs[:2], "slurm", tmp_dir)
+    assert fake_submit()[2][1] == "afterok:job1,aftercorr:job2"
+
+
+def test_elementwise_pbs(tmp_dir, fake_submit):
+    """PBS has no elementwise dependencies between arrays."""
+    run_jobs(pipeline_jobs(3, {}), "pbs", tmp_dir)
+    assert fake_submit()[1][1].startswith("depend=afterok:job1")
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test random access to the combinations of variables."""
+
+from pathlib import Path
+
+import pytest
+
+from experi.run import read_file, variable_matrix
+from experi.space import VariableSpace
+
+test_cases = sorted(Path("test/data/iter").glob("*.yml"))
+
+
+@pytest.mark.parametrize("test_file", test_cases, ids=[i.stem for i in test_cases])
+def test_matches_matrix(test_file):
+    variables = read_file(test_file)["variables"]
+    expected = list(variable_matrix(variables))
+    space = VariableSpace(variables)
+    assert len(space) == len(expected)
+    assert [space[i] for i in range(len(space))] == expected
+    assert list(space) == expected
+
+
+def test_large_product():
+    variables = {f"var{i}": list(range(20)) for i in range(6)}
+    space = VariableSpace(variables)
+    assert len(space) == 20 ** 6
+    index = 9_999_999
+    expected = {f"var{5 - i}": (index // 20 ** i) % 20 for i in range(6)}
+    assert space[index] == expected
+    assert space[-1] == {f"var{i}": 19 for i in range(6)}
+    assert space[-2:] == [space[-2], space[-1]]
+
+
+@pytest.mark.parametrize(
+    "variables",
+    [
+        {"zip": {"var1": [1, 2, 3], "var2": [4, 5]}},
+        {"chain": [{"var1": [1, 2]}, {"var1": 3, "var2": [4, 5, 6]}]},
+        {"cycle": {"times": 3, "var1": [1, 2]}, "var2": {"arange": 4}},
+        {"var1": {"arange": {"start": 1, "stop": 2, "step": 0.25}}},
+    ],
+    ids=["zip", "chain", "cycle", "arange"],
+)
+def test_iterators(variables):
+    expected = list(variable_matrix(variables))
+    space = VariableSpace(variables)
+    assert len(space) == len(expected)
+    assert list(space) == expected
+
+
+@pytest.mark.parametrize("index", [4, -5])
+def test_index_error(index):
+    space = VariableSpace({"var1": [1, 2, 3, 4]})
+    with pytest.raises(IndexError):
+        space[index]